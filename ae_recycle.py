@@ -0,0 +1,229 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+import process_wrapper
+import render_store
+from log_sink import SubprocessLog
+
+LOGGER = logging.getLogger('ae_recycle')
+LOGGER.setLevel(level=logging.DEBUG)
+
+GB = 1024 * 1024 * 1024
+# Item fields that can change any frame of the comp.  The duration only moves the end of the last segment and
+# the markers only the segments either side of them, so those are part of each segment's own fingerprint.  The
+# event, division, variant and item name only change where the output goes
+SEGMENT_ITEM_FIELDS = [x for x in render_store.ITEM_FIELDS if x != 'duration'] + \
+    ['flags', 'location', 'source_appearance', 'source_duration', 'source_name', 'speed_divisor']
+
+
+class TrendMonitor:
+    """Watches the seconds per frame moving average and After Effects memory since it last started."""
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.frames = 0
+        self.best_spf = None
+        self.baseline_rss = None
+        self.spf = None
+        self.rss = None
+
+    def observe(self, spf_moving_average, rss_bytes=None):
+        self.frames += 1
+        self.spf = spf_moving_average
+        if self.frames >= self.policy.warmup_frames:
+            self.best_spf = min(self.best_spf or spf_moving_average, spf_moving_average)
+        if rss_bytes:
+            self.rss = rss_bytes
+            if self.baseline_rss is None and self.frames >= self.policy.warmup_frames:
+                self.baseline_rss = rss_bytes
+
+    def reason(self):
+        """Why After Effects should be restarted, or None."""
+        policy = self.policy
+        if self.rss and policy.rss_limit_gb and self.rss > policy.rss_limit_gb * GB:
+            return f"After Effects using {self.rss / GB:.1f}GB, over the limit of {policy.rss_limit_gb:.1f}GB"
+        if self.rss and self.baseline_rss and policy.rss_growth and self.rss > self.baseline_rss * policy.rss_growth:
+            return f"After Effects memory grew from {self.baseline_rss / GB:.1f}GB to {self.rss / GB:.1f}GB"
+        if self.best_spf and policy.spf_growth and self.spf > self.best_spf * policy.spf_growth:
+            return f"seconds per frame rose from {self.best_spf:.2f} to {self.spf:.2f}"
+        return None
+
+
+class RecyclePolicy:
+    """Renders long comps as segments of frames, restarting After Effects between them when it slows down.
+
+    aerender cannot be stopped part way through a QuickTime file without losing it, so the frame boundaries
+    are those between segments, each rendered with -s and -e to its own file.  With reuse, segments after
+    the first hand the comp to the running After Effects via -reuse, and only once a TrendMonitor threshold
+    is crossed is that instance ended so that the next segment starts a fresh one.  Without it, as when
+    several renders share the host, every segment starts afresh.  The segments are then joined without
+    re-encoding by ffmpeg's concat demuxer.
+
+    With keep_segments, segments start at the item's markers as well, and are kept after joining along with a
+    SegmentManifest of what each was rendered from.  This is for retries and resumes: a retry, or a later run
+    after a render was interrupted or failed part way, only renders the segments not yet kept, and an edit to
+    the item's duration or markers alone only renders those whose fingerprint it changed.  It does not help
+    with formatter edits such as a new caption or music cue, as they re-save the AE project and every segment
+    is then rendered again.
+    """
+
+    def __init__(self, ffmpeg_path, segment_frames=1500, min_frames=3000, warmup_frames=50, spf_growth=1.3,
+                 rss_growth=1.5, rss_limit_gb=None, reuse=True, keep_segments=False, min_segment_frames=250):
+        self.ffmpeg_path = ffmpeg_path
+        self.segment_frames = segment_frames
+        self.min_frames = min_frames
+        self.warmup_frames = warmup_frames
+        self.spf_growth = spf_growth
+        self.rss_growth = rss_growth
+        self.rss_limit_gb = rss_limit_gb
+        self.reuse = reuse
+        self.keep_segments = keep_segments
+        self.min_segment_frames = min_segment_frames
+
+    @classmethod
+    def from_env(cls, env):
+        if not env.get('ae_recycle'):
+            return None
+        settings = dict(env['ae_recycle'])
+        if not env.get('ffmpeg_path'):
+            raise ValueError("ae_recycle needs ffmpeg_path in the env to join the rendered segments")
+        # -reuse would hand concurrent renders to the same After Effects instance
+        return cls(env['ffmpeg_path'], reuse=env.get('render_slots', 1) <= 1, **settings)
+
+    def applies(self, total_frames):
+        return total_frames >= self.min_frames
+
+    def segments(self, total_frames, marker_frames=()):
+        """(start, end) frames, inclusive, of each segment, also starting one at each marker frame that leaves
+        at least min_segment_frames since the last."""
+        boundaries = [0]
+        for frame in sorted(set(marker_frames)):
+            if boundaries[-1] + self.min_segment_frames <= frame <= total_frames - self.min_segment_frames:
+                boundaries.append(frame)
+        boundaries.append(total_frames)
+
+        segments = []
+        for span_start, span_end in zip(boundaries, boundaries[1:]):
+            # Counted from the marker, so that a change later in the span leaves the segments before it alone
+            segments += [(start, min(span_end, start + self.segment_frames) - 1)
+                         for start in range(span_start, span_end, self.segment_frames)]
+        return segments
+
+    def monitor(self):
+        return TrendMonitor(self)
+
+
+def marker_frames(item):
+    """The item's markers as frames of the rendered comp, scaled from the source comp by the speed divisor."""
+    frames = [round(x * item.speed_divisor * item.frame_rate) for x in item.marker_times]
+    return [x for x in frames if 0 <= x < round(item.duration * item.frame_rate)]
+
+
+def segment_fingerprint(params, start_frame, end_frame, markers):
+    fields = dict(
+        item={name: getattr(params.item, name) for name in SEGMENT_ITEM_FIELDS},
+        ae={name: getattr(params.render.ae, name) for name in render_store.AE_FIELDS},
+        frames=[start_frame, end_frame],
+        markers=[x for x in markers if start_frame <= x <= end_frame + 1],
+    )
+    return hashlib.sha256(json.dumps(fields, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def project_stamp(project_path):
+    stat = os.stat(project_path)
+    return f"{stat.st_mtime_ns}:{stat.st_size}"
+
+
+class SegmentManifest:
+    """Sidecar json kept with an item's segments, recording the fingerprint of each and the AE project they
+    were rendered from.
+
+    The fingerprints only see the item params, not the comp in the AE project, so nothing can say which frames
+    an edit to the project affected, even when some fingerprints have changed with it.  Once the project has
+    changed every segment is rendered again.
+    """
+
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self.project = None
+        self.segments = {}
+
+    def load(self):
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as file:
+                data = json.load(file)
+            self.project = data['project']
+            self.segments = data['segments']
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as exc:
+            LOGGER.warning("Ignoring unreadable segment manifest %s: %s", self.manifest_path, exc)
+        return self
+
+    def save(self):
+        partial_path = f"{self.manifest_path}.partial"
+        with open(partial_path, 'w', encoding='utf-8') as file:
+            json.dump(dict(project=self.project, segments=self.segments), file, indent=2, sort_keys=True)
+        os.replace(partial_path, self.manifest_path)
+
+    def reusable(self, fingerprints, project):
+        """Names of kept segments that can be joined again as they are, from the names and fingerprints of
+        those wanted now."""
+        if project != self.project:
+            return set()
+        return {name for name, fingerprint in fingerprints.items() if self.segments.get(name) == fingerprint}
+
+    def update(self, project, names):
+        """Start rendering against project, keeping only the named segments and returning the others."""
+        dropped = [name for name in self.segments if name not in names]
+        self.project = project
+        self.segments = {name: self.segments[name] for name in names}
+        self.save()
+        return dropped
+
+    def add(self, name, fingerprint):
+        self.segments[name] = fingerprint
+        self.save()
+
+
+def join_segments(ffmpeg_path, segment_paths, output_path, job_name):
+    """Concatenate segments into one file without re-encoding, returning ffmpeg's return code."""
+    list_path = f"{output_path}.segments.txt"
+    with open(list_path, 'w', encoding='utf-8') as file:
+        for segment_path in segment_paths:
+            escaped_path = os.path.abspath(segment_path).replace("'", "'\\''")
+            file.write(f"file '{escaped_path}'\n")
+
+    ffmpeg = process_wrapper.ProcessWrapper([
+        ffmpeg_path,
+        '-hide_banner',
+        '-nostdin',
+        '-y',
+        '-f', 'concat',
+        '-safe', '0',
+        '-i', list_path,
+        '-map', '0',
+        '-c', 'copy',
+        output_path
+    ])
+    log = SubprocessLog.sink(f"{job_name} ffmpeg", LOGGER)
+    ffmpeg.run()
+    try:
+        try:
+            while ffmpeg.is_alive() or not ffmpeg.output_queue.empty():
+                while not ffmpeg.output_queue.empty():
+                    stream_label, seconds, line = ffmpeg.output_queue.get()
+                    if stream_label == 'EXC':
+                        raise line
+                    log.write(stream_label, line)
+                time.sleep(0.5)
+        except (Exception, KeyboardInterrupt):
+            ffmpeg.kill()
+            raise
+    finally:
+        log.close()
+        os.remove(list_path)
+    return ffmpeg.get_return_code()
@@ -0,0 +1,58 @@
+import logging
+
+import psutil
+
+LOGGER = logging.getLogger('ae_session')
+LOGGER.setLevel(level=logging.DEBUG)
+
+
+class AeSession:
+    """An After Effects instance kept running between the aerender runs of items that share a project.
+
+    Each item still has its own aerender process, so progress, return codes, retries and trackers stay
+    per item.  With -reuse and -close DO_NOT_CLOSE, aerender hands the comp to the instance left by the
+    previous item instead of starting After Effects and loading the project again.  The instance is ended
+    when an item needs a different project, after a failure, and at the end of the run.
+
+    -reuse attaches to any running After Effects, so this is meant for dedicated render hosts.
+    """
+
+    def __init__(self):
+        self.project_path = None
+        self.ae_pids = []
+        self.items_rendered = 0
+
+    def aerender_args(self, project_path):
+        """Arguments that make aerender use the session, first ending it if it holds another project."""
+        if self.project_path != project_path:
+            self.close()
+            self.project_path = project_path
+        return ['-reuse', '-close', 'DO_NOT_CLOSE']
+
+    def rendered(self, ae_pids):
+        """Note a successful item along with the After Effects processes it ran in."""
+        self.ae_pids += [x for x in ae_pids if x not in self.ae_pids]
+        self.items_rendered += 1
+
+    def failed(self, killed=False):
+        """After a failure the state of the project in After Effects is unknown, so start afresh."""
+        if killed:
+            self.ae_pids = []
+        self.close()
+
+    def close(self):
+        if self.project_path and self.items_rendered:
+            LOGGER.info("Ending After Effects session for %s after %d items", self.project_path,
+                        self.items_rendered)
+        processes = []
+        for pid in self.ae_pids:
+            try:
+                process = psutil.Process(pid)
+                process.kill()
+                processes.append(process)
+            except (psutil.NoSuchProcess, ProcessLookupError):
+                LOGGER.info("After Effects process with pid %s no longer active", pid)
+        psutil.wait_procs(processes, timeout=30)
+        self.project_path = None
+        self.ae_pids = []
+        self.items_rendered = 0
@@ -0,0 +1,150 @@
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import json5
+
+import division_order
+import item_params
+import path_maker
+
+LOGGER = logging.getLogger('division_index')
+LOGGER.setLevel(level=logging.DEBUG)
+
+SCHEMA_VERSION = 1
+
+
+class DivisionIndex:
+    """Compiled copy of the order.json5 and item json5 files of each division, held in SQLite.
+
+    Files are stored as parsed JSON keyed on path, along with their mtime and size, and are only
+    re-parsed with json5 when either changes.  Loading a division then costs one directory scan and
+    one query, and item models are validated from JSON by pydantic's native parser.
+    """
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.connection = None
+        self.lock = threading.RLock()
+        self.refreshed_dirs = set()
+
+    def open(self):
+        try:
+            self.connection = self.connect()
+        except sqlite3.DatabaseError as exp:
+            LOGGER.warning(f"Rebuilding division index {self.index_path}: {exp}")
+            os.remove(self.index_path)
+            self.connection = self.connect()
+        return self
+
+    def connect(self):
+        connection = sqlite3.connect(self.index_path, check_same_thread=False)
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            connection.execute("DROP TABLE IF EXISTS files")
+            connection.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+        connection.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, defs_dir TEXT NOT NULL, "
+                           "mtime_ns INTEGER NOT NULL, size INTEGER NOT NULL, data TEXT NOT NULL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS files_defs_dir ON files (defs_dir)")
+        connection.commit()
+        return connection
+
+    def close(self):
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+    def query(self, sql, parameters=()):
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def refresh(self, defs_dir):
+        """Bring the index for one defs directory up to date, parsing only new or changed files."""
+        if defs_dir in self.refreshed_dirs:
+            return
+        start_time = time.perf_counter()
+        indexed = {path: (mtime_ns, size) for path, mtime_ns, size in self.query(
+            "SELECT path, mtime_ns, size FROM files WHERE defs_dir = ?", (defs_dir,))}
+
+        changed = []
+        present = set()
+        with os.scandir(defs_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.json5') or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                present.add(entry.path)
+                if indexed.get(entry.path) != (stat.st_mtime_ns, stat.st_size):
+                    changed.append(self.parse_file(entry.path, defs_dir, stat))
+
+        removed = [(path,) for path in indexed if path not in present]
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)", changed)
+            self.connection.executemany("DELETE FROM files WHERE path = ?", removed)
+        self.refreshed_dirs.add(defs_dir)
+        LOGGER.debug(f"Indexed {defs_dir}: {len(present)} files, {len(changed)} parsed, {len(removed)} removed "
+                     f"in {time.perf_counter() - start_time:.3f}s")
+
+    @staticmethod
+    def parse_file(path, defs_dir, stat):
+        with open(path, 'r', encoding='utf-8') as file:
+            data = json5.load(file)
+        return path, defs_dir, stat.st_mtime_ns, stat.st_size, json.dumps(data)
+
+    def file_data(self, path):
+        defs_dir = os.path.dirname(path)
+        if defs_dir not in self.refreshed_dirs:
+            self.refresh(defs_dir)
+            rows = self.query("SELECT data FROM files WHERE path = ?", (path,))
+            if not rows:
+                raise FileNotFoundError(f"No such file: {path}")
+            return rows[0][0]
+
+        # Already scanned this run, so only check that this file has not been edited since
+        stat = os.stat(path)
+        row = next(iter(self.query("SELECT mtime_ns, size, data FROM files WHERE path = ?", (path,))), None)
+        if row is None or row[:2] != (stat.st_mtime_ns, stat.st_size):
+            parsed = self.parse_file(path, defs_dir, stat)
+            with self.lock, self.connection:
+                self.connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)", parsed)
+            return parsed[-1]
+        return row[2]
+
+    def order(self, order_path):
+        return division_order.DivisionOrder(order=json.loads(self.file_data(order_path)))
+
+    def item_params(self, item_path):
+        return item_params.ItemParams.model_validate_json(self.file_data(item_path))
+
+    def division_items(self, division_path_maker):
+        """All items of a division in appearance order, as (order_item, ItemParams) pairs."""
+        order = self.order(division_path_maker.order_path())
+        return [(order_item, self.item_params(division_path_maker.item_path(order_item['name'])))
+                for order_item in order.order['appearance_order']]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build or refresh the division index ahead of a run.')
+    parser.add_argument('specs', nargs='+', metavar='SPEC',
+                        help='event/division[/variant] specs as for sloerender.py --batch, e.g. "hoc2025/*"')
+    parser.add_argument('--division-index', default='sloerender_division_index.sqlite')
+    parser.add_argument('--env-filepath', default='sloerender_env.json5')
+    options = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s.%(msecs)03d %(name)s:%(levelname)s: %(message)s', datefmt='%H:%M:%S',
+                        level=logging.INFO)
+
+    base_path_maker = path_maker.PathMaker(options.env_filepath)
+    index = DivisionIndex(options.division_index).open()
+    try:
+        for spec in options.specs:
+            for division in base_path_maker.find_divisions(spec):
+                load_start = time.perf_counter()
+                division_items = index.division_items(base_path_maker.for_division(*division))
+                LOGGER.info(f"{'/'.join(division)}: {len(division_items)} items loaded in "
+                            f"{time.perf_counter() - load_start:.3f}s")
+    finally:
+        index.close()
@@ -4,9 +4,11 @@ import json5
 
 
 class DivisionOrder:
-    def __init__(self, json5_file):
-        with open(json5_file, 'r', encoding='utf-8') as file:
-            self.order = json5.load(file)
+    def __init__(self, json5_file=None, order=None):
+        if order is None:
+            with open(json5_file, 'r', encoding='utf-8') as file:
+                order = json5.load(file)
+        self.order = order
 
     def filter(self, regexp):
         pattern = re.compile(regexp)
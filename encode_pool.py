@@ -0,0 +1,166 @@
+import logging
+import queue
+import re
+import threading
+
+from trackers import TrackerRecorder
+
+LOGGER = logging.getLogger('encode_pool')
+LOGGER.setLevel(level=logging.DEBUG)
+
+
+class EncodeTask:
+    def __init__(self, job, force_final, tags=None, tracker_ids=(None, None)):
+        self.job = job
+        self.force_final = force_final
+        self.tags = tags or {}
+        self.tracker_ids = tracker_ids
+        # One slot per output profile, as they are encoded concurrently from the same intermediate
+        self.encoders = [hb.encoder for _, hb in job.params.render.output_profiles()]
+        self.encoder = self.encoders[0]
+        self.exception = None
+        self.final_scan_result = None
+        self.recorder = TrackerRecorder()
+        self.thread = None
+
+    def run(self, on_done):
+        try:
+            with self.recorder:
+                self.final_scan_result = self.job.execute_encode(force_final=self.force_final)
+        except (Exception, KeyboardInterrupt) as exc:
+            self.exception = exc
+        finally:
+            on_done(self)
+
+
+class EncodePool:
+    """Runs HandBrakeCLI encodes concurrently within per-host and per-encoder slot limits.
+
+    Encodes run on worker threads and record their tracker calls.  The owner calls collect() from the
+    main thread, at points where no tracker run is open, to receive completed tasks and replay them.
+    """
+
+    def __init__(self, total_slots=1, encoder_slots=None):
+        self.total_slots = total_slots
+        self.encoder_slots = encoder_slots or {}
+        self.lock = threading.Lock()
+        self.paused = False
+        self.pending = []
+        self.running = []
+        self.completed = queue.Queue()
+
+    @classmethod
+    def from_env(cls, env):
+        if 'encode_slots_total' not in env:
+            return None
+        return cls(total_slots=env['encode_slots_total'], encoder_slots=env.get('encode_slots', {}))
+
+    def slots_for(self, encoder):
+        return self.encoder_slots.get(encoder, self.total_slots)
+
+    def submit(self, task):
+        LOGGER.info("Queued encode of %s using %s", task.job.job_name, task.encoder)
+        with self.lock:
+            self.pending.append(task)
+        self.dispatch()
+
+    def dispatch(self):
+        with self.lock:
+            if self.paused:
+                return
+            for task in list(self.pending):
+                # A task needing more slots than the limit still runs, on its own
+                slots_running = self.slots_running()
+                if slots_running and slots_running + len(task.encoders) > self.total_slots:
+                    break
+                if not all(self.encoder_available(task, encoder) for encoder in set(task.encoders)):
+                    continue
+                self.pending.remove(task)
+                self.running.append(task)
+                LOGGER.info("Starting encode of %s using %s (%d/%d slots in use)", task.job.job_name,
+                            ", ".join(task.encoders), self.slots_running(), self.total_slots)
+                task.thread = threading.Thread(target=task.run, args=(self.task_done,),
+                                               name=f"encode-{task.job.job_name}", daemon=True)
+                task.thread.start()
+
+    def slots_running(self, encoder=None):
+        return sum(1 for task in self.running for x in task.encoders if encoder is None or x == encoder)
+
+    def encoder_available(self, task, encoder):
+        encoder_running = self.slots_running(encoder)
+        if not encoder_running:
+            return self.slots_for(encoder) > 0
+        return encoder_running + task.encoders.count(encoder) <= self.slots_for(encoder)
+
+    def task_done(self, task):
+        # Queue the task before it leaves running, so that busy() never misses it
+        with self.lock:
+            self.completed.put(task)
+            self.running.remove(task)
+        self.dispatch()
+
+    def busy(self):
+        """Whether any task is queued, running, or finished but not yet collected."""
+        with self.lock:
+            return bool(self.pending or self.running) or not self.completed.empty()
+
+    def collect(self, block=False):
+        """Return tasks that have completed since the last call, optionally waiting for at least one."""
+        tasks = []
+        # Wait in steps, as pending tasks can be dropped by a drain while waiting
+        while block and not tasks and self.busy() and self.completed.empty():
+            try:
+                tasks.append(self.completed.get(timeout=1.0))
+            except queue.Empty:
+                pass
+        while not self.completed.empty():
+            tasks.append(self.completed.get())
+        return tasks
+
+    def set_paused(self, paused):
+        with self.lock:
+            self.paused = paused
+        LOGGER.info("Encode launches %s", "paused" if paused else "resumed")
+        self.dispatch()
+
+    def set_slots(self, total_slots, encoder_slots=None):
+        with self.lock:
+            self.total_slots = total_slots
+            self.encoder_slots.update(encoder_slots or {})
+        LOGGER.info("Encode slots changed to %d in total, %s by encoder", self.total_slots, self.encoder_slots)
+        self.dispatch()
+
+    def move(self, pattern, front=True):
+        with self.lock:
+            matching = [x for x in self.pending if re.search(pattern, x.job.job_name)]
+            others = [x for x in self.pending if x not in matching]
+            self.pending = matching + others if front else others + matching
+        self.dispatch()
+        return len(matching)
+
+    def status(self):
+        with self.lock:
+            return dict(paused=self.paused, total_slots=self.total_slots, encoder_slots=dict(self.encoder_slots),
+                        pending=[x.job.job_name for x in self.pending],
+                        running=[x.job.job_name for x in self.running])
+
+    def drop_pending(self):
+        """Remove encodes that have not started, leaving their ProRes files in place for a later run."""
+        with self.lock:
+            pending, self.pending = self.pending, []
+        for task in pending:
+            LOGGER.info("Dropped queued encode of %s", task.job.job_name)
+        return pending
+
+    def cancel_all(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+            running = list(self.running)
+        for task in pending:
+            LOGGER.info("Cancelled queued encode of %s", task.job.job_name)
+        for task in running:
+            LOGGER.info("Cancelling running encode of %s", task.job.job_name)
+            task.job.cancel()
+        for task in running:
+            task.thread.join()
+        return pending
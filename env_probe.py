@@ -0,0 +1,175 @@
+import json
+import logging
+import os
+
+import json5
+
+import render_params
+
+LOGGER = logging.getLogger('env_probe')
+LOGGER.setLevel(level=logging.DEBUG)
+
+
+class ProbeError(Exception):
+    pass
+
+
+def find_ae_prefs_path(ae_settings):
+    major, minor = map(int, ae_settings.condensed_version.split("."))
+    base_prefs_path = ae_settings.ae_prefs_path.replace('{user}', os.getenv('USERNAME', ''))
+    for test_minor in range(minor + 32, minor - 1, -1):
+        test_version = f"{major}.{test_minor}"
+        ae_prefs_path = base_prefs_path.replace('{version}', test_version)
+        if os.path.isfile(ae_prefs_path):
+            LOGGER.info(f"Using AE prefs file {ae_prefs_path} for version {test_version}")
+            return ae_prefs_path
+
+    raise ProbeError(
+        f"Unable to find AE preferences file using {base_prefs_path} and {ae_settings.condensed_version}")
+
+
+def read_mfr_tags(ae_prefs_path):
+    prefs = {}
+    with open(ae_prefs_path, 'r') as f:
+        current_section = None
+        for line in f:
+            if line.strip().startswith('['):
+                current_section = line.strip(' []"\n')
+            elif current_section == "Concurrent Frame Rendering":
+                if '=' in line:
+                    key, value = [x.strip().strip('"') for x in line.split('=')]
+                    prefs[key] = value
+
+    tags = {}
+    enable_cfr = prefs.get("Enable Concurrent Frame Renders")
+    num_concurrent_frames = prefs.get("Number of Concurrent Frame Renders")
+    reserved_cpu_power = prefs.get("Reserved CPU Power")
+
+    if reserved_cpu_power and int(reserved_cpu_power) > 10:
+        LOGGER.warning("Bad value for Reserved CPU Power %s", reserved_cpu_power)
+
+    if enable_cfr is None:
+        tags[f"mfr=unknown"] = True
+    elif int(enable_cfr):
+        tags[f"mfr={int(num_concurrent_frames)}"] = True
+    else:
+        tags["mfr=off"] = True
+
+    return tags
+
+
+def aerender_path(ae_settings):
+    return os.path.join(ae_settings.aerender_dir.replace('{ae.major_version}', ae_settings.major_version),
+                        'aerender.exe')
+
+
+def handbrake_path(hb_settings):
+    return os.path.join(hb_settings.hb_dir, 'HandBrakeCLI.exe')
+
+
+def file_mtime(path):
+    return os.path.getmtime(path) if path and os.path.exists(path) else None
+
+
+class EnvironmentProbe:
+    """Resolves and validates tool paths, render params and AE preferences once per run.
+
+    Results are cached in a small json file and reused while the mtimes of every input file are
+    unchanged, so a restart does not repeat the AE prefs search.
+    """
+
+    def __init__(self, env_filepath, render_params_path, cache_path):
+        self.env_filepath = env_filepath
+        self.render_params_path = render_params_path
+        self.cache_path = cache_path
+
+        self.aerender_path = None
+        self.ae_prefs_path = None
+        self.hb_path = None
+        self.mfr_tags = None
+        self.render_params = None
+
+    def sources(self):
+        return {
+            'env': self.env_filepath,
+            'render_params': self.render_params_path,
+            'aerender': self.aerender_path,
+            'ae_prefs': self.ae_prefs_path,
+            'hb': self.hb_path,
+        }
+
+    def load_cache(self):
+        if not os.path.isfile(self.cache_path):
+            return False
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as file:
+                cache = json.load(file)
+        except (OSError, ValueError) as exc:
+            LOGGER.warning("Ignoring unreadable probe cache %s: %s", self.cache_path, exc)
+            return False
+
+        for key, path in cache['sources'].items():
+            if file_mtime(path) != cache['mtimes'].get(key):
+                LOGGER.info("Probe cache is stale because %s has changed: %s", key, path)
+                return False
+        if cache['sources'].get('env') != self.env_filepath or \
+                cache['sources'].get('render_params') != self.render_params_path:
+            return False
+
+        cached_render_params = render_params.RenderParams(**cache['render_params'])
+        # A newly installed AE minor version has its own prefs file, which the mtimes above cannot see
+        try:
+            ae_prefs_path = find_ae_prefs_path(cached_render_params.ae)
+        except ProbeError:
+            return False
+        if ae_prefs_path != cache['sources']['ae_prefs']:
+            LOGGER.info("Probe cache is stale because the AE prefs file is now %s", ae_prefs_path)
+            return False
+
+        self.render_params = cached_render_params
+        self.aerender_path = cache['sources']['aerender']
+        self.ae_prefs_path = cache['sources']['ae_prefs']
+        self.hb_path = cache['sources']['hb']
+        self.mfr_tags = cache['mfr_tags']
+        return True
+
+    def save_cache(self):
+        sources = self.sources()
+        cache = dict(
+            sources=sources,
+            mtimes={key: file_mtime(path) for key, path in sources.items()},
+            render_params=self.render_params.model_dump(),
+            mfr_tags=self.mfr_tags,
+        )
+        temp_path = self.cache_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(cache, file, indent=2)
+        os.replace(temp_path, self.cache_path)
+
+    def probe(self):
+        with open(self.render_params_path, 'r', encoding='utf-8') as file:
+            self.render_params = render_params.RenderParams(**json5.load(file))
+
+        self.aerender_path = aerender_path(self.render_params.ae)
+        if not os.path.isfile(self.aerender_path):
+            raise ProbeError(f"aerender not found at {self.aerender_path}")
+
+        self.hb_path = handbrake_path(self.render_params.hb)
+        if not os.path.isfile(self.hb_path):
+            raise ProbeError(f"HandBrakeCLI not found at {self.hb_path}")
+
+        self.ae_prefs_path = find_ae_prefs_path(self.render_params.ae)
+        self.mfr_tags = read_mfr_tags(self.ae_prefs_path)
+
+    def run(self):
+        if self.load_cache():
+            LOGGER.info("Using cached environment probe from %s", self.cache_path)
+        else:
+            LOGGER.info("Probing environment for tools and preferences")
+            self.probe()
+            self.save_cache()
+
+        LOGGER.info("aerender: %s", self.aerender_path)
+        LOGGER.info("HandBrakeCLI: %s", self.hb_path)
+        LOGGER.info("AE prefs: %s, tags %s", self.ae_prefs_path, ", ".join(self.mfr_tags.keys()))
+        return self
@@ -0,0 +1,299 @@
+# python 3.12
+import argparse
+import heapq
+import itertools
+import logging
+import statistics
+
+import division_index
+import path_maker
+import perf_history
+import render_params
+import text_table
+
+LOGGER = logging.getLogger('farm_sim')
+LOGGER.setLevel(level=logging.DEBUG)
+USAGE_DESCRIPTION = '''
+Simulates rendering an event's items on a pool of hosts, using the stage durations recorded in the performance
+history, to compare makespans and resource use under different scheduling policies without rendering anything.
+Each --host is NAME[:RENDER_SLOTS[:ENCODE_SLOTS[:SCRATCH_GB]]], defaulting to 1 render slot, 1 encode slot and
+an unlimited ProRes scratch disk.
+Policies are the item order (fifo, lpt for longest first), whether encodes overlap the next render (pipelined,
+serial) and how items reach hosts (shared queue, or decimate as with sloerender.py --decimate n/m).
+Example of usage:
+python farm_sim.py "hoc2025/*" --host render1:1:2:2000 --host render2:2:3:4000
+python farm_sim.py "hoc2025/divm*" --host render1 --host render2 --order lpt --assignment decimate
+'''
+
+ORDERS = ['fifo', 'lpt']
+MODES = ['pipelined', 'serial']
+ASSIGNMENTS = ['shared', 'decimate']
+GB = 1024 * 1024 * 1024
+
+
+class SimItem:
+    def __init__(self, name, frames, prores_bytes, render_seconds, encode_seconds):
+        self.name = name
+        self.frames = frames
+        self.prores_bytes = prores_bytes
+        # Seconds on each host, by host name
+        self.render_seconds = render_seconds
+        self.encode_seconds = encode_seconds
+
+    def expected_seconds(self):
+        return statistics.mean(self.render_seconds[x] + self.encode_seconds[x] for x in self.render_seconds)
+
+
+class Resource:
+    """A pool of capacity whose use over time is integrated for utilisation."""
+
+    def __init__(self, name, capacity):
+        self.name = name
+        self.capacity = capacity
+        self.in_use = 0
+        self.peak = 0
+        self.busy_area = 0.0
+        self.last_time = 0.0
+
+    def advance(self, now):
+        self.busy_area += self.in_use * (now - self.last_time)
+        self.last_time = now
+
+    def available(self, amount=1):
+        # A request larger than the whole capacity is allowed when nothing else holds it
+        return self.capacity is None or self.in_use + amount <= self.capacity or not self.in_use
+
+    def acquire(self, now, amount=1):
+        self.advance(now)
+        self.in_use += amount
+        self.peak = max(self.peak, self.in_use)
+
+    def release(self, now, amount=1):
+        self.advance(now)
+        self.in_use -= amount
+
+    def utilisation(self, makespan):
+        if not makespan or not self.capacity:
+            return None
+        return self.busy_area / (makespan * self.capacity)
+
+
+class SimHost:
+    def __init__(self, name, render_slots=1, encode_slots=1, scratch_gb=None):
+        self.name = name
+        self.render = Resource(f"{name} render", render_slots)
+        self.encode = Resource(f"{name} encode", encode_slots)
+        self.scratch = Resource(f"{name} scratch", scratch_gb * GB if scratch_gb else None)
+        self.queue = []
+        self.encode_queue = []
+        self.items_done = 0
+
+    @classmethod
+    def from_spec(cls, spec):
+        name, *numbers = spec.split(':')
+        numbers = [float(x) for x in numbers]
+        render_slots, encode_slots, scratch_gb = numbers + [1, 1, 0][len(numbers):]
+        if int(render_slots) < 1 or int(encode_slots) < 1:
+            # Items would wait forever for the slot, holding their scratch
+            raise ValueError(f"Host {spec} needs at least one render slot and one encode slot")
+        return cls(name, int(render_slots), int(encode_slots), scratch_gb or None)
+
+
+class FarmSimulation:
+    """Discrete-event simulation of the render, scan and encode stages of items across hosts.
+
+    A render holds a render slot and the item's ProRes space on the host's scratch disk.  Pipelined, the render
+    slot is freed when the ProRes file is scanned and the encode waits for an encode slot; serial, the render
+    slot is held until the encode and final scan complete, as sloerender.py does without encode_slots_total.
+    """
+
+    def __init__(self, items, hosts, order='fifo', mode='pipelined', assignment='shared', scan_seconds=5.0):
+        self.hosts = hosts
+        self.mode = mode
+        self.scan_seconds = scan_seconds
+        self.events = []
+        self.sequence = itertools.count()
+        self.now = 0.0
+        self.shared_queue = None
+
+        items = list(items)
+        if order == 'lpt':
+            items.sort(key=lambda x: x.expected_seconds(), reverse=True)
+        if assignment == 'shared':
+            self.shared_queue = items
+        else:
+            for i, host in enumerate(hosts):
+                host.queue = items[i::len(hosts)]
+
+    def schedule(self, delay, callback, *args):
+        heapq.heappush(self.events, (self.now + delay, next(self.sequence), callback, args))
+
+    def next_item(self, host):
+        queue = self.shared_queue if self.shared_queue is not None else host.queue
+        if queue and host.scratch.available(queue[0].prores_bytes):
+            return queue.pop(0)
+        return None
+
+    def start_renders(self, host):
+        while host.render.in_use < host.render.capacity:
+            item = self.next_item(host)
+            if item is None:
+                return
+            host.render.acquire(self.now)
+            host.scratch.acquire(self.now, item.prores_bytes)
+            self.schedule(item.render_seconds[host.name] + self.scan_seconds, self.render_done, host, item)
+
+    def render_done(self, host, item):
+        if self.mode == 'pipelined':
+            host.render.release(self.now)
+        host.encode_queue.append(item)
+        self.start_encodes(host)
+        self.start_renders(host)
+
+    def start_encodes(self, host):
+        while host.encode_queue and host.encode.in_use < host.encode.capacity:
+            item = host.encode_queue.pop(0)
+            host.encode.acquire(self.now)
+            self.schedule(item.encode_seconds[host.name] + self.scan_seconds, self.encode_done, host, item)
+
+    def encode_done(self, host, item):
+        host.encode.release(self.now)
+        host.scratch.release(self.now, item.prores_bytes)
+        if self.mode == 'serial':
+            host.render.release(self.now)
+        host.items_done += 1
+        self.start_encodes(host)
+        # Freed scratch space may let any host take the next shared item
+        for other_host in self.hosts:
+            self.start_renders(other_host)
+
+    def run(self):
+        for host in self.hosts:
+            self.start_renders(host)
+        while self.events:
+            self.now, _, callback, args = heapq.heappop(self.events)
+            callback(*args)
+        for host in self.hosts:
+            for resource in (host.render, host.encode, host.scratch):
+                resource.advance(self.now)
+        return self.now
+
+
+def load_items(specs, base_path_maker, index, history, host_names, prores_bitrate, default_spf, default_encode_fps):
+    """Items of the divisions matching the specs, with expected stage seconds on each host from the history."""
+    runs = history.runs() if history else []
+    item_runs = {}
+    host_runs = {}
+    for run in runs:
+        item_runs.setdefault((perf_history.PerfHistory.item_key(run), run['host']), []).append(run)
+        host_runs.setdefault(run['host'], []).append(run)
+
+    def median_of(rows, column, default):
+        values = [row[column] for row in rows if row[column]]
+        return statistics.median(values) if values else default
+
+    all_spf = median_of(runs, 'spf_p50', default_spf)
+    all_encode_fps = median_of(runs, 'encode_fps', default_encode_fps)
+
+    items = []
+    for spec in specs:
+        for division in base_path_maker.find_divisions(spec):
+            for order_item, item_p in index.division_items(base_path_maker.for_division(*division)):
+                frames = item_p.duration * item_p.frame_rate
+                key = perf_history.PerfHistory.item_key(dict(event=item_p.event, division=item_p.division,
+                                                             variant=item_p.variant, item_name=item_p.item_name))
+                render_seconds = {}
+                encode_seconds = {}
+                for host_name in host_names:
+                    rows = item_runs.get((key, host_name), [])
+                    host_rows = host_runs.get(host_name, [])
+                    render_seconds[host_name] = median_of(
+                        rows, 'render_seconds', frames * median_of(host_rows, 'spf_p50', all_spf))
+                    encode_seconds[host_name] = median_of(
+                        rows, 'encode_seconds', frames / median_of(host_rows, 'encode_fps', all_encode_fps))
+                items.append(SimItem(f"{'/'.join(x for x in division if x)}/{item_p.item_name}", frames,
+                                     int(prores_bitrate * 1000 / 8 * item_p.duration), render_seconds,
+                                     encode_seconds))
+    return items
+
+
+def simulate(items, host_specs, order, mode, assignment, scan_seconds):
+    hosts = [SimHost.from_spec(spec) for spec in host_specs]
+    simulation = FarmSimulation(items, hosts, order=order, mode=mode, assignment=assignment,
+                                scan_seconds=scan_seconds)
+    makespan = simulation.run()
+    utilisation = {}
+    for host in hosts:
+        utilisation[host.render.name] = host.render.utilisation(makespan)
+        utilisation[host.encode.name] = host.encode.utilisation(makespan)
+        if host.scratch.capacity:
+            utilisation[f"{host.scratch.name} peak"] = host.scratch.peak / host.scratch.capacity
+    return dict(policy=f"{order}/{mode}/{assignment}", makespan=makespan, utilisation=utilisation,
+                items={host.name: host.items_done for host in hosts})
+
+
+def format_seconds(seconds):
+    hours, remainder = divmod(int(seconds), 3600)
+    return f"{hours}:{remainder // 60:02d}:{remainder % 60:02d}"
+
+
+def log_results(results):
+    resources = list(results[0]['utilisation'])
+    columns = ['policy', 'makespan'] + resources + ['items by host']
+    rows = [[result['policy'], format_seconds(result['makespan'])] +
+            [f"{result['utilisation'][x]:.0%}" if result['utilisation'][x] is not None else '-' for x in resources] +
+            [" ".join(f"{name}={count}" for name, count in result['items'].items())]
+            for result in sorted(results, key=lambda x: x['makespan'])]
+    LOGGER.info("Simulated makespans, fastest first, with utilisation of each resource:\n\n%s\n",
+                text_table.format_table(columns, rows))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=USAGE_DESCRIPTION, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('specs', nargs='+', metavar='SPEC',
+                        help='event/division[/variant] specs as for sloerender.py --batch, e.g. "hoc2025/*"')
+    parser.add_argument('--assignment', nargs='+', choices=ASSIGNMENTS, default=ASSIGNMENTS)
+    parser.add_argument('--default-encode-fps', default=100.0, type=float,
+                        help='Encode frames per second assumed when the history has none')
+    parser.add_argument('--default-spf', default=2.0, type=float,
+                        help='aerender seconds per frame assumed when the history has none')
+    parser.add_argument('--division-index', default='sloerender_division_index.sqlite')
+    parser.add_argument('--env-filepath', default='sloerender_env.json5')
+    parser.add_argument('--host', action='append', dest='hosts', metavar='HOST',
+                        help='NAME[:RENDER_SLOTS[:ENCODE_SLOTS[:SCRATCH_GB]]], defaulting to the hosts in the history')
+    parser.add_argument('--mode', nargs='+', choices=MODES, default=MODES)
+    parser.add_argument('--order', nargs='+', choices=ORDERS, default=ORDERS)
+    parser.add_argument('--perf-history', default='sloerender_perf_history.sqlite')
+    parser.add_argument('--render-params-base', default='render_params_base.json5',
+                        help='For the ProRes bitrate, to size the scratch disk use')
+    parser.add_argument('--scan-seconds', default=5.0, type=float,
+                        help='Seconds for each HandBrakeCLI scan of a ProRes or final file')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    options = parse_args()
+    logging.basicConfig(format='%(asctime)s.%(msecs)03d %(name)s:%(levelname)s: %(message)s', datefmt='%H:%M:%S',
+                        level=logging.INFO)
+    base_path_maker = path_maker.PathMaker(options.env_filepath)
+    history = perf_history.PerfHistory(options.perf_history).open() if options.perf_history else None
+    index = division_index.DivisionIndex(options.division_index).open()
+    try:
+        host_specs = options.hosts or sorted({run['host'] for run in history.runs()} if history else [])
+        if not host_specs:
+            raise SystemExit("No --host given and no hosts in the performance history")
+        try:
+            for spec in host_specs:
+                SimHost.from_spec(spec)
+        except ValueError as exc:
+            raise SystemExit(str(exc))
+        items = load_items(options.specs, base_path_maker, index, history, [x.split(':')[0] for x in host_specs],
+                           render_params.RenderParams.from_json5(options.render_params_base).ae.prores_bitrate,
+                           options.default_spf, options.default_encode_fps)
+    finally:
+        index.close()
+        if history:
+            history.close()
+    LOGGER.info("Simulating %d items on %s", len(items), ", ".join(host_specs))
+    log_results([simulate(items, host_specs, order, mode, assignment, options.scan_seconds)
+                 for order, mode, assignment in itertools.product(options.order, options.mode, options.assignment)])
@@ -6,19 +6,23 @@ import re
 import time
 from datetime import datetime
 
+import hb_encode
 import process_wrapper
+from log_sink import SubprocessLog
 
 LOGGER = logging.getLogger('file_scanner')
 LOGGER.setLevel(level=logging.DEBUG)
 
 
 class FileScanner:
-    def __init__(self, file_path, job_name, params):
+    def __init__(self, file_path, job_name, params, hb_command=None):
         self.file_path = file_path
         self.job_name = job_name
         self.params = params
+        self.hb_command = hb_command or hb_encode.handbrake_command(params.render.hb)
 
         self.file_data = {}
+        self.log = None
         self.json_capture_on = None
         self.json_data = None
         self.json_discard_on = None
@@ -40,10 +44,7 @@ class FileScanner:
             path=os.path.abspath(self.file_path),
             size=os.path.getsize(self.file_path)
         )
-        hb_path = os.path.join(self.params.render.hb.hb_dir, 'HandBrakeCLI.exe')
-
-        hb_scan_command = [
-            hb_path,
+        hb_scan_command = self.hb_command + [
             '--input', self.file_path,
             '--json',
             '--scan',
@@ -53,18 +54,22 @@ class FileScanner:
         handbrakecli = process_wrapper.ProcessWrapper(hb_scan_command)
         self.json_capture_on = False
         self.json_discard_on = False
+        self.log = SubprocessLog.sink(self.job_name, LOGGER)
         handbrakecli.run()
         self.start_time = time.monotonic()
         try:
-            while handbrakecli.is_alive():
-                self.service_job(handbrakecli)
-                time.sleep(0.5)
+            try:
+                while handbrakecli.is_alive():
+                    self.service_job(handbrakecli)
+                    time.sleep(0.5)
 
-        except (Exception, KeyboardInterrupt) as exp:
-            handbrakecli.kill()
-            raise
+            except (Exception, KeyboardInterrupt) as exp:
+                handbrakecli.kill()
+                raise
 
-        self.service_job(handbrakecli)
+            self.service_job(handbrakecli)
+        finally:
+            self.log.close()
 
         rc = handbrakecli.get_return_code()
         if rc == 0:
@@ -123,6 +128,6 @@ class FileScanner:
                             if match:
                                 self.json_discard_on = True
                     if not self.json_discard_on:
-                        LOGGER.debug(line)
+                        self.log.write(stream_label, line, level=logging.DEBUG)
             else:
-                LOGGER.info("%s", line.rstrip())
+                self.log.write(stream_label, line.rstrip())
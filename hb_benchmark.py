@@ -0,0 +1,158 @@
+# python 3.12
+import argparse
+import csv
+import itertools
+import logging
+import os
+import socket
+import time
+
+import json5
+
+import file_scanner
+import hb_encode
+import render_params
+import text_table
+import tool_stub
+
+LOGGER = logging.getLogger('hb_benchmark')
+LOGGER.setLevel(level=logging.DEBUG)
+USAGE_DESCRIPTION = '''
+This script encodes a reference clip under a matrix of HandBrake settings and records the performance of each.
+Example of usage:
+python hb_benchmark.py --input "reference prores.mov" --matrix hb_matrix.json5 --results hb_benchmark.csv
+'''
+
+# Settings varied when no --matrix file is given.  Keys are HandbrakeSettings fields
+DEFAULT_MATRIX = {
+    'encoder': ['nvenc_h265', 'nvenc_h264'],
+    'encoder_preset': ['quality', 'speed'],
+    'bitrate': [40000, 60000],
+    'hw_decoding': ['nvdec', ''],
+}
+
+RESULT_FIELDS = ['host', 'encoder', 'encoder_preset', 'bitrate', 'hw_decoding', 'turbo', 'optimize', 'repeat',
+                 'rc', 'valid', 'wall_seconds', 'fps_avg', 'cpu_seconds', 'cpu_percent', 'output_bytes']
+
+
+class HandbrakeBenchmark:
+    def __init__(self, options):
+        self.options = options
+        self.hb_command = tool_stub.stub_command('handbrake') if options.stub else None
+        self.results = []
+
+    def load_matrix(self):
+        if self.options.matrix:
+            with open(self.options.matrix, 'r', encoding='utf-8') as file:
+                return json5.load(file)
+        return DEFAULT_MATRIX
+
+    def combinations(self, base_settings):
+        matrix = self.load_matrix()
+        keys = sorted(matrix.keys())
+        for values in itertools.product(*(matrix[key] for key in keys)):
+            yield base_settings.model_copy(update=dict(zip(keys, values)))
+
+    def run_one(self, hb_settings, repeat):
+        label = f"{hb_settings.encoder}-{hb_settings.encoder_preset}-{hb_settings.bitrate}-" \
+                f"{hb_settings.hw_decoding or 'swdec'}-{repeat}"
+        output_path = os.path.join(self.options.output_dir, f"{label}.mp4")
+        if os.path.exists(output_path):
+            os.remove(output_path)
+
+        encode = hb_encode.HandbrakeEncode(hb_settings, self.options.input, output_path, f"Benchmark {label}",
+                                           hb_command=self.hb_command)
+        cpu_seconds = [0.0]
+
+        def _sample_cpu(running_encode):
+            # Keep the high-water mark since the tree's processes vanish as the encode finishes
+            cpu_seconds[0] = max(cpu_seconds[0], running_encode.cpu_seconds())
+
+        start_time = time.monotonic()
+        rc = encode.run(poll_callback=_sample_cpu)
+        wall_seconds = time.monotonic() - start_time
+
+        valid = False
+        if rc == 0 and self.options.validate:
+            # No RenderJobParams here, so resolve HandBrakeCLI from the settings rather than leave it to FileScanner
+            scan = file_scanner.FileScanner(output_path, f"Benchmark scan {label}", None,
+                                            hb_command=self.hb_command or hb_encode.handbrake_command(hb_settings))
+            valid = scan.scan_video()['valid']
+
+        result = dict(
+            host=socket.gethostname(),
+            encoder=hb_settings.encoder,
+            encoder_preset=hb_settings.encoder_preset,
+            bitrate=hb_settings.bitrate,
+            hw_decoding=hb_settings.hw_decoding,
+            turbo=hb_settings.turbo,
+            optimize=hb_settings.optimize,
+            repeat=repeat,
+            rc=rc,
+            valid=valid if self.options.validate else '',
+            wall_seconds=round(wall_seconds, 2),
+            fps_avg=round(encode.last_progress.get('RateAvg', 0.0), 2),
+            cpu_seconds=round(cpu_seconds[0], 2),
+            cpu_percent=round(100 * cpu_seconds[0] / wall_seconds, 1) if wall_seconds else 0.0,
+            output_bytes=os.path.getsize(output_path) if os.path.isfile(output_path) else 0,
+        )
+        if not self.options.keep_outputs and os.path.isfile(output_path):
+            os.remove(output_path)
+        return result
+
+    def run(self):
+        base_settings = render_params.RenderParams.from_json5(self.options.render_params_base).hb
+        os.makedirs(self.options.output_dir, exist_ok=True)
+        for hb_settings in self.combinations(base_settings):
+            for repeat in range(self.options.repeat):
+                result = self.run_one(hb_settings, repeat)
+                LOGGER.info("Result: %s", result)
+                self.results.append(result)
+                self.write_result(result)
+        self.log_table()
+
+    def write_result(self, result):
+        write_header = not os.path.isfile(self.options.results)
+        with open(self.options.results, 'a', newline='', encoding='utf-8') as file:
+            writer = csv.DictWriter(file, fieldnames=RESULT_FIELDS)
+            if write_header:
+                writer.writeheader()
+            writer.writerow(result)
+
+    def log_table(self):
+        columns = ['encoder', 'encoder_preset', 'bitrate', 'hw_decoding', 'rc', 'valid', 'wall_seconds', 'fps_avg',
+                   'cpu_percent', 'output_bytes']
+        rows = [[str(result[column]) for column in columns]
+                for result in sorted(self.results, key=lambda x: (x['rc'] != 0, x['wall_seconds']))]
+        LOGGER.info("Benchmark results for %s, fastest first:\n\n%s\n", socket.gethostname(),
+                    text_table.format_table(columns, rows))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=USAGE_DESCRIPTION)
+    parser.add_argument('--input', required=True,
+                        help='Reference clip to encode, normally a ProRes intermediate')
+    parser.add_argument('--keep-outputs', action='store_true',
+                        help='Keep the encoded files rather than deleting them after measurement')
+    parser.add_argument('--matrix', default=None,
+                        help='json5 file mapping HandbrakeSettings fields to lists of values to try')
+    parser.add_argument('--output-dir', default='hb_benchmark_output',
+                        help='Directory for the encoded files')
+    parser.add_argument('--render-params-base', default='render_params_base.json5',
+                        help='Parameter file (json5) providing the settings not varied by the matrix')
+    parser.add_argument('--repeat', default=1, type=int,
+                        help='Number of times to encode each combination')
+    parser.add_argument('--results', default='hb_benchmark.csv',
+                        help='CSV file to append results to')
+    parser.add_argument('--stub', action='store_true',
+                        help='Use tool_stub.py in place of HandBrakeCLI, for testing without GPUs')
+    parser.add_argument('--validate', action='store_true',
+                        help='Scan each output with HandBrakeCLI to check that it is valid')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s.%(msecs)03d %(name)s:%(levelname)s: %(message)s',
+                        datefmt='%H:%M:%S',
+                        level=logging.INFO)
+    HandbrakeBenchmark(parse_args()).run()
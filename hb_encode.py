@@ -0,0 +1,149 @@
+import json
+import logging
+import re
+import time
+
+import psutil
+
+import env_probe
+import process_wrapper
+from log_sink import SubprocessLog
+
+LOGGER = logging.getLogger('hb_encode')
+LOGGER.setLevel(level=logging.DEBUG)
+
+
+def handbrake_command(hb_settings):
+    return [env_probe.handbrake_path(hb_settings)]
+
+
+class HandbrakeEncode:
+    def __init__(self, hb_settings, input_path, output_path, job_name, progress_callback=None, hb_command=None,
+                 placement=None):
+        self.hb_settings = hb_settings
+        self.input_path = input_path
+        self.output_path = output_path
+        self.job_name = job_name
+        self.progress_callback = progress_callback
+        self.hb_command = hb_command or handbrake_command(hb_settings)
+        self.placement = placement
+
+        self.handbrakecli = None
+        self.log = None
+        self.json_capture_on = False
+        self.json_data = None
+        self.last_progress = {}
+        self.start_time = None
+
+    def command(self):
+        command = self.hb_command + [
+            '--ab', str(self.hb_settings.audio_bitrate),
+        ]
+        if self.hb_settings.hw_decoding:
+            command += ['--enable-hw-decoding', self.hb_settings.hw_decoding]
+        command += [
+            '--encoder', str(self.hb_settings.encoder),
+            '--encoder-preset', str(self.hb_settings.encoder_preset),
+            '--input', self.input_path,
+            '--json',
+        ]
+        if self.hb_settings.optimize:
+            command.append('--optimize')
+        command += ['--output', self.output_path]
+        if self.hb_settings.turbo:
+            command.append('--turbo')
+        command += ['--vb', str(self.hb_settings.bitrate)]
+        return command
+
+    def start(self):
+        self.log = SubprocessLog.sink(f"{self.job_name} HandBrakeCLI", LOGGER)
+        self.handbrakecli = process_wrapper.ProcessWrapper(self.command())
+        self.json_capture_on = False
+        self.handbrakecli.run()
+        self.start_time = time.monotonic()
+
+    def is_alive(self):
+        return self.handbrakecli.is_alive()
+
+    def kill(self):
+        self.handbrakecli.kill()
+
+    def cpu_seconds(self):
+        """User plus system CPU seconds of the HandBrakeCLI process tree so far."""
+        total = 0.0
+        if self.handbrakecli and self.handbrakecli.process:
+            try:
+                parent = psutil.Process(self.handbrakecli.process.pid)
+                for process in [parent] + parent.children(recursive=True):
+                    cpu_times = process.cpu_times()
+                    total += cpu_times.user + cpu_times.system
+            except (psutil.NoSuchProcess, ProcessLookupError):
+                pass
+        return total
+
+    def run(self, poll_callback=None):
+        return run_together([self], poll_callback=poll_callback)[0]
+
+    def get_return_code(self):
+        rc = self.handbrakecli.get_return_code()
+        if rc == 0:
+            LOGGER.info(f"Successful: {self.job_name}")
+        else:
+            LOGGER.error(f"+++RETURN CODE %s: %s", rc, self.job_name)
+        return rc
+
+    def service(self):
+        if self.placement and self.handbrakecli.process:
+            self.placement.apply([self.handbrakecli.process.pid])
+        while not self.handbrakecli.output_queue.empty():
+            stream_label, seconds, line = self.handbrakecli.output_queue.get()
+            if stream_label == 'EXC':
+                raise line
+            if stream_label == 'OUT':
+                if self.json_capture_on:
+                    self.json_data.append(line.rstrip())
+                    if line.startswith('}'):  # Use the absense of indent to determine the end
+                        self.json_capture_on = False
+                        progress = json.loads("\n".join(self.json_data))
+                        if progress['State'] == 'WORKING':
+                            self.last_progress = progress['Working']
+                            if self.progress_callback:
+                                self.progress_callback(progress)
+                else:
+                    match = re.search(r'Progress: \{', line)
+                    if match:
+                        self.json_capture_on = True
+                        self.json_data = ['{']
+                    else:
+                        self.log.write(stream_label, line)
+            else:
+                self.log.write(stream_label, line.rstrip())
+
+
+def run_together(encodes, poll_callback=None):
+    """Run several encodes at once, e.g. of the same input so that they share its reads through the page cache.
+
+    Returns their return codes, and kills them all if any raises.
+    """
+    for encode in encodes:
+        encode.start()
+    try:
+        try:
+            while any(encode.is_alive() for encode in encodes):
+                for encode in encodes:
+                    encode.service()
+                    if poll_callback:
+                        poll_callback(encode)
+                time.sleep(0.5)
+
+        except (Exception, KeyboardInterrupt) as exp:
+            for encode in encodes:
+                encode.kill()
+            raise
+
+        for encode in encodes:
+            encode.service()
+    finally:
+        for encode in encodes:
+            encode.log.close()
+    return [encode.get_return_code() for encode in encodes]
@@ -0,0 +1,100 @@
+import logging
+import statistics
+
+import psutil
+
+from perf_history import TUNED_COLUMNS, comp_class
+
+LOGGER = logging.getLogger('host_tuning')
+LOGGER.setLevel(level=logging.DEBUG)
+
+# Runs of each candidate setting needed on a host and comp class before the history decides between them
+MIN_RUNS = 3
+# Memory left to Windows and this process, plus that of each concurrent HandBrakeCLI encode
+RESERVED_MEMORY_GB = 8.0
+ENCODE_MEMORY_GB = 2.0
+
+
+def clamp(value, low, high):
+    return max(low, min(high, value))
+
+
+class HostTuning:
+    """Chooses the aerender -mem_usage and -mfr values for this host and each comp class.
+
+    With ae_auto_tune in the environment, the starting point is derived from the host's cores and memory.
+    The render_params values are the other candidate, and once each has MIN_RUNS renders of a comp class in
+    the performance history, the one with the lower relative seconds per frame is used.  Values in
+    ae_overrides, typically in a host's own env file, always take precedence.
+    """
+
+    def __init__(self, base_ae, perf_history=None, overrides=None, encode_slots=0, auto_tune=False):
+        self.base_ae = base_ae
+        self.perf_history = perf_history
+        self.overrides = overrides or {}
+        unknown = set(self.overrides) - set(TUNED_COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown ae_overrides {', '.join(sorted(unknown))}, expected some of {TUNED_COLUMNS}")
+        self.encode_slots = encode_slots
+        self.auto_tune = auto_tune
+        self.cpu_count = psutil.cpu_count(logical=True) or 1
+        self.memory_gb = psutil.virtual_memory().total / (1024 * 1024 * 1024)
+        self.last_choices = {}
+
+    @classmethod
+    def from_env(cls, env, base_ae, perf_history=None):
+        return cls(base_ae, perf_history=perf_history, overrides=env.get('ae_overrides'),
+                   encode_slots=env.get('encode_slots_total', 0), auto_tune=env.get('ae_auto_tune', False))
+
+    def base_settings(self):
+        return {column: getattr(self.base_ae, column) for column in TUNED_COLUMNS}
+
+    def host_settings(self):
+        reserved_gb = RESERVED_MEMORY_GB + ENCODE_MEMORY_GB * self.encode_slots
+        max_mem_percent = clamp(int(100 * (self.memory_gb - reserved_gb) / self.memory_gb), 50, 95)
+        # Leave a core to decode the ProRes file for each concurrent encode, and one for everything else
+        reserved_cores = 1 + self.encode_slots
+        mfr_max_cpu_percent = clamp(5 * int(20 * (self.cpu_count - reserved_cores) / self.cpu_count), 50, 100)
+        return dict(image_cache_percent=self.base_ae.image_cache_percent, max_mem_percent=max_mem_percent,
+                    mfr_max_cpu_percent=mfr_max_cpu_percent)
+
+    def choose(self, item_comp_class):
+        """Settings for a comp class, and how they were chosen."""
+        if not self.auto_tune:
+            return self.base_settings(), 'base'
+
+        candidates = [self.host_settings()]
+        if self.base_settings() != candidates[0]:
+            candidates.append(self.base_settings())
+        if not self.perf_history or len(candidates) == 1:
+            return candidates[0], 'host'
+
+        scores = self.perf_history.setting_scores(item_comp_class)
+        candidate_scores = [scores.get(tuple(x[column] for column in TUNED_COLUMNS), []) for x in candidates]
+        run_counts = [len(x) for x in candidate_scores]
+        if min(run_counts) < MIN_RUNS:
+            # Try the candidate with the fewest runs, starting with the host derived one
+            return candidates[run_counts.index(min(run_counts))], 'trial'
+        medians = [statistics.median(x) for x in candidate_scores]
+        return candidates[medians.index(min(medians))], 'history'
+
+    def tune(self, render_p, item):
+        """Render params with the aerender settings for this host and item, and tracker tags recording them."""
+        item_comp_class = comp_class(item)
+        settings, source = self.choose(item_comp_class)
+        if self.overrides:
+            settings = dict(settings, **self.overrides)
+            source += '+override'
+
+        if self.last_choices.get(item_comp_class) != (settings, source):
+            LOGGER.info("aerender settings for %s on this host (%d cores, %.0fGB): %s, chosen by %s",
+                        item_comp_class, self.cpu_count, self.memory_gb,
+                        ", ".join(f"{k}={v}" for k, v in settings.items()), source)
+            self.last_choices[item_comp_class] = (settings, source)
+
+        tags = {
+            f"ae_mem={settings['image_cache_percent']}/{settings['max_mem_percent']}": True,
+            f"ae_mfr_cpu={settings['mfr_max_cpu_percent']}": True,
+            f"ae_tuning={source}": True,
+        }
+        return render_p.model_copy(update=dict(ae=render_p.ae.model_copy(update=settings))), tags
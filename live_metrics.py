@@ -0,0 +1,264 @@
+import collections
+import http.server
+import json
+import logging
+import socket
+import threading
+import time
+
+import psutil
+
+LOGGER = logging.getLogger('live_metrics')
+LOGGER.setLevel(level=logging.DEBUG)
+
+FRAME_INTERVAL_WINDOW = 1000
+QUANTILES = [0.5, 0.9, 0.99]
+
+
+def label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def quantile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] == '/metrics':
+            body = LiveMetrics.prometheus_text().encode('utf-8')
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        elif self.path.split('?')[0] in ('/', '/status'):
+            body = json.dumps(LiveMetrics.status(), indent=2).encode('utf-8')
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        LOGGER.debug("%s %s", self.address_string(), format % args)
+
+
+class LiveMetrics:
+    """Live state of the render, served over local HTTP as Prometheus text (/metrics) and json (/status).
+
+    Render code reports into class-level state that is cheap to update and does nothing until serve()
+    is called.  Stages come from Profiler spans, so every stage timed for --profile is also visible here.
+    """
+    ENABLED = False
+    lock = threading.Lock()
+    process_lock = threading.Lock()
+    start_time = time.time()
+    server = None
+    encode_pool = None
+
+    items_total = 0
+    items_started = 0
+    items_rendered = 0
+    items_skipped = 0
+    items_failed = 0
+    stages = {}
+    stage_seconds = collections.defaultdict(float)
+    stage_count = collections.defaultdict(int)
+    renders = {}
+    frame_intervals = collections.deque(maxlen=FRAME_INTERVAL_WINDOW)
+    frames_rendered = 0
+    encodes = {}
+    processes = {}
+
+    @classmethod
+    def serve(cls, port, host='127.0.0.1'):
+        cls.server = http.server.ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        cls.server.daemon_threads = True
+        threading.Thread(target=cls.server.serve_forever, name='live_metrics', daemon=True).start()
+        cls.ENABLED = True
+        LOGGER.info(f"Serving live metrics on http://{host}:{port}/metrics and /status")
+
+    @classmethod
+    def close(cls):
+        if cls.server:
+            cls.server.shutdown()
+            cls.server.server_close()
+            cls.server = None
+        cls.ENABLED = False
+
+    @classmethod
+    def span_started(cls, name, item):
+        if not cls.ENABLED:
+            return
+        with cls.lock:
+            cls.stages.setdefault(item or 'run', []).append((name, time.time()))
+
+    @classmethod
+    def span_finished(cls, name, item, seconds):
+        if not cls.ENABLED:
+            return
+        with cls.lock:
+            cls.stage_seconds[name] += seconds
+            cls.stage_count[name] += 1
+            item_stages = cls.stages.get(item or 'run', [])
+            if item_stages:
+                item_stages.pop()
+            if not item_stages:
+                cls.stages.pop(item or 'run', None)
+
+    @classmethod
+    def set_items(cls, total, started):
+        if not cls.ENABLED:
+            return
+        with cls.lock:
+            cls.items_total = total
+            cls.items_started = started
+
+    @classmethod
+    def item_finished(cls, outcome):
+        """outcome is one of 'rendered', 'skipped' or 'failed'."""
+        if not cls.ENABLED:
+            return
+        with cls.lock:
+            setattr(cls, f"items_{outcome}", getattr(cls, f"items_{outcome}") + 1)
+
+    @classmethod
+    def frame_rendered(cls, item, frame_num, frames_total, frame_interval=None):
+        if not cls.ENABLED:
+            return
+        with cls.lock:
+            cls.renders[item] = dict(frames_done=frame_num, frames_total=frames_total, updated=time.time())
+            cls.frames_rendered += 1
+            if frame_interval is not None:
+                cls.frame_intervals.append(frame_interval)
+
+    @classmethod
+    def render_finished(cls, item):
+        if not cls.ENABLED:
+            return
+        with cls.lock:
+            cls.renders.pop(item, None)
+
+    @classmethod
+    def encode_progress(cls, item, progress, fps, fps_avg):
+        if not cls.ENABLED:
+            return
+        with cls.lock:
+            cls.encodes[item] = dict(progress=progress, fps=fps, fps_avg=fps_avg, updated=time.time())
+
+    @classmethod
+    def encode_finished(cls, item):
+        if not cls.ENABLED:
+            return
+        with cls.lock:
+            cls.encodes.pop(item, None)
+
+    @classmethod
+    def process_tree(cls):
+        """Resource use of this process and all its children, e.g. aerender, AfterFX and HandBrakeCLI."""
+        with cls.process_lock:
+            return cls.measure_process_tree()
+
+    @classmethod
+    def measure_process_tree(cls):
+        root = psutil.Process()
+        current = {}
+        totals = dict(processes=0, cpu_percent=0.0, cpu_seconds=0.0, rss_bytes=0)
+        for process in [root] + root.children(recursive=True):
+            # Keep the Process objects between scrapes so that cpu_percent measures the interval between them
+            process = cls.processes.get(process.pid, process)
+            try:
+                with process.oneshot():
+                    cpu_times = process.cpu_times()
+                    totals['cpu_percent'] += process.cpu_percent()
+                    totals['cpu_seconds'] += cpu_times.user + cpu_times.system
+                    totals['rss_bytes'] += process.memory_info().rss
+                totals['processes'] += 1
+                current[process.pid] = process
+            except (psutil.NoSuchProcess, psutil.AccessDenied, ProcessLookupError):
+                pass
+        cls.processes = current
+        return totals
+
+    @classmethod
+    def encode_queue(cls):
+        if not cls.encode_pool:
+            return dict(pending=0, running=0)
+        with cls.encode_pool.lock:
+            return dict(pending=len(cls.encode_pool.pending), running=len(cls.encode_pool.running))
+
+    @classmethod
+    def status(cls):
+        with cls.lock:
+            intervals = sorted(cls.frame_intervals)
+            status = dict(
+                host=socket.gethostname(),
+                uptime_seconds=round(time.time() - cls.start_time, 1),
+                items=dict(total=cls.items_total, started=cls.items_started,
+                           remaining=max(0, cls.items_total - cls.items_started), rendered=cls.items_rendered,
+                           skipped=cls.items_skipped, failed=cls.items_failed),
+                stages={item: [name for name, _ in item_stages] for item, item_stages in cls.stages.items()},
+                renders={item: dict(render) for item, render in cls.renders.items()},
+                frames_rendered=cls.frames_rendered,
+                seconds_per_frame={str(q): round(quantile(intervals, q), 4) for q in QUANTILES} if intervals else {},
+                encodes={item: dict(encode) for item, encode in cls.encodes.items()},
+                stage_seconds={name: round(seconds, 3) for name, seconds in cls.stage_seconds.items()},
+                stage_count=dict(cls.stage_count),
+            )
+        status['process_tree'] = cls.process_tree()
+        status['encode_queue'] = cls.encode_queue()
+        return status
+
+    @classmethod
+    def prometheus_text(cls):
+        status = cls.status()
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append(f"# HELP sloerender_{name} {help_text}")
+            lines.append(f"# TYPE sloerender_{name} {metric_type}")
+            for labels, value in samples:
+                label_text = ",".join(f'{k}="{label_value(v)}"' for k, v in labels.items())
+                lines.append(f"sloerender_{name}{{{label_text}}} {value}" if label_text else
+                             f"sloerender_{name} {value}")
+
+        items = status['items']
+        metric('items', 'gauge', 'Items in this run by state',
+               [(dict(state=state), items[state]) for state in ('total', 'started', 'remaining')])
+        metric('items_finished_total', 'counter', 'Items finished by outcome',
+               [(dict(outcome=outcome), items[outcome]) for outcome in ('rendered', 'skipped', 'failed')])
+        metric('stage', 'gauge', 'Stage each active item is in',
+               [(dict(item=item, stage=stages[-1]), 1) for item, stages in status['stages'].items()])
+        metric('render_frames_done', 'gauge', 'Frames rendered by aerender for the current item',
+               [(dict(item=item), render['frames_done']) for item, render in status['renders'].items()])
+        metric('render_frames_total', 'gauge', 'Frames expected from aerender for the current item',
+               [(dict(item=item), render['frames_total']) for item, render in status['renders'].items()])
+        metric('frames_rendered_total', 'counter', 'Frames rendered by aerender in this run',
+               [({}, status['frames_rendered'])])
+        metric('aerender_seconds_per_frame', 'summary',
+               f'Seconds per frame over the last {FRAME_INTERVAL_WINDOW} frames',
+               [(dict(quantile=q), value) for q, value in status['seconds_per_frame'].items()])
+        metric('encode_progress', 'gauge', 'Fraction of the encode complete',
+               [(dict(item=item), encode['progress']) for item, encode in status['encodes'].items()])
+        metric('encode_fps', 'gauge', 'Current HandBrakeCLI encoding frames per second',
+               [(dict(item=item), encode['fps']) for item, encode in status['encodes'].items()])
+        metric('encode_fps_avg', 'gauge', 'Average HandBrakeCLI encoding frames per second',
+               [(dict(item=item), encode['fps_avg']) for item, encode in status['encodes'].items()])
+        metric('encode_queue', 'gauge', 'Encodes waiting for or holding an encoder slot',
+               [(dict(state=state), count) for state, count in status['encode_queue'].items()])
+        metric('stage_seconds_total', 'counter', 'Seconds spent in each stage',
+               [(dict(stage=name), seconds) for name, seconds in status['stage_seconds'].items()])
+        metric('stage_count_total', 'counter', 'Completed stage runs',
+               [(dict(stage=name), count) for name, count in status['stage_count'].items()])
+        process_tree = status['process_tree']
+        metric('process_tree_processes', 'gauge', 'Processes in the renderer process tree',
+               [({}, process_tree['processes'])])
+        metric('process_tree_cpu_percent', 'gauge', 'CPU percent of the process tree since the last scrape',
+               [({}, process_tree['cpu_percent'])])
+        metric('process_tree_cpu_seconds', 'gauge', 'User plus system CPU seconds of the live processes',
+               [({}, process_tree['cpu_seconds'])])
+        metric('process_tree_rss_bytes', 'gauge', 'Resident memory of the process tree',
+               [({}, process_tree['rss_bytes'])])
+        metric('uptime_seconds', 'gauge', 'Seconds since the renderer started', [({}, status['uptime_seconds'])])
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,165 @@
+import datetime
+import gzip
+import logging
+import os
+import queue
+import re
+import threading
+import time
+
+LOGGER = logging.getLogger('log_sink')
+LOGGER.setLevel(level=logging.DEBUG)
+
+
+class PassthroughSink:
+    """Default sink, logging each subprocess line directly as the code always has."""
+
+    def __init__(self, logger):
+        self.logger = logger
+
+    def write(self, stream_label, text, level=logging.INFO):
+        self.logger.log(level, "%s", text)
+
+    def close(self):
+        pass
+
+
+class FileSink:
+    """Queues subprocess lines for the background writer and logs a rate-limited summary to the console."""
+
+    def __init__(self, writer, name, logger, summary_seconds):
+        self.writer = writer
+        self.name = name
+        self.logger = logger
+        self.summary_seconds = summary_seconds
+        self.path = os.path.join(writer.log_dir, re.sub(r'[^\w.-]+', '_', name) + '.log.gz')
+
+        self.lines = 0
+        self.lines_at_summary = 0
+        self.last_summary_time = time.monotonic()
+        self.last_text = None
+
+    def write(self, stream_label, text, level=logging.INFO):
+        self.lines += 1
+        self.last_text = text
+        self.writer.put(self, stream_label, text)
+
+        now = time.monotonic()
+        if now - self.last_summary_time >= self.summary_seconds:
+            self.summarise(now)
+
+    def summarise(self, now):
+        if self.lines > self.lines_at_summary:
+            self.logger.info("%s: %d lines in %ds (%d total), latest: %s", self.name,
+                             self.lines - self.lines_at_summary, now - self.last_summary_time, self.lines,
+                             self.last_text)
+        self.lines_at_summary = self.lines
+        self.last_summary_time = now
+
+    def close(self):
+        self.summarise(time.monotonic())
+        # Blocking put so the file is always closed, even if lines were being dropped
+        self.writer.line_queue.put((self, None, None, None))
+        if self.lines:
+            self.logger.debug("%s: full output in %s", self.name, self.path)
+
+
+class SubprocessLog:
+    """Routes high-volume aerender and HandBrakeCLI output away from the console.
+
+    When configured, each job's raw output goes through a bounded queue to a background writer that
+    keeps a gzip-compressed, size-rotated file per job.  The polling thread never blocks on file or
+    console I/O; if the queue fills up, lines are dropped and counted rather than stalling the watchdog.
+    """
+    ENABLED = False
+    lock = threading.Lock()
+    log_dir = None
+    max_bytes = None
+    backup_count = None
+    summary_seconds = None
+    dropped = 0
+    line_queue = None
+    thread = None
+
+    @classmethod
+    def configure(cls, log_dir, max_bytes=50 * 1024 * 1024, backup_count=3, summary_seconds=30.0,
+                  queue_size=100000):
+        os.makedirs(log_dir, exist_ok=True)
+        cls.log_dir = log_dir
+        cls.max_bytes = max_bytes
+        cls.backup_count = backup_count
+        cls.summary_seconds = summary_seconds
+        cls.line_queue = queue.Queue(maxsize=queue_size)
+        cls.thread = threading.Thread(target=cls.run_writer, name='subprocess_log_writer', daemon=True)
+        cls.thread.start()
+        cls.ENABLED = True
+        LOGGER.info("Subprocess output will be written to %s", log_dir)
+
+    @classmethod
+    def sink(cls, name, logger):
+        if not cls.ENABLED:
+            return PassthroughSink(logger)
+        return FileSink(cls, name, logger, cls.summary_seconds)
+
+    @classmethod
+    def put(cls, sink, stream_label, text):
+        try:
+            cls.line_queue.put_nowait((sink, stream_label, time.time(), text))
+        except queue.Full:
+            with cls.lock:
+                cls.dropped += 1
+
+    @classmethod
+    def rotate(cls, path):
+        base = path[:-len('.log.gz')]
+        for i in range(cls.backup_count - 1, 0, -1):
+            if os.path.exists(f"{base}.{i}.log.gz"):
+                os.replace(f"{base}.{i}.log.gz", f"{base}.{i + 1}.log.gz")
+        if cls.backup_count > 0:
+            os.replace(path, f"{base}.1.log.gz")
+        else:
+            os.remove(path)
+
+    @classmethod
+    def run_writer(cls):
+        files = {}
+        while True:
+            sink, stream_label, timestamp, text = cls.line_queue.get()
+            if sink is None:
+                break
+            if stream_label is None:
+                log_file, _ = files.pop(sink, (None, None))
+                if log_file:
+                    log_file.close()
+                continue
+
+            log_file, written = files.get(sink, (None, 0))
+            if log_file is None:
+                # Count what earlier runs appended to this job's log towards the size limit
+                written = os.path.getsize(sink.path) if os.path.exists(sink.path) else 0
+                if written >= cls.max_bytes:
+                    cls.rotate(sink.path)
+                    written = 0
+                log_file = gzip.open(sink.path, 'at', encoding='utf-8', compresslevel=6)
+            record = f"{datetime.datetime.fromtimestamp(timestamp).isoformat()} {stream_label} {text}\n"
+            log_file.write(record)
+            written += len(record)
+            if written > cls.max_bytes:
+                log_file.close()
+                cls.rotate(sink.path)
+                log_file, written = None, 0
+            files[sink] = (log_file, written)
+
+        for log_file, _ in files.values():
+            if log_file:
+                log_file.close()
+
+    @classmethod
+    def close(cls):
+        if not cls.ENABLED:
+            return
+        cls.line_queue.put((None, None, None, None))
+        cls.thread.join()
+        cls.ENABLED = False
+        if cls.dropped:
+            LOGGER.warning("Dropped %d subprocess output lines because the log queue was full", cls.dropped)
@@ -1,22 +1,184 @@
 # python 3.12
 import argparse
+import csv
 import logging
+import os
+import tempfile
 from datetime import datetime
 from pathlib import Path
 
 import json5
+import pydantic
 
 import item_params
 
 LOGGER = logging.getLogger('make_render_job')
 logging.basicConfig(level=logging.INFO)
 USAGE_DESCRIPTION = '''
-This script is used to create a JSON5 file from command line parameters.
+This script is used to create item JSON5 files, either one from command line parameters or a whole division
+from a manifest, validating every item against ItemParams and updating order.json5.
 Example of usage:
-python your_script.py --ae_project /path/to/project.aep --ae_comp "comp name" --name "My item"
+python make_render_job.py --ae_project /path/to/project.aep --ae_comp "comp name" --name "My item" \\
+    --defaults division_defaults.json5
+python make_render_job.py --manifest items.csv --defs-dir /smr/formatters/ev/defs-ev-div --smr-root /smr
+python make_render_job.py --comps-list comps.txt --ae_project formatters/ev/formatter-ev-div.aep \\
+    --defaults division_defaults.json5 --defs-dir /smr/formatters/ev/defs-ev-div --smr-root /smr
 '''
 
 
+def write_atomic(filepath, text):
+    """Write to a temporary file in the same directory and rename it over the target."""
+    file_dir = os.path.dirname(os.path.abspath(filepath))
+    file_handle, temp_path = tempfile.mkstemp(dir=file_dir, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(file_handle, 'w', encoding='utf-8') as file:
+            file.write(text)
+        os.replace(temp_path, filepath)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def parse_value(name, value):
+    """Convert a manifest cell or --set value.  Pydantic coerces numbers itself, marker_times needs splitting."""
+    if name == 'marker_times' and isinstance(value, str):
+        return [float(x) for x in value.replace(';', ' ').replace(',', ' ').split()]
+    return value
+
+
+class ItemManifest:
+    """Rows of item fields from a CSV or JSON5 manifest, or a plain list of comp names."""
+
+    def __init__(self):
+        self.defaults = {}
+        self.rows = []
+
+    @classmethod
+    def from_file(cls, manifest_path):
+        manifest = cls()
+        if manifest_path.lower().endswith('.csv'):
+            with open(manifest_path, 'r', encoding='utf-8-sig', newline='') as file:
+                for row in csv.DictReader(file):
+                    # Empty cells fall back to the defaults, except marker_times where empty means none
+                    manifest.rows.append({k.strip(): parse_value(k.strip(), v) for k, v in row.items()
+                                          if k and (v or (v == '' and k.strip() == 'marker_times'))})
+        else:
+            with open(manifest_path, 'r', encoding='utf-8') as file:
+                data = json5.load(file)
+            if isinstance(data, dict):
+                manifest.defaults = data.get('defaults', {})
+                data = data['items']
+            manifest.rows = [{k: parse_value(k, v) for k, v in row.items()} for row in data]
+        LOGGER.info(f"Read {len(manifest.rows)} items from {manifest_path}")
+        return manifest
+
+    @classmethod
+    def from_comps_list(cls, comps_list_path, ae_project):
+        """One item per line of comp names, e.g. the renderable comps listed by Create SMR Comps.jsx."""
+        manifest = cls()
+        with open(comps_list_path, 'r', encoding='utf-8') as file:
+            for line in file:
+                ae_comp = line.strip()
+                if ae_comp and not ae_comp.startswith('#'):
+                    manifest.rows.append(dict(ae_comp=ae_comp, ae_project=ae_project))
+        LOGGER.info(f"Read {len(manifest.rows)} comps from {comps_list_path}")
+        return manifest
+
+
+class BulkItemWriter:
+    def __init__(self, defs_dir, smr_root=None, defaults=None, creation_timestamp=None):
+        self.defs_dir = defs_dir
+        self.smr_root = smr_root
+        self.defaults = defaults or {}
+        self.creation_timestamp = creation_timestamp or datetime.now().isoformat()
+        self.project_timestamps = {}
+
+    def relative_location(self, path):
+        if self.smr_root:
+            path = os.path.relpath(path, self.smr_root)
+        return Path(path).as_posix()
+
+    def ae_project_timestamp(self, ae_project):
+        """Modification time of an AE project, statted once however many items share it."""
+        if ae_project not in self.project_timestamps:
+            project_path = ae_project
+            if self.smr_root and not os.path.isabs(project_path):
+                project_path = os.path.join(self.smr_root, project_path)
+            try:
+                self.project_timestamps[ae_project] = datetime.fromtimestamp(
+                    Path(project_path).stat().st_mtime).isoformat()
+            except OSError as exp:
+                LOGGER.warning(f"Cannot stat AE project {project_path}: {exp}")
+                self.project_timestamps[ae_project] = None
+        return self.project_timestamps[ae_project]
+
+    def item_path(self, item_name):
+        return os.path.join(self.defs_dir, f'{item_name}.json5')
+
+    def build_items(self, rows):
+        """Validate every row against ItemParams, returning (items, errors) so that all problems are reported."""
+        items = []
+        errors = []
+        seen_names = set()
+        for row_num, row in enumerate(rows, start=1):
+            data = dict(self.defaults, **row)
+            if 'name' in data and 'item_name' not in data:
+                data['item_name'] = data.pop('name')
+            data.setdefault('item_name', data.get('ae_comp'))
+            if data['item_name']:
+                data.setdefault('location', self.relative_location(self.item_path(data['item_name'])))
+            try:
+                item = item_params.ItemParams(**data)
+            except pydantic.ValidationError as exp:
+                errors.append(f"Item {row_num} ({data.get('item_name')}): {exp}")
+                continue
+            if item.item_name in seen_names:
+                errors.append(f"Item {row_num}: duplicate item_name {item.item_name}")
+                continue
+            seen_names.add(item.item_name)
+
+            extras = dict(creation_timestamp=data.get('creation_timestamp', self.creation_timestamp),
+                          ae_project_timestamp=data.get('ae_project_timestamp')
+                          or self.ae_project_timestamp(item.ae_project))
+            items.append((item, extras))
+        return items, errors
+
+    def order_data(self, items, replace_order=False):
+        order_path = os.path.join(self.defs_dir, 'order.json5')
+        if os.path.isfile(order_path) and not replace_order:
+            with open(order_path, 'r', encoding='utf-8') as file:
+                order = json5.load(file)
+        else:
+            first_item = items[0][0]
+            order = dict(ae_project=first_item.ae_project, ae_version=first_item.ae_version,
+                         division=first_item.division, event=first_item.event,
+                         appearance_order=[], location=self.relative_location(order_path))
+
+        records = {record['name']: record for record in order['appearance_order']}
+        for item, _ in items:
+            if item.item_name not in records:
+                order['appearance_order'].append(records.setdefault(item.item_name, dict(name=item.item_name)))
+            records[item.item_name].update(source_appearance=item.source_appearance,
+                                           source_duration=item.source_duration)
+
+        # Transitions as calculated by Create SMR Comps.jsx, redone as items may have been added or changed
+        last_disappearance_time = 0.0
+        for record in order['appearance_order']:
+            if 'source_appearance' in record and 'source_duration' in record:
+                record['source_transition'] = record['source_appearance'] - last_disappearance_time
+                last_disappearance_time = record['source_appearance'] + record['source_duration']
+        return order_path, order
+
+    def write(self, items, replace_order=False):
+        """Write every item file, then order.json5, so order.json5 never names an item that is not yet written."""
+        os.makedirs(self.defs_dir, exist_ok=True)
+        order_path, order = self.order_data(items, replace_order)
+        for item, extras in items:
+            write_atomic(self.item_path(item.item_name), json5.dumps(dict(item.model_dump(), **extras), indent=2))
+        write_atomic(order_path, json5.dumps(order, indent=2))
+        LOGGER.info(f"Wrote {len(items)} items and {order_path}")
+
+
 class CommandParamsHandler:
     def __init__(self):
         self.parser = self.initialize_parser()
@@ -25,9 +187,9 @@ class CommandParamsHandler:
     @staticmethod
     def initialize_parser():
         parser = argparse.ArgumentParser(description=USAGE_DESCRIPTION)
-        parser.add_argument('--ae_comp', required=True, type=str,
+        parser.add_argument('--ae_comp', required=False, type=str,
                             help='Name of a composition in the After Effects project')
-        parser.add_argument('--ae_project', required=True, type=str,
+        parser.add_argument('--ae_project', required=False, type=str,
                             help='Filepath to an After Effects project')
         parser.add_argument('--name', required=False, type=str,
                             help='Name of the item')
@@ -37,37 +199,97 @@ class CommandParamsHandler:
                             help='Time of item file creation')
         parser.add_argument('--ae-project-timestamp', required=False, type=str,
                             help='Time of After Effects project modification')
+        parser.add_argument('--comps-list', required=False, type=str,
+                            help='Text file of comp names, one per line, in --ae_project to create items for')
+        parser.add_argument('--defaults', required=False, type=str,
+                            help='JSON5 file of field values shared by all items, e.g. event, division, variant')
+        parser.add_argument('--defs-dir', required=False, type=str,
+                            help='Directory to write item files and order.json5 into (bulk mode)')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Validate the items without writing anything')
+        parser.add_argument('--manifest', required=False, type=str,
+                            help='CSV or JSON5 manifest with one row per item (bulk mode)')
+        parser.add_argument('--replace-order', action='store_true',
+                            help='Rebuild order.json5 from the manifest instead of updating the existing one')
+        parser.add_argument('--set', action='append', default=[], metavar='FIELD=VALUE',
+                            help='Set an item field for all items, overriding --defaults')
+        parser.add_argument('--smr-root', required=False, type=str,
+                            help='Root that ae_project and location paths are relative to')
         return parser
 
+    def load_defaults(self, options):
+        defaults = {}
+        if options.defaults:
+            with open(options.defaults, 'r', encoding='utf-8') as file:
+                defaults = json5.load(file)
+        for setting in options.set:
+            field_name, _, value = setting.partition('=')
+            defaults[field_name] = parse_value(field_name, value)
+        if options.creation_timestamp:
+            defaults['creation_timestamp'] = options.creation_timestamp
+        if options.ae_project_timestamp:
+            defaults['ae_project_timestamp'] = options.ae_project_timestamp
+        return defaults
+
     def generate_and_write_item_params(self):
         options = self.parser.parse_args()
         LOGGER.debug(f'Arguments parsed: {options}')
-        if not options.ae_project_timestamp:
-            options.ae_project_timestamp = datetime.fromtimestamp(Path(options.ae_project).stat().st_mtime).isoformat()
-        if not options.creation_timestamp:
-            options.creation_timestamp = datetime.now().isoformat()
+        if options.manifest or options.comps_list:
+            return self.generate_and_write_bulk(options)
+        if not options.ae_comp or not options.ae_project:
+            self.parser.error('--ae_comp and --ae_project are required unless --manifest or --comps-list is used')
+
         if not options.name:
             options.name = options.ae_comp
         if not options.output_json5:
             options.output_json5 = f"{options.name}-render.json5"
             LOGGER.info(f'--output-json5 is not passed, setting it to {options.output_json5} based on name')
 
-        item = item_params.ItemParams(
-            ae_project=options.ae_project,
-            ae_comp=options.ae_comp,
-            name=options.name,
-            creation_timestamp=options.creation_timestamp,
-            ae_project_timestamp=options.ae_project_timestamp
-        )
+        writer = BulkItemWriter(os.path.dirname(options.output_json5) or '.', options.smr_root,
+                                self.load_defaults(options))
+        items, errors = writer.build_items([dict(ae_project=options.ae_project, ae_comp=options.ae_comp,
+                                                 item_name=options.name,
+                                                 location=writer.relative_location(options.output_json5))])
+        if errors:
+            self.parser.exit(1, "\n".join(errors) + "\n")
+
+        if not options.dry_run:
+            item, extras = items[0]
+            self.write_item_params_to_file(options.output_json5, dict(item.model_dump(), **extras))
+        return 0
+
+    def generate_and_write_bulk(self, options):
+        if not options.defs_dir:
+            self.parser.error('--defs-dir is required with --manifest or --comps-list')
+        if options.comps_list:
+            if not options.ae_project:
+                self.parser.error('--ae_project is required with --comps-list')
+            manifest = ItemManifest.from_comps_list(options.comps_list, options.ae_project)
+        else:
+            manifest = ItemManifest.from_file(options.manifest)
+
+        writer = BulkItemWriter(options.defs_dir, options.smr_root, dict(manifest.defaults,
+                                                                         **self.load_defaults(options)))
+        items, errors = writer.build_items(manifest.rows)
+        for error in errors:
+            LOGGER.error(error)
+        if errors:
+            LOGGER.error(f"{len(errors)} of {len(manifest.rows)} items are invalid, nothing written")
+            return 1
+        if not items:
+            LOGGER.warning("No items in manifest, nothing written")
+            return 0
 
-        self.write_item_params_to_file(options.output_json5, item)
+        LOGGER.info(f"Validated {len(items)} items using {len(writer.project_timestamps)} AE project(s)")
+        if not options.dry_run:
+            writer.write(items, replace_order=options.replace_order)
+        return 0
 
     def write_item_params_to_file(self, filepath, item):
-        with open(filepath, 'w', encoding='utf-8') as f:
-            f.write(json5.dumps(item.dict(), indent=2))
+        write_atomic(filepath, json5.dumps(item, indent=2))
         LOGGER.info(f'Render item details written to the file: {filepath}')
 
 
 if __name__ == '__main__':
     handler = CommandParamsHandler()
-    handler.generate_and_write_item_params()
+    raise SystemExit(handler.generate_and_write_item_params())
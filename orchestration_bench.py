@@ -0,0 +1,266 @@
+# python 3.12
+import argparse
+import json
+import logging
+import os
+import queue
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import psutil
+
+import file_scanner
+import hb_encode
+import item_params
+import output_params
+import process_wrapper
+import render_job
+import render_params
+import text_table
+import tool_stub
+from log_sink import SubprocessLog
+from trackers import Trackers
+
+LOGGER = logging.getLogger('orchestration_bench')
+LOGGER.setLevel(level=logging.DEBUG)
+USAGE_DESCRIPTION = '''
+This script measures the overhead of the Python orchestration (ProcessWrapper, the service_* output parsers and
+Trackers calls) by running it against tool_stub.py in place of aerender and HandBrakeCLI.
+Example of usage:
+python orchestration_bench.py --frames 2000 --line-rate 500 --results bench.json --baseline bench_baseline.json
+python orchestration_bench.py --replay-aerender aerender.jsonl --replay-handbrake handbrake.jsonl
+'''
+
+# Metrics where an increase beyond the tolerance counts as a regression
+REGRESSION_METRICS = ['parse_us_per_line', 'queue_latency_p95_ms', 'python_cpu_ms_per_line', 'overhead_seconds']
+
+
+class InstrumentedQueue(queue.Queue):
+    def __init__(self):
+        super().__init__()
+        self.latencies = []
+
+    def get(self, *args, **kwargs):
+        item = super().get(*args, **kwargs)
+        self.latencies.append(time.monotonic() - item[1])
+        return item
+
+
+class InstrumentedProcessWrapper(process_wrapper.ProcessWrapper):
+    instances = []
+
+    def __init__(self, command):
+        super().__init__(command)
+        self.output_queue = InstrumentedQueue()
+        self.process_start = None
+        self.process_end = None
+        InstrumentedProcessWrapper.instances.append(self)
+
+    def run_process(self):
+        self.process_start = time.monotonic()
+        super().run_process()
+        self.process_end = time.monotonic()
+
+
+class ParseTimer:
+    """Accumulates CPU time spent on the polling thread inside the wrapped service method."""
+
+    def __init__(self):
+        self.thread_seconds = 0.0
+
+    def wrap(self, method):
+        def _timed(*args, **kwargs):
+            start = time.thread_time()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.thread_seconds += time.thread_time() - start
+
+        return _timed
+
+
+class OrchestrationBench:
+    def __init__(self, options):
+        self.options = options
+        self.work_dir = tempfile.mkdtemp(prefix='orchestration_bench_')
+        self.params = self.make_params()
+        self.results = {}
+
+    def make_params(self):
+        render_p = render_params.RenderParams.from_json5(self.options.render_params_base)
+        item_p = item_params.ItemParams(
+            ae_comp='Bench comp', ae_project='bench.aep', ae_version='25.2', division='bench', duration=60.0,
+            event='bench', flags='', frame_rate=50.0, height=2160, item_name='bench', location='bench.json5',
+            marker_times=[], source_appearance=0.0, source_duration=60.0, source_name='bench', speed_divisor=8,
+            variant='', width=3840)
+        output_p = output_params.OutputParams(destination_path=os.path.join(self.work_dir, 'bench.mp4'))
+        return render_job.RenderJobParams(item=item_p, output=output_p, render=render_p)
+
+    def set_stub_env(self, replay_path):
+        os.environ['SLOE_STUB_FRAMES'] = str(self.options.frames)
+        os.environ['SLOE_STUB_LINE_RATE'] = str(self.options.line_rate)
+        os.environ['SLOE_STUB_SPEEDUP'] = str(self.options.speedup)
+        if replay_path:
+            os.environ['SLOE_STUB_REPLAY'] = replay_path
+        else:
+            os.environ.pop('SLOE_STUB_REPLAY', None)
+
+    def measure(self, name, scenario, timer, replay_path=None):
+        self.set_stub_env(replay_path)
+        InstrumentedProcessWrapper.instances = []
+        python_process = psutil.Process()
+        cpu_before = python_process.cpu_times()
+        start_time = time.monotonic()
+
+        scenario()
+
+        wall_seconds = time.monotonic() - start_time
+        cpu_after = python_process.cpu_times()
+        python_cpu_seconds = (cpu_after.user - cpu_before.user) + (cpu_after.system - cpu_before.system)
+        latencies = [x for wrapper in InstrumentedProcessWrapper.instances for x in wrapper.output_queue.latencies]
+        tool_seconds = sum(wrapper.process_end - wrapper.process_start
+                           for wrapper in InstrumentedProcessWrapper.instances if wrapper.process_end)
+        lines = max(len(latencies), 1)
+
+        self.results[name] = dict(
+            lines=len(latencies),
+            wall_seconds=round(wall_seconds, 3),
+            tool_seconds=round(tool_seconds, 3),
+            overhead_seconds=round(wall_seconds - tool_seconds, 3),
+            parse_us_per_line=round(1e6 * timer.thread_seconds / lines, 2),
+            queue_latency_p50_ms=round(1e3 * statistics.median(latencies), 3) if latencies else 0.0,
+            queue_latency_p95_ms=round(1e3 * statistics.quantiles(latencies, n=20)[-1], 3)
+            if len(latencies) >= 2 else 0.0,
+            queue_latency_max_ms=round(1e3 * max(latencies), 3) if latencies else 0.0,
+            python_cpu_seconds=round(python_cpu_seconds, 3),
+            python_cpu_ms_per_line=round(1e3 * python_cpu_seconds / lines, 4),
+        )
+        LOGGER.info("%s: %s", name, self.results[name])
+
+    def bench_aerender(self):
+        job = render_job.RenderJob(None, 'Bench aerender', self.params)
+        timer = ParseTimer()
+        job.service_aerender_job = timer.wrap(job.service_aerender_job)
+        prores_path = os.path.join(self.work_dir, 'bench prores.mov')
+        command = tool_stub.stub_command('aerender') + ['-project', 'bench.aep', '-comp', 'Bench comp',
+                                                        '-output', prores_path]
+        self.measure('aerender', lambda: job.run_aerender(command, prores_path), timer,
+                     replay_path=self.options.replay_aerender)
+
+    def bench_handbrake(self):
+        job = render_job.RenderJob(None, 'Bench HandBrakeCLI', self.params)
+        input_path = os.path.join(self.work_dir, 'bench prores.mov')
+        if not os.path.isfile(input_path):
+            with open(input_path, 'wb') as file:
+                file.write(b'\0')
+        encode = hb_encode.HandbrakeEncode(self.params.render.hb, input_path, self.params.output.destination_path,
+                                           'Bench HandBrakeCLI', progress_callback=job.handle_handbrakecli_progress,
+                                           hb_command=tool_stub.stub_command('handbrake'))
+        timer = ParseTimer()
+        encode.service = timer.wrap(encode.service)
+        self.measure('handbrake', encode.run, timer, replay_path=self.options.replay_handbrake)
+
+    def bench_scan(self):
+        scan = file_scanner.FileScanner(os.path.join(self.work_dir, 'bench prores.mov'), 'Bench scan', self.params,
+                                        hb_command=tool_stub.stub_command('handbrake'))
+        timer = ParseTimer()
+        scan.service_job = timer.wrap(scan.service_job)
+        self.measure('scan', scan.scan_video, timer)
+
+    def run(self):
+        Trackers.CLEARML_ENABLED = self.options.trackers
+        Trackers.MLFLOW_ENABLED = self.options.trackers
+        real_process_wrapper = process_wrapper.ProcessWrapper
+        process_wrapper.ProcessWrapper = InstrumentedProcessWrapper
+        try:
+            for scenario in self.options.scenarios:
+                getattr(self, f"bench_{scenario}")()
+        finally:
+            process_wrapper.ProcessWrapper = real_process_wrapper
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
+        if self.options.results:
+            with open(self.options.results, 'w', encoding='utf-8') as file:
+                json.dump(self.results, file, indent=2)
+        self.log_table()
+        if self.options.baseline:
+            return self.compare_baseline()
+        return 0
+
+    def log_table(self):
+        columns = ['lines', 'wall_seconds', 'overhead_seconds', 'parse_us_per_line', 'queue_latency_p50_ms',
+                   'queue_latency_p95_ms', 'python_cpu_ms_per_line']
+        rows = [[name] + [str(result[column]) for column in columns] for name, result in self.results.items()]
+        headings = ['scenario'] + columns
+        LOGGER.info("Orchestration overhead:\n\n%s\n", text_table.format_table(headings, rows))
+
+    def compare_baseline(self):
+        with open(self.options.baseline, 'r', encoding='utf-8') as file:
+            baseline = json.load(file)
+        regressions = 0
+        for name, result in self.results.items():
+            for metric in REGRESSION_METRICS:
+                old_value = baseline.get(name, {}).get(metric)
+                if not old_value:
+                    continue
+                change = (result[metric] - old_value) / old_value
+                if change > self.options.tolerance:
+                    LOGGER.error("+++REGRESSION %s %s: %s -> %s (%+.0f%%)", name, metric, old_value, result[metric],
+                                 100 * change)
+                    regressions += 1
+        if not regressions:
+            LOGGER.info("No regressions against %s", self.options.baseline)
+        return 1 if regressions else 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=USAGE_DESCRIPTION)
+    parser.add_argument('--baseline', default=None,
+                        help='Results file from an earlier run to compare against')
+    parser.add_argument('--frames', default=2000, type=int,
+                        help='Frames for the synthesised aerender and HandBrake output')
+    parser.add_argument('--line-rate', default=500.0, type=float,
+                        help='aerender progress lines per second for synthesised output')
+    parser.add_argument('--log-file', default='orchestration_bench.log',
+                        help='File receiving the orchestration log, keeping the console quiet')
+    parser.add_argument('--render-params-base', default='render_params_base.json5',
+                        help='Parameter file (json5) for rendering')
+    parser.add_argument('--replay-aerender', default=None,
+                        help='Recording (from tool_stub.py record) to replay in place of synthesised aerender output')
+    parser.add_argument('--replay-handbrake', default=None,
+                        help='Recording to replay in place of synthesised HandBrakeCLI output')
+    parser.add_argument('--results', default=None,
+                        help='Write results as json to this file')
+    parser.add_argument('--scenarios', nargs='+', default=['aerender', 'handbrake', 'scan'],
+                        choices=['aerender', 'handbrake', 'scan'])
+    parser.add_argument('--speedup', default=20.0, type=float,
+                        help='Speed up synthesised or replayed tool output by this factor')
+    parser.add_argument('--subprocess-log-dir', default=None,
+                        help='Route tool output through log_sink.SubprocessLog into this directory')
+    parser.add_argument('--tolerance', default=0.25, type=float,
+                        help='Fractional increase over the baseline that counts as a regression')
+    parser.add_argument('--trackers', action='store_true',
+                        help='Leave ClearML and MLflow reporting enabled, using their local configuration')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    bench_options = parse_args()
+    logging.basicConfig(format='%(asctime)s.%(msecs)03d %(name)s:%(levelname)s: %(message)s',
+                        datefmt='%H:%M:%S',
+                        filename=bench_options.log_file,
+                        level=logging.INFO)
+    console = logging.StreamHandler()
+    console.setLevel(logging.INFO)
+    console.addFilter(logging.Filter('orchestration_bench'))
+    logging.getLogger().addHandler(console)
+    if bench_options.subprocess_log_dir:
+        SubprocessLog.configure(bench_options.subprocess_log_dir)
+    try:
+        exit_code = OrchestrationBench(bench_options).run()
+    finally:
+        SubprocessLog.close()
+    sys.exit(exit_code)
@@ -1,5 +1,8 @@
+import copy
+import fnmatch
 import logging
 import os
+import socket
 
 import json5
 
@@ -7,6 +10,12 @@ LOGGER = logging.getLogger('path_maker')
 LOGGER.setLevel(level=logging.DEBUG)
 
 
+def host_env_filepath(env_filepath):
+    """The host's own env file, e.g. yaban-sloerender_env.json5, if there is one."""
+    host_filepath = f"{socket.gethostname()}-{env_filepath}"
+    return host_filepath if os.path.isfile(host_filepath) else env_filepath
+
+
 class PathMaker:
     def __init__(self, env_filepath):
         with open(env_filepath, "r", encoding='utf-8') as file:
@@ -37,6 +46,41 @@ class PathMaker:
     def set_default_variant(self, variant_name):
         self.env['variant'] = variant_name
 
+    def for_division(self, event_name, division_name, variant_name):
+        path_maker = copy.copy(self)
+        path_maker.env = dict(self.env)
+        path_maker.set_default_event(event_name)
+        path_maker.set_default_division(division_name)
+        path_maker.set_default_variant(variant_name)
+        return path_maker
+
+    def find_divisions(self, spec):
+        """Expand an event/division/variant spec containing glob patterns into matching defs directories."""
+        parts = spec.split('/')
+        event_glob = parts[0]
+        division_glob = parts[1] if len(parts) > 1 else '*'
+        variant_glob = parts[2] if len(parts) > 2 else self.get_variant()
+
+        matches = []
+        formatters_dir = os.path.join(self.env['smr_root'], 'formatters')
+        for event_name in sorted(os.listdir(formatters_dir)):
+            event_dir = os.path.join(formatters_dir, event_name)
+            if not os.path.isdir(event_dir) or not fnmatch.fnmatch(event_name, event_glob):
+                continue
+            defs_prefix = f"defs-{event_name}-"
+            for defs_name in sorted(os.listdir(event_dir)):
+                if not defs_name.startswith(defs_prefix):
+                    continue
+                if not os.path.isfile(os.path.join(event_dir, defs_name, 'order.json5')):
+                    continue
+                division_name, _, variant_name = defs_name[len(defs_prefix):].partition('-')
+                if fnmatch.fnmatch(division_name, division_glob) and fnmatch.fnmatch(variant_name, variant_glob):
+                    matches.append((event_name, division_name, variant_name))
+
+        if not matches:
+            LOGGER.warning("No divisions found in %s matching %s", formatters_dir, spec)
+        return matches
+
     def project_name(self):
         project_elements = [
             self.get_event(),
@@ -69,6 +113,12 @@ class PathMaker:
         return os.path.join(self.env['smr_scratch_prores'], self.get_event(event_name),
                             self.get_division(division_name))
 
+    def smr_scratch_mp4_dir(self, event_name=None, division_name=None, variant_name=None):
+        return os.path.join(self.env['smr_scratch_mp4'], self.get_event(event_name), self.get_division(division_name))
+
+    def has_scratch_mp4(self):
+        return bool(self.env.get('smr_scratch_mp4'))
+
     def order_path(self, event_name=None, division_name=None, variant_name=None):
         return os.path.join(self.formatters_defs_dir(event_name, division_name, variant_name), 'order.json5')
 
@@ -78,18 +128,28 @@ class PathMaker:
     def item_ae_project_path(self, item_ae_project_path):
         return os.path.join(self.env['smr_root'], item_ae_project_path)
 
-    def final_path(self, name, event_name=None, division_name=None, variant_name=None, mkdir=False):
+    def final_path(self, name, event_name=None, division_name=None, variant_name=None, mkdir=False, suffix=''):
         variant = self.get_variant(variant_name)
         if self.env['variant_has_suffix'] and variant:
-            final_path = os.path.join(self.final_dir(event_name, division_name), f'{name}-{variant}.mp4')
+            final_path = os.path.join(self.final_dir(event_name, division_name), f'{name}-{variant}{suffix}.mp4')
         else:
-            final_path = os.path.join(self.final_dir(event_name, division_name), f'{name}.mp4')
+            final_path = os.path.join(self.final_dir(event_name, division_name), f'{name}{suffix}.mp4')
 
         if mkdir:
             os.makedirs(os.path.dirname(final_path), exist_ok=True)
 
         return final_path
 
+    def scratch_mp4_path(self, name, event_name=None, division_name=None, variant_name=None, mkdir=False,
+                         suffix=''):
+        final_name = os.path.basename(self.final_path(name, event_name, division_name, variant_name, suffix=suffix))
+        scratch_mp4_path = os.path.join(self.smr_scratch_mp4_dir(event_name, division_name), final_name)
+
+        if mkdir:
+            os.makedirs(os.path.dirname(scratch_mp4_path), exist_ok=True)
+
+        return scratch_mp4_path
+
     def prores_path(self, name, event_name=None, division_name=None, variant_name=None, mkdir=False):
         variant = self.get_variant(variant_name)
         if variant:
@@ -102,3 +162,33 @@ class PathMaker:
             os.makedirs(os.path.dirname(prores_path), exist_ok=True)
 
         return prores_path
+
+    def preflight_path(self, name, start_frame, event_name=None, division_name=None, variant_name=None, mkdir=False):
+        prores_name = os.path.basename(self.prores_path(name, event_name, division_name, variant_name))
+        preflight_path = os.path.join(self.smr_scratch_prores_dir(event_name, division_name), 'preflight',
+                                      prores_name.replace(' prores.mov', f' preflight {start_frame}.mov'))
+
+        if mkdir:
+            os.makedirs(os.path.dirname(preflight_path), exist_ok=True)
+
+        return preflight_path
+
+    def segment_path(self, name, start_frame, event_name=None, division_name=None, variant_name=None, mkdir=False):
+        prores_name = os.path.basename(self.prores_path(name, event_name, division_name, variant_name))
+        segment_path = os.path.join(self.smr_scratch_prores_dir(event_name, division_name), 'segments',
+                                    prores_name.replace(' prores.mov', f' segment {start_frame:06d}.mov'))
+
+        if mkdir:
+            os.makedirs(os.path.dirname(segment_path), exist_ok=True)
+
+        return segment_path
+
+    def segment_manifest_path(self, name, event_name=None, division_name=None, variant_name=None, mkdir=False):
+        prores_name = os.path.basename(self.prores_path(name, event_name, division_name, variant_name))
+        manifest_path = os.path.join(self.smr_scratch_prores_dir(event_name, division_name), 'segments',
+                                     prores_name.replace(' prores.mov', ' segments.json'))
+
+        if mkdir:
+            os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+
+        return manifest_path
@@ -0,0 +1,289 @@
+# python 3.12
+import argparse
+import logging
+import socket
+import sqlite3
+import statistics
+import sys
+import threading
+import time
+
+import text_table
+
+LOGGER = logging.getLogger('perf_history')
+LOGGER.setLevel(level=logging.DEBUG)
+USAGE_DESCRIPTION = '''
+Compares recent renders recorded in the local performance history against earlier ones, flagging items and
+hosts that have become slower, along with any AE version, template or MFR setting that changed with them.
+Example of usage:
+python perf_history.py compare --recent-days 7
+python perf_history.py compare --history sloerender_perf_history.sqlite --min-ratio 1.1 --z 2
+'''
+
+SCHEMA_VERSION = 3
+COLUMNS = [
+    ('timestamp', 'REAL'),
+    ('host', 'TEXT'),
+    ('event', 'TEXT'),
+    ('division', 'TEXT'),
+    ('variant', 'TEXT'),
+    ('item_name', 'TEXT'),
+    ('ae_version', 'TEXT'),
+    ('condensed_version', 'TEXT'),
+    ('render_settings_template', 'TEXT'),
+    ('encoder', 'TEXT'),
+    ('mfr_tags', 'TEXT'),
+    ('comp_class', 'TEXT'),
+    ('image_cache_percent', 'INTEGER'),
+    ('max_mem_percent', 'INTEGER'),
+    ('mfr_max_cpu_percent', 'INTEGER'),
+    ('frames', 'INTEGER'),
+    ('spf_p50', 'REAL'),
+    ('spf_p90', 'REAL'),
+    ('spf_p99', 'REAL'),
+    ('preflight_spf', 'REAL'),
+    ('render_seconds', 'REAL'),
+    ('encode_fps', 'REAL'),
+    ('encode_seconds', 'REAL'),
+    ('total_seconds', 'REAL'),
+]
+# Metrics compared by the regression check, and whether a higher value is worse
+COMPARED_METRICS = {'spf_p50': True, 'encode_fps': False}
+# Settings reported as possible causes when they differ between the baseline and recent runs
+CAUSE_COLUMNS = ['condensed_version', 'ae_version', 'render_settings_template', 'mfr_tags', 'max_mem_percent',
+                 'mfr_max_cpu_percent', 'encoder']
+# aerender settings chosen per host and comp class by host_tuning
+TUNED_COLUMNS = ['image_cache_percent', 'max_mem_percent', 'mfr_max_cpu_percent']
+
+
+def quantile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def comp_class(item):
+    return f"{item.width}x{item.height}@{item.frame_rate:g}"
+
+
+class PerfHistory:
+    """Local SQLite store of one summary row per rendered item, per host, for comparisons and estimates."""
+
+    def __init__(self, history_path):
+        self.history_path = history_path
+        self.connection = None
+        self.lock = threading.RLock()
+        self.host = socket.gethostname()
+
+    def open(self):
+        self.connection = sqlite3.connect(self.history_path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version < SCHEMA_VERSION:
+            self.connection.execute(f"CREATE TABLE IF NOT EXISTS runs "
+                                    f"({', '.join(f'{name} {sql_type}' for name, sql_type in COLUMNS)})")
+            # Earlier versions only lack columns, which are left empty in their rows
+            existing = {row['name'] for row in self.connection.execute("PRAGMA table_info(runs)")}
+            for name, sql_type in COLUMNS:
+                if name not in existing:
+                    self.connection.execute(f"ALTER TABLE runs ADD COLUMN {name} {sql_type}")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS runs_item ON runs (item_name, host)")
+            self.connection.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+            self.connection.commit()
+        elif version != SCHEMA_VERSION:
+            raise sqlite3.DatabaseError(f"{self.history_path} has schema version {version}, "
+                                        f"expected {SCHEMA_VERSION}")
+        return self
+
+    def close(self):
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+    def record(self, job):
+        """Add a row summarising a finished RenderJob, if it rendered or encoded anything."""
+        if not job.frame_intervals and not job.encode_seconds:
+            return
+        item = job.params.item
+        render = job.params.render
+        intervals = sorted(job.frame_intervals)
+        encode_fps = None
+        if job.encode and job.encode.last_progress:
+            encode_fps = job.encode.last_progress.get('RateAvg')
+        row = dict(
+            timestamp=time.time(),
+            host=self.host,
+            event=item.event,
+            division=item.division,
+            variant=item.variant,
+            item_name=item.item_name,
+            ae_version=item.ae_version,
+            condensed_version=render.ae.condensed_version,
+            render_settings_template=render.ae.render_settings_template,
+            encoder=render.hb.encoder,
+            mfr_tags=",".join(sorted(job.mfr_tags or [])),
+            comp_class=comp_class(item),
+            image_cache_percent=render.ae.image_cache_percent,
+            max_mem_percent=render.ae.max_mem_percent,
+            mfr_max_cpu_percent=render.ae.mfr_max_cpu_percent,
+            frames=round(item.duration * item.frame_rate),
+            spf_p50=quantile(intervals, 0.5) if intervals else None,
+            spf_p90=quantile(intervals, 0.9) if intervals else None,
+            spf_p99=quantile(intervals, 0.99) if intervals else None,
+            preflight_spf=job.preflight_seconds_per_frame,
+            render_seconds=job.render_seconds or None,
+            encode_fps=encode_fps,
+            encode_seconds=job.encode_seconds or None,
+            total_seconds=job.total_seconds(),
+        )
+        with self.lock, self.connection:
+            self.connection.execute(f"INSERT INTO runs ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})",
+                                    list(row.values()))
+
+    def query(self, sql, parameters=()):
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def runs(self):
+        return [dict(row) for row in self.query("SELECT * FROM runs ORDER BY timestamp")]
+
+    def estimate_seconds(self, item, host=None):
+        """Expected render plus encode seconds for an item on a host, from its own history or the host's."""
+        host = host or self.host
+        rows = self.query(
+            "SELECT render_seconds, encode_seconds FROM runs WHERE item_name = ? AND event = ? AND division = ? "
+            "AND variant = ? AND host = ? AND render_seconds IS NOT NULL ORDER BY timestamp DESC LIMIT 5",
+            (item.item_name, item.event, item.division, item.variant, host))
+        if rows:
+            return statistics.median(row['render_seconds'] + (row['encode_seconds'] or 0.0) for row in rows)
+
+        frames = item.duration * item.frame_rate
+        rows = self.query(
+            "SELECT spf_p50, encode_fps FROM runs WHERE host = ? AND spf_p50 IS NOT NULL "
+            "ORDER BY timestamp DESC LIMIT 50", (host,))
+        if not rows:
+            return None
+        seconds = frames * statistics.median(row['spf_p50'] for row in rows)
+        encode_fps = [row['encode_fps'] for row in rows if row['encode_fps']]
+        if encode_fps:
+            seconds += frames / statistics.median(encode_fps)
+        return seconds
+
+    def setting_scores(self, item_comp_class, host=None):
+        """Seconds per frame relative to the item's median on this host, by the tuned settings of each run."""
+        host = host or self.host
+        rows = self.query(
+            f"SELECT item_name, event, division, variant, spf_p50, {', '.join(TUNED_COLUMNS)} FROM runs "
+            f"WHERE host = ? AND comp_class = ? AND spf_p50 IS NOT NULL", (host, item_comp_class))
+        item_spf = {}
+        for row in rows:
+            item_spf.setdefault(self.item_key(row), []).append(row['spf_p50'])
+        scores = {}
+        for row in rows:
+            settings = tuple(row[column] for column in TUNED_COLUMNS)
+            scores.setdefault(settings, []).append(row['spf_p50'] / statistics.median(item_spf[self.item_key(row)]))
+        return scores
+
+    @staticmethod
+    def compare_values(baseline, recent, higher_is_worse, min_ratio, z_threshold):
+        """Ratio of recent to baseline median, in the worse direction, if it is a significant slowdown."""
+        baseline_median = statistics.median(baseline)
+        recent_median = statistics.median(recent)
+        if not baseline_median or not recent_median:
+            return None
+        ratio = recent_median / baseline_median if higher_is_worse else baseline_median / recent_median
+        if ratio < min_ratio:
+            return None
+        # With enough history, also require the change to stand out from the usual run to run variation
+        if len(baseline) >= 3:
+            stdev = statistics.stdev(baseline)
+            if stdev and abs(recent_median - statistics.mean(baseline)) < z_threshold * stdev:
+                return None
+        return ratio
+
+    def compare(self, recent_days=7.0, min_ratio=1.2, z_threshold=3.0):
+        """Find items and hosts whose recent runs are slower than those before them."""
+        cutoff = time.time() - recent_days * 24 * 3600
+        runs = self.runs()
+
+        # Normalise each run against the median of the item's baseline runs on all hosts, so that hosts can be
+        # compared across the different items they happened to render
+        item_baselines = {}
+        for run in runs:
+            if run['timestamp'] < cutoff and run['spf_p50']:
+                item_baselines.setdefault(self.item_key(run), []).append(run['spf_p50'])
+        for run in runs:
+            baseline = item_baselines.get(self.item_key(run))
+            run['spf_relative'] = run['spf_p50'] / statistics.median(baseline) if baseline and run['spf_p50'] \
+                else None
+
+        groups = {}
+        for run in runs:
+            groups.setdefault(('item', f"{self.item_key(run)} on {run['host']}"), []).append(run)
+            groups.setdefault(('host', run['host']), []).append(run)
+
+        findings = []
+        for (group_type, group_name), group_runs in sorted(groups.items()):
+            baseline_runs = [run for run in group_runs if run['timestamp'] < cutoff]
+            recent_runs = [run for run in group_runs if run['timestamp'] >= cutoff]
+            if not baseline_runs or not recent_runs:
+                continue
+            metrics = {'spf_relative': True} if group_type == 'host' else COMPARED_METRICS
+            for metric, higher_is_worse in metrics.items():
+                baseline = [run[metric] for run in baseline_runs if run[metric]]
+                recent = [run[metric] for run in recent_runs if run[metric]]
+                if not baseline or not recent:
+                    continue
+                ratio = self.compare_values(baseline, recent, higher_is_worse, min_ratio, z_threshold)
+                if ratio:
+                    changes = []
+                    for column in CAUSE_COLUMNS:
+                        old_values = {run[column] for run in baseline_runs}
+                        new_values = {run[column] for run in recent_runs} - old_values
+                        if new_values:
+                            changes.append(f"{column} {'/'.join(sorted(map(str, old_values)))} -> "
+                                           f"{'/'.join(sorted(map(str, new_values)))}")
+                    findings.append(dict(group=f"{group_type} {group_name}", metric=metric,
+                                         baseline=statistics.median(baseline), recent=statistics.median(recent),
+                                         ratio=ratio, runs=f"{len(baseline)}/{len(recent)}",
+                                         changes="; ".join(changes)))
+        return findings
+
+    @staticmethod
+    def item_key(run):
+        return "/".join(x for x in (run['event'], run['division'], run['variant'], run['item_name']) if x)
+
+
+def log_findings(findings):
+    columns = ['group', 'metric', 'baseline', 'recent', 'ratio', 'runs', 'changes']
+    rows = [[finding['group'], finding['metric'], f"{finding['baseline']:.4g}", f"{finding['recent']:.4g}",
+             f"{finding['ratio']:.2f}x", finding['runs'], finding['changes']] for finding in findings]
+    LOGGER.error("+++REGRESSIONS (baseline/recent runs):\n\n%s\n", text_table.format_table(columns, rows))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=USAGE_DESCRIPTION)
+    parser.add_argument('command', choices=['compare'])
+    parser.add_argument('--history', default='sloerender_perf_history.sqlite',
+                        help='History database written by sloerender.py --perf-history')
+    parser.add_argument('--min-ratio', default=1.2, type=float,
+                        help='Smallest slowdown of the recent median over the baseline median to report')
+    parser.add_argument('--recent-days', default=7.0, type=float,
+                        help='Runs in this many most recent days are compared against all earlier runs')
+    parser.add_argument('--z', default=3.0, type=float,
+                        help='With three or more baseline runs, also require this many standard deviations of change')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    options = parse_args()
+    logging.basicConfig(format='%(asctime)s.%(msecs)03d %(name)s:%(levelname)s: %(message)s', datefmt='%H:%M:%S',
+                        level=logging.INFO)
+    history = PerfHistory(options.history).open()
+    try:
+        findings = history.compare(recent_days=options.recent_days, min_ratio=options.min_ratio,
+                                   z_threshold=options.z)
+    finally:
+        history.close()
+    if findings:
+        log_findings(findings)
+        sys.exit(1)
+    LOGGER.info("No regressions in the last %s days", options.recent_days)
@@ -0,0 +1,75 @@
+import logging
+import statistics
+
+LOGGER = logging.getLogger('preflight')
+LOGGER.setLevel(level=logging.DEBUG)
+
+
+class Preflight:
+    """Settings for the short renders of sampled frames that RenderJob makes before committing to a full render.
+
+    Windows of frames_per_sample frames are spread evenly across the comp, plus up to marker_samples more
+    around the marker times, where transitions and captions change.  Marker times are in the source comp,
+    so they are scaled by the item's speed divisor to find them in the rendered comp.  Each window is a
+    separate aerender run, so the first frame of each pays for loading the project and the later frames
+    give the cost per frame.
+    """
+
+    def __init__(self, samples=3, marker_samples=2, frames_per_sample=3, max_seconds_per_frame=120.0):
+        self.samples = samples
+        self.marker_samples = marker_samples
+        self.frames_per_sample = max(2, frames_per_sample)
+        self.max_seconds_per_frame = max_seconds_per_frame
+
+    @classmethod
+    def from_env(cls, env):
+        if not env.get('preflight_samples'):
+            return None
+        return cls(samples=env['preflight_samples'], marker_samples=env.get('preflight_marker_samples', 2),
+                   frames_per_sample=env.get('preflight_frames_per_sample', 3),
+                   max_seconds_per_frame=env.get('preflight_max_seconds_per_frame', 120.0))
+
+    def windows(self, item):
+        """(start, end) frames, inclusive, of each window to render for an item."""
+        frames = round(item.duration * item.frame_rate)
+        length = min(self.frames_per_sample, frames)
+        last_start = max(0, frames - length)
+
+        starts = []
+        for i in range(self.samples):
+            fraction = i / (self.samples - 1) if self.samples > 1 else 0.5
+            starts.append(round(fraction * last_start))
+        marker_frames = [round(x * item.speed_divisor * item.frame_rate) for x in item.marker_times]
+        marker_frames = [x for x in marker_frames if 0 <= x < frames]
+        if marker_frames and self.marker_samples:
+            # Take markers spread across those available, centring a window on each
+            step = max(1, len(marker_frames) / self.marker_samples)
+            for i in range(min(self.marker_samples, len(marker_frames))):
+                starts.append(min(last_start, max(0, marker_frames[int(i * step)] - length // 2)))
+
+        windows = []
+        for start in sorted(set(starts)):
+            if windows and start <= windows[-1][1]:
+                # Overlapping windows are rendered as one
+                windows[-1] = (windows[-1][0], max(windows[-1][1], start + length - 1))
+            else:
+                windows.append((start, start + length - 1))
+        return windows
+
+    def check_resolution(self, item, scan_result):
+        """Reason the scan of a preflight output shows it is unusable, or None."""
+        if not scan_result['valid']:
+            return scan_result['message']
+        geometry = scan_result.get('video', {}).get('Title0', {}).get('Geometry', {})
+        width, height = geometry.get('Width'), geometry.get('Height')
+        if (width, height) != (item.width, item.height):
+            return f"rendered at {width}x{height} instead of {item.width}x{item.height}"
+        return None
+
+    def check_speed(self, frame_intervals):
+        """Reason the seconds per frame are too slow, or None."""
+        if frame_intervals and self.max_seconds_per_frame and \
+                statistics.median(frame_intervals) > self.max_seconds_per_frame:
+            return f"{statistics.median(frame_intervals):.1f}s per frame exceeds the limit of " \
+                   f"{self.max_seconds_per_frame:.1f}s"
+        return None
@@ -0,0 +1,65 @@
+import logging
+import os
+
+import psutil
+
+LOGGER = logging.getLogger('process_placement')
+LOGGER.setLevel(level=logging.DEBUG)
+
+# Windows priority classes, and the nice values used for them elsewhere
+PRIORITY_NAMES = ['idle', 'below_normal', 'normal', 'above_normal', 'high']
+POSIX_NICE = dict(idle=19, below_normal=10, normal=0, above_normal=-5, high=-10)
+
+
+def priority_value(priority):
+    if priority not in PRIORITY_NAMES:
+        raise ValueError(f"Unknown process priority {priority}, expected one of {PRIORITY_NAMES}")
+    if os.name == 'nt':
+        return getattr(psutil, f"{priority.upper()}_PRIORITY_CLASS")
+    return POSIX_NICE[priority]
+
+
+def cpu_partitions(count, reserved_cpus=0):
+    """Split the logical CPUs into count contiguous sets, leaving the last reserved_cpus out of all of them.
+
+    With fewer CPUs than sets, some sets share CPUs.
+    """
+    cpus = list(range(psutil.cpu_count(logical=True) or 1))
+    usable = cpus[:max(count, len(cpus) - reserved_cpus)]
+    size = max(1, len(usable) // count)
+    return [[usable[(i * size + j) % len(usable)] for j in range(size)] for i in range(count)]
+
+
+class ProcessPlacement:
+    """CPU affinity and priority applied to external processes as they are discovered."""
+
+    def __init__(self, affinity=None, priority=None):
+        self.affinity = affinity
+        self.priority = priority
+        self.applied_pids = set()
+
+    def __bool__(self):
+        return bool(self.affinity or self.priority)
+
+    def apply(self, pids):
+        for pid in pids:
+            if pid in self.applied_pids:
+                continue
+            self.applied_pids.add(pid)
+            try:
+                process = psutil.Process(pid)
+                if self.affinity and hasattr(process, 'cpu_affinity'):
+                    process.cpu_affinity(self.affinity)
+                if self.priority:
+                    process.nice(priority_value(self.priority))
+                LOGGER.debug("Placed %s (pid %d) on CPUs %s at %s priority", process.name(), pid,
+                             self.affinity or 'all', self.priority or 'default')
+            except (psutil.NoSuchProcess, ProcessLookupError):
+                pass
+            except psutil.AccessDenied as exc:
+                LOGGER.warning("Unable to set the affinity or priority of pid %d: %s", pid, exc)
+
+
+def set_own_priority(priority):
+    if priority:
+        ProcessPlacement(priority=priority).apply([os.getpid()])
@@ -0,0 +1,161 @@
+import collections
+import contextlib
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+
+import text_table
+
+LOGGER = logging.getLogger('profiling')
+LOGGER.setLevel(level=logging.DEBUG)
+
+
+class StackSampler:
+    """Samples the stacks of all Python threads at a fixed interval, producing collapsed stacks for flame graphs."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.counts = collections.Counter()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='stack_sampler', daemon=True)
+
+    def run(self):
+        own_ident = threading.get_ident()
+        while not self.stopping.wait(self.interval):
+            for thread_ident, frame in sys._current_frames().items():
+                if thread_ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                self.counts[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self, output_path):
+        self.stopping.set()
+        self.thread.join()
+        with open(output_path, 'w', encoding='utf-8') as file:
+            for stack, count in self.counts.most_common():
+                file.write(f"{stack} {count}\n")
+        LOGGER.info("Wrote %d sampled stacks to %s", sum(self.counts.values()), output_path)
+
+
+class Profiler:
+    """Records timing spans for each stage of a run and writes them as a Chrome trace (chrome://tracing, Perfetto)."""
+    ENABLED = False
+    lock = threading.Lock()
+    events = []
+    thread_names = {}
+    origin = time.perf_counter()
+    python_profile = None
+    python_profiler = None
+    trace_path = None
+    listeners = []
+
+    @classmethod
+    def enable(cls, trace_path, python_profile=None):
+        cls.ENABLED = True
+        cls.trace_path = trace_path
+        cls.python_profile = python_profile
+        cls.origin = time.perf_counter()
+        if python_profile == 'cprofile':
+            cls.python_profiler = cProfile.Profile()
+            cls.python_profiler.enable()
+        elif python_profile == 'sample':
+            cls.python_profiler = StackSampler()
+            cls.python_profiler.start()
+        LOGGER.info("Profiling enabled, trace will be written to %s", trace_path)
+
+    @classmethod
+    def add_listener(cls, listener):
+        """Also report spans, even when profiling is off, to an object with span_started and span_finished."""
+        cls.listeners.append(listener)
+
+    @classmethod
+    @contextlib.contextmanager
+    def span(cls, name, item=None, **args):
+        if not cls.ENABLED and not cls.listeners:
+            yield
+            return
+
+        for listener in cls.listeners:
+            listener.span_started(name, item)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            for listener in cls.listeners:
+                listener.span_finished(name, item, end - start)
+            if cls.ENABLED:
+                event = dict(name=name, cat=item or 'run', ph='X', pid=os.getpid(), tid=threading.get_ident(),
+                             ts=round((start - cls.origin) * 1e6), dur=round((end - start) * 1e6),
+                             args=dict(args, item=item) if item else args)
+                with cls.lock:
+                    cls.events.append(event)
+                    cls.thread_names[event['tid']] = threading.current_thread().name
+
+    @staticmethod
+    def item_key(path_maker, item_name):
+        """Span item for an item, qualified by its division so that batch runs keep same-named items apart."""
+        if path_maker is None:
+            return item_name
+        return f"{path_maker.project_name()}/{item_name}"
+
+    @classmethod
+    def item_breakdown(cls, item):
+        breakdown = collections.defaultdict(float)
+        with cls.lock:
+            for event in cls.events:
+                if event['cat'] == item:
+                    breakdown[event['name']] += event['dur'] / 1e6
+        return {name: round(seconds, 3) for name, seconds in breakdown.items()}
+
+    @classmethod
+    def summary(cls):
+        stages = collections.defaultdict(list)
+        with cls.lock:
+            for event in cls.events:
+                stages[event['name']].append(event['dur'] / 1e6)
+
+        columns = ['stage', 'count', 'total_s', 'mean_s', 'max_s']
+        rows = [[name, str(len(durations)), f"{sum(durations):.3f}", f"{sum(durations) / len(durations):.3f}",
+                 f"{max(durations):.3f}"]
+                for name, durations in sorted(stages.items(), key=lambda x: -sum(x[1]))]
+        return text_table.format_table(columns, rows)
+
+    @classmethod
+    def finish(cls):
+        if not cls.ENABLED:
+            return
+
+        with cls.lock:
+            thread_names = [dict(name='thread_name', ph='M', pid=os.getpid(), tid=tid, args=dict(name=name))
+                            for tid, name in cls.thread_names.items()]
+            trace = dict(traceEvents=thread_names + cls.events, displayTimeUnit='ms')
+        with open(cls.trace_path, 'w', encoding='utf-8') as file:
+            json.dump(trace, file)
+        LOGGER.info("Wrote %d spans to %s", len(cls.events), cls.trace_path)
+
+        if cls.events:
+            LOGGER.info("Stage timings:\n\n%s\n", cls.summary())
+
+        if cls.python_profile == 'cprofile':
+            cls.python_profiler.disable()
+            profile_path = os.path.splitext(cls.trace_path)[0] + '.prof'
+            cls.python_profiler.dump_stats(profile_path)
+            summary = io.StringIO()
+            pstats.Stats(cls.python_profiler, stream=summary).sort_stats('cumulative').print_stats(30)
+            LOGGER.info("cProfile output written to %s, top functions:\n%s", profile_path, summary.getvalue())
+        elif cls.python_profile == 'sample':
+            cls.python_profiler.stop(os.path.splitext(cls.trace_path)[0] + '.stacks.txt')
@@ -0,0 +1,245 @@
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+LOGGER = logging.getLogger('prores_cache')
+LOGGER.setLevel(level=logging.DEBUG)
+
+
+class ScratchSpaceError(Exception):
+    pass
+
+
+class ProResCache:
+    """Treats the ProRes scratch directory as a cache with a byte budget.
+
+    Files are evicted least-recently-used first, with released files (those already encoded when
+    delete_intermediate_on_success is set) going before anything else.  Deletion happens on a
+    background reclaimer thread and only when space is needed, either to admit a new render or to
+    bring the cache back under budget.
+    """
+    INDEX_FILENAME = 'prores_cache_index.json'
+    DELETE_RETRY_SECONDS = 1.0
+    DELETE_ATTEMPTS = 12
+
+    def __init__(self, scratch_root, budget_bytes=None, reserve_bytes=0):
+        self.scratch_root = scratch_root
+        self.budget_bytes = budget_bytes
+        self.reserve_bytes = reserve_bytes
+        self.index_path = os.path.join(scratch_root, self.INDEX_FILENAME)
+
+        self.lock = threading.Condition()
+        self.entries = {}
+        self.in_use = {}
+        self.pending_deletes = {}
+        # Shortfall of each admit waiting for space, by path
+        self.bytes_wanted = {}
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run_reclaimer, name='prores_reclaimer', daemon=True)
+
+        self.load_index()
+
+    @classmethod
+    def from_env(cls, env):
+        budget_gb = env.get('smr_scratch_prores_budget_gb')
+        reserve_gb = env.get('smr_scratch_prores_reserve_gb', 10)
+        return cls(env['smr_scratch_prores'],
+                   budget_bytes=int(budget_gb * 1024 ** 3) if budget_gb else None,
+                   reserve_bytes=int(reserve_gb * 1024 ** 3))
+
+    @staticmethod
+    def expected_prores_bytes(params, seconds=None):
+        # Bitrates are in kbps, as for HandBrake
+        return int(params.render.ae.prores_bitrate * 1000 / 8 * (params.item.duration if seconds is None else seconds))
+
+    def load_index(self):
+        index = {}
+        if os.path.isfile(self.index_path):
+            try:
+                with open(self.index_path, 'r', encoding='utf-8') as file:
+                    index = json.load(file)
+            except (OSError, ValueError) as exc:
+                LOGGER.warning("Ignoring unreadable cache index %s: %s", self.index_path, exc)
+
+        for dir_path, _, filenames in os.walk(self.scratch_root):
+            for filename in filenames:
+                if not filename.endswith('.mov'):
+                    continue
+                path = os.path.abspath(os.path.join(dir_path, filename))
+                entry = index.get(path, {})
+                self.entries[path] = dict(
+                    last_used=entry.get('last_used', os.path.getmtime(path)),
+                    released=entry.get('released', False),
+                    size=os.path.getsize(path)
+                )
+        LOGGER.info("ProRes cache holds %d files, %.2fGB, budget %s", len(self.entries),
+                    self.cached_bytes() / 1024 ** 3,
+                    f"{self.budget_bytes / 1024 ** 3:.2f}GB" if self.budget_bytes else "unlimited")
+
+    def save_index(self):
+        os.makedirs(self.scratch_root, exist_ok=True)
+        temp_path = self.index_path + '.tmp'
+        with self.lock:
+            index = {path: dict(last_used=entry['last_used'], released=entry['released'])
+                     for path, entry in self.entries.items()}
+            with open(temp_path, 'w', encoding='utf-8') as file:
+                json.dump(index, file, indent=2)
+            os.replace(temp_path, self.index_path)
+
+    def start(self):
+        self.thread.start()
+
+    def close(self):
+        with self.lock:
+            self.stopping = True
+            self.lock.notify_all()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.save_index()
+
+    def cached_bytes(self):
+        return sum(entry['size'] for entry in self.entries.values())
+
+    def touch(self, path, released=False):
+        path = os.path.abspath(path)
+        with self.lock:
+            if not os.path.isfile(path) or path in self.pending_deletes:
+                return
+            self.entries[path] = dict(last_used=time.time(), released=released, size=os.path.getsize(path))
+        self.save_index()
+
+    def release(self, path):
+        """Mark a file as no longer needed; it is deleted first when space is wanted."""
+        LOGGER.info("Released intermediate file for deferred deletion: %s", path)
+        self.touch(path, released=True)
+        with self.lock:
+            self.lock.notify_all()
+
+    def discard(self, path):
+        """Delete a file (e.g. an incomplete render) on the reclaimer thread."""
+        path = os.path.abspath(path)
+        with self.lock:
+            self.entries.pop(path, None)
+            if os.path.exists(path):
+                self.pending_deletes[path] = self.DELETE_ATTEMPTS
+                self.lock.notify_all()
+
+    def use(self, path, expected_bytes=0):
+        """Context manager that admits a render of expected_bytes to path and pins it until exit."""
+        cache = self
+
+        class _InUse:
+            def __enter__(self):
+                cache.admit(path, expected_bytes)
+
+            def __exit__(self, exc_type, exc_val, exc_tb):
+                cache.finish(path)
+
+        return _InUse()
+
+    def admit(self, path, expected_bytes, timeout=600):
+        """Block until there is space for expected_bytes at path, or raise ScratchSpaceError."""
+        path = os.path.abspath(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            # A stale file at the same path must be gone before AE starts writing there
+            if expected_bytes and path in self.entries:
+                del self.entries[path]
+                self.pending_deletes[path] = self.DELETE_ATTEMPTS
+            try:
+                while True:
+                    shortfall = self.shortfall(path, expected_bytes)
+                    if shortfall <= 0 and path not in self.pending_deletes:
+                        break
+                    if not self.evictable() and not self.pending_deletes:
+                        raise ScratchSpaceError(
+                            f"Not enough scratch space for {path}: need {expected_bytes / 1024 ** 3:.2f}GB, "
+                            f"short by {shortfall / 1024 ** 3:.2f}GB with nothing left to evict")
+                    if time.monotonic() > deadline:
+                        raise ScratchSpaceError(f"Timed out waiting for scratch space for {path}")
+                    self.bytes_wanted[path] = max(shortfall, 0)
+                    self.lock.notify_all()
+                    self.lock.wait(timeout=5.0)
+            finally:
+                self.bytes_wanted.pop(path, None)
+            self.in_use[path] = expected_bytes
+        if expected_bytes:
+            LOGGER.info("Admitted render of %.2fGB to %s", expected_bytes / 1024 ** 3, path)
+
+    def finish(self, path):
+        path = os.path.abspath(path)
+        with self.lock:
+            self.in_use.pop(path, None)
+            released = self.entries.get(path, {}).get('released', False)
+        self.touch(path, released=released)
+
+    def shortfall(self, path, expected_bytes):
+        # Renders already admitted will keep growing until they reach their expected size
+        outstanding = 0
+        for other_path, other_bytes in self.in_use.items():
+            if other_path != path and other_bytes:
+                current_size = os.path.getsize(other_path) if os.path.exists(other_path) else 0
+                outstanding += max(other_bytes - current_size, 0)
+        free = shutil.disk_usage(os.path.dirname(path)).free
+        shortfall = expected_bytes + outstanding + self.reserve_bytes - free
+        if self.budget_bytes:
+            shortfall = max(shortfall, self.cached_bytes() + expected_bytes - self.budget_bytes)
+        return shortfall
+
+    def evictable(self):
+        candidates = [(not entry['released'], entry['last_used'], path) for path, entry in self.entries.items()
+                      if path not in self.in_use and path not in self.pending_deletes]
+        return [path for _, _, path in sorted(candidates)]
+
+    def run_reclaimer(self):
+        while True:
+            with self.lock:
+                if self.stopping and not self.pending_deletes:
+                    return
+                over_budget = self.budget_bytes and self.cached_bytes() > self.budget_bytes
+                # Summed, as each waiting admit needs its own shortfall freed
+                wanted = sum(self.bytes_wanted.values())
+                if not self.pending_deletes and (wanted > 0 or over_budget):
+                    if over_budget:
+                        wanted = max(wanted, self.cached_bytes() - self.budget_bytes)
+                    for path in self.evictable():
+                        if wanted <= 0:
+                            break
+                        wanted -= self.entries.pop(path)['size']
+                        self.pending_deletes[path] = self.DELETE_ATTEMPTS
+                deletes = list(self.pending_deletes.keys())
+                if not deletes:
+                    self.lock.wait(timeout=30.0)
+                    continue
+
+            for path in deletes:
+                self.delete_file(path)
+            with self.lock:
+                self.lock.notify_all()
+            self.save_index()
+
+    def delete_file(self, path):
+        try:
+            if os.path.exists(path):
+                file_size_gb = os.path.getsize(path) / 1024 ** 3
+                os.remove(path)
+                LOGGER.info(f"Reclaimed {file_size_gb:.2f}GB from {path}")
+            with self.lock:
+                self.pending_deletes.pop(path, None)
+        except PermissionError as exc:
+            with self.lock:
+                if path not in self.pending_deletes:
+                    # Already deleted or given up on by another thread
+                    return
+                attempts_left = self.pending_deletes.pop(path) - 1
+                if attempts_left > 0:
+                    self.pending_deletes[path] = attempts_left
+            if attempts_left <= 0:
+                LOGGER.error(f"Giving up deleting {path}: {exc}")
+            else:
+                LOGGER.warning(f"Attempt to delete {path} failed, will retry: {exc}")
+                time.sleep(self.DELETE_RETRY_SECONDS)
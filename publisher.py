@@ -0,0 +1,148 @@
+import errno
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+
+LOGGER = logging.getLogger('publisher')
+LOGGER.setLevel(level=logging.DEBUG)
+
+COPY_CHUNK_BYTES = 64 * 1024 * 1024
+# Windows reports a cross-volume rename as ERROR_NOT_SAME_DEVICE rather than EXDEV
+WINDOWS_ERROR_NOT_SAME_DEVICE = 17
+
+
+def fsync_dir(dir_path):
+    """Make a rename durable on POSIX.  Windows cannot open directories, and NTFS journals renames anyway."""
+    if os.name != 'posix':
+        return
+    dir_fd = os.open(dir_path, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def kernel_copy(source_file, dest_file, size):
+    """Copy with copy_file_range or sendfile so the data does not pass through Python, where available."""
+    for copy_function in (getattr(os, 'copy_file_range', None), getattr(os, 'sendfile', None)):
+        if copy_function is None:
+            continue
+        offset = 0
+        try:
+            while offset < size:
+                if copy_function is os.sendfile:
+                    copied = os.sendfile(dest_file.fileno(), source_file.fileno(), offset, COPY_CHUNK_BYTES)
+                else:
+                    copied = os.copy_file_range(source_file.fileno(), dest_file.fileno(), COPY_CHUNK_BYTES,
+                                                offset, offset)
+                if copied == 0:
+                    break
+                offset += copied
+            return copy_function.__name__
+        except OSError as exp:
+            if offset or exp.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                                           errno.EBADF, errno.ENOTSOCK):
+                raise
+    source_file.seek(0)
+    shutil.copyfileobj(source_file, dest_file, COPY_CHUNK_BYTES)
+    return 'copyfileobj'
+
+
+def publish_file(source_path, dest_path):
+    """Move a finished file into place so that dest_path is either absent, the old file or the complete new one."""
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+    try:
+        os.replace(source_path, dest_path)
+        return 'rename'
+    except OSError as exp:
+        if exp.errno != errno.EXDEV and getattr(exp, 'winerror', None) != WINDOWS_ERROR_NOT_SAME_DEVICE:
+            raise
+
+    dest_dir, dest_name = os.path.split(dest_path)
+    partial_path = os.path.join(dest_dir, f".{dest_name}.partial")
+    try:
+        size = os.path.getsize(source_path)
+        with open(source_path, 'rb') as source_file, open(partial_path, 'wb') as dest_file:
+            method = kernel_copy(source_file, dest_file, size)
+            dest_file.flush()
+            os.fsync(dest_file.fileno())
+        if os.path.getsize(partial_path) != size:
+            raise OSError(f"Copied {os.path.getsize(partial_path)} of {size} bytes to {partial_path}")
+        os.replace(partial_path, dest_path)
+        fsync_dir(dest_dir)
+    except BaseException:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    os.remove(source_path)
+    return method
+
+
+class PublishTask:
+    def __init__(self, job_name, source_path, dest_path):
+        self.job_name = job_name
+        self.source_path = source_path
+        self.dest_path = dest_path
+        self.exception = None
+        self.done = threading.Event()
+
+
+class Publisher:
+    """Moves encoded files from local scratch to their final location on a background thread.
+
+    A rename is used when scratch and final share a filesystem, otherwise a kernel-side copy to a hidden
+    partial file, fsync and rename, so the final directory never contains a partly written output.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.task_queue = queue.Queue()
+        self.tasks = []
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='publisher', daemon=True)
+        self.thread.start()
+        return self
+
+    def publish(self, job_name, source_path, dest_path):
+        task = PublishTask(job_name, source_path, dest_path)
+        with self.lock:
+            self.tasks.append(task)
+        self.task_queue.put(task)
+        LOGGER.info("Queued publish of %s to %s", source_path, dest_path)
+        return task
+
+    def run(self):
+        while True:
+            task = self.task_queue.get()
+            if task is None:
+                break
+            start_time = time.monotonic()
+            try:
+                size_gb = os.path.getsize(task.source_path) / (1024 * 1024 * 1024)
+                method = publish_file(task.source_path, task.dest_path)
+                LOGGER.info("Published %s (%.2fGB) by %s in %.1fs", task.dest_path, size_gb, method,
+                            time.monotonic() - start_time)
+            except Exception as exc:
+                LOGGER.error("+++Failed to publish %s to %s: %s", task.source_path, task.dest_path, exc)
+                task.exception = exc
+            finally:
+                task.done.set()
+
+    def wait(self):
+        """Wait for every queued publish, returning the ones that failed.  Their files stay in scratch."""
+        with self.lock:
+            tasks, self.tasks = self.tasks, []
+        for task in tasks:
+            task.done.wait()
+        return [task for task in tasks if task.exception]
+
+    def close(self):
+        if self.thread:
+            self.task_queue.put(None)
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,185 @@
+# python 3.12
+import argparse
+import json
+import logging
+import re
+import socket
+import socketserver
+import sys
+import threading
+
+LOGGER = logging.getLogger('render_control')
+LOGGER.setLevel(level=logging.DEBUG)
+USAGE_DESCRIPTION = '''
+Sends a command to a running sloerender.py started with --control-port.
+Commands:
+  status                       show the run state, queued items and encode slots
+  pause / resume               hold or allow the launch of new renders and encodes
+  drain                        let running stages finish, then stop, leaving queued work for the next run
+  stop                         stop after the current item, as stop.txt does
+  slots TOTAL [ENCODER=N ...]  change the encode pool slot limits
+  prioritise REGEXP            move queued items and encodes whose names match to the front
+  deprioritise REGEXP          move them to the back
+Example of usage:
+python render_control.py --port 8766 drain
+python render_control.py --port 8766 slots 2 nvenc_h265=2 x265=0
+'''
+DEFAULT_PORT = 8766
+
+
+class WorkQueue:
+    """Items still to be started by Render.render_items, which the control channel can reorder."""
+
+    def __init__(self, entries):
+        self.lock = threading.Lock()
+        self.entries = list(entries)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def pop(self):
+        with self.lock:
+            return self.entries.pop(0) if self.entries else None
+
+    def names(self):
+        with self.lock:
+            return [order_item['name'] for _, order_item in self.entries]
+
+    def move(self, pattern, front=True):
+        with self.lock:
+            matching = [x for x in self.entries if re.search(pattern, x[1]['name'])]
+            others = [x for x in self.entries if not re.search(pattern, x[1]['name'])]
+            self.entries = matching + others if front else others + matching
+        return len(matching)
+
+
+class ControlRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline().decode('utf-8').strip()
+        try:
+            response = self.server.control.handle_command(line)
+        except (ValueError, re.error) as exc:
+            response = dict(ok=False, error=str(exc))
+        self.wfile.write((json.dumps(response) + "\n").encode('utf-8'))
+
+
+class RenderControl:
+    """Run state changed by commands on a local TCP port, and checked by the render loop between stages.
+
+    Nothing here interrupts a running aerender or HandBrakeCLI; pause and drain only act before the next
+    launch, so no partially finished output is thrown away.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.resumed = threading.Event()
+        self.resumed.set()
+        self.drain_requested = False
+        self.stop_requested = False
+        self.server = None
+        self.work_queue = None
+        self.encode_pool = None
+
+    def serve(self, port, host='127.0.0.1'):
+        self.server = socketserver.ThreadingTCPServer((host, port), ControlRequestHandler)
+        self.server.daemon_threads = True
+        self.server.control = self
+        threading.Thread(target=self.server.serve_forever, name='render_control', daemon=True).start()
+        LOGGER.info(f"Accepting control commands on {host}:{port}")
+        return self
+
+    def close(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def paused(self):
+        return not self.resumed.is_set()
+
+    def stopping(self):
+        return self.drain_requested or self.stop_requested
+
+    def wait_if_paused(self):
+        if self.paused():
+            LOGGER.info("Paused, waiting for resume")
+            while not self.resumed.wait(timeout=60) and not self.stopping():
+                LOGGER.info("Still paused")
+            if not self.stopping():
+                LOGGER.info("Resumed")
+
+    def status(self):
+        status = dict(ok=True, paused=self.paused(), draining=self.drain_requested, stopping=self.stop_requested,
+                      queued_items=self.work_queue.names() if self.work_queue else [])
+        if self.encode_pool:
+            status['encodes'] = self.encode_pool.status()
+        return status
+
+    def handle_command(self, line):
+        command, *args = line.split(maxsplit=1)
+        args = args[0].split() if args and command == 'slots' else args
+        LOGGER.info("Control command: %s", line)
+
+        if command == 'status':
+            return self.status()
+        if command == 'pause':
+            self.resumed.clear()
+            if self.encode_pool:
+                self.encode_pool.set_paused(True)
+        elif command == 'resume':
+            self.resumed.set()
+            if self.encode_pool:
+                self.encode_pool.set_paused(False)
+        elif command == 'drain':
+            with self.lock:
+                self.drain_requested = True
+            if self.encode_pool:
+                self.encode_pool.drop_pending()
+            self.resumed.set()
+        elif command == 'stop':
+            with self.lock:
+                self.stop_requested = True
+        elif command == 'slots':
+            if not self.encode_pool:
+                raise ValueError("Encodes are not pooled in this run (no encode_slots_total in the environment)")
+            if not args:
+                raise ValueError("slots needs a total, e.g. slots 2 nvenc_h265=2")
+            encoder_slots = {}
+            for arg in args[1:]:
+                encoder, _, count = arg.partition('=')
+                encoder_slots[encoder] = int(count)
+            self.encode_pool.set_slots(int(args[0]), encoder_slots)
+        elif command in ('prioritise', 'deprioritise'):
+            if not args:
+                raise ValueError(f"{command} needs a regexp to match item names")
+            front = command == 'prioritise'
+            moved = self.work_queue.move(args[0], front=front) if self.work_queue else 0
+            if self.encode_pool:
+                moved += self.encode_pool.move(args[0], front=front)
+            LOGGER.info("Moved %d queued items or encodes matching %s to the %s", moved, args[0],
+                        'front' if front else 'back')
+        else:
+            raise ValueError(f"Unknown command {command}")
+        return self.status()
+
+
+def send_command(command, port=DEFAULT_PORT, host='127.0.0.1'):
+    with socket.create_connection((host, port), timeout=10) as connection:
+        connection.sendall((command + "\n").encode('utf-8'))
+        return json.loads(connection.makefile('r', encoding='utf-8').readline())
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=USAGE_DESCRIPTION, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', default=DEFAULT_PORT, type=int)
+    parser.add_argument('command', nargs='+')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    options = parse_args()
+    response = send_command(" ".join(options.command), port=options.port, host=options.host)
+    print(json.dumps(response, indent=2))
+    sys.exit(0 if response.get('ok') else 1)
@@ -1,20 +1,31 @@
+import contextlib
 import datetime
-import json
+import functools
 import logging
 import os
 import queue
 import re
+import statistics
 import time
 from collections import defaultdict
 
 import psutil
 from pydantic import BaseModel
 
+import ae_recycle
+import env_probe
 import file_scanner
+import hb_encode
 import item_params
 import output_params
 import process_wrapper
 import render_params
+import render_store
+from ae_session import AeSession
+from live_metrics import LiveMetrics
+from log_sink import SubprocessLog
+from profiling import Profiler
+from retry_policy import RetryPolicy
 from trackers import Trackers
 
 LOGGER = logging.getLogger('render_job')
@@ -28,91 +39,119 @@ class RenderJobParams(BaseModel):
 
 
 class RenderTimeout(Exception):
-    pass
+    failure_class = 'timeout'
+
+
+class ProcessFailed(Exception):
+    failure_class = 'return_code'
+
+    def __init__(self, message, rc=None):
+        super().__init__(message)
+        self.rc = rc
+
+
+class InvalidOutput(Exception):
+    failure_class = 'invalid_output'
+
+
+class MissingInput(Exception):
+    failure_class = 'missing_input'
+
+
+class PreflightFailed(Exception):
+    failure_class = 'preflight'
+
+
+class RenderCancelled(Exception):
+    failure_class = None
+
+
+class EncodeCancelled(Exception):
+    failure_class = None
 
 
 class RenderJob:
-    def __init__(self, path_maker, job_name, params):
+    def __init__(self, path_maker, job_name, params, prores_cache=None, probe=None, publisher=None,
+                 retry_policy=None, ae_session=None, placement=None, encode_placement=None, preflight=None,
+                 render_store=None, recycle_policy=None, progress_callback=None):
         self.AE_ACTIVITY_TIMEOUT = 300
+        self.ae_session = ae_session
+        self.placement = placement
+        self.encode_placement = encode_placement
         self.path_maker = path_maker
         self.job_name = job_name
         self.params = params
+        self.preflight = preflight
+        self.profile_item = Profiler.item_key(path_maker, params.item.item_name)
+        # Called with the stage and the fraction of it done, e.g. by RenderService
+        self.progress_callback = progress_callback
+        self.prores_cache = prores_cache
+        self.probe = probe
+        self.publisher = publisher
+        self.recycle_policy = recycle_policy
+        self.render_store = render_store
+        self.retry_policy = retry_policy or RetryPolicy()
 
         self.ae_child_pids = None
+        self.ae_error_lines = []
+        self.aerender = None
+        self.ae_log = None
+        self.ae_restarts = 0
+        self.cancelled = False
+        self.encode = None
+        self.encode_seconds = 0.0
+        self.encodes = {}
+        self.execute_end_time = None
+        self.execute_start_time = None
         self.final_scan_result = None
         self.frame_interval_moving_average = 0.0
-        self.hb_iteration = None
-        self.json_capture_on = None
-        self.json_data = None
-        self.json_discard_on = None
+        self.frame_intervals = []
+        self.hb_iterations = defaultdict(int)
         self.last_activity_time = None
         self.last_frame_time = None
+        self.mfr_tags = None
+        self.output_scan_results = {}
+        self.preflight_intervals = []
+        self.preflight_seconds_per_frame = None
+        self.preflight_window = None
         self.prores_scan_result = None
+        self.publish_tasks = []
+        self.render_seconds = 0.0
+        self.reuse_segments = True
+        self.segments_rendered = set()
+        self.segments_reused = 0
         self.start_time = None
+        self.trend_monitor = None
 
     def extract_preferences(self):
-        major, minor = map(int, self.params.render.ae.condensed_version.split("."))
-        base_prefs_path = self.params.render.ae.ae_prefs_path.replace('{user}', os.getenv('USERNAME'))
-        for test_minor in range(minor + 32, minor - 1, -1):
-            test_version = f"{major}.{test_minor}"
-            ae_prefs_path = base_prefs_path.replace('{version}', test_version)
-            if os.path.isfile(ae_prefs_path):
-                LOGGER.info(f"Using AE prefs file {ae_prefs_path} for version {test_version}")
-                break
-        else:
-            raise Exception(
-                f"Unable to find AE preferences file using {base_prefs_path} and {self.params.render.ae.condensed_version}")
-
-        prefs = {}
-        with open(ae_prefs_path, 'r') as f:
-            current_section = None
-            for line in f:
-                if line.strip().startswith('['):
-                    current_section = line.strip(' []"\n')
-                elif current_section == "Concurrent Frame Rendering":
-                    if '=' in line:
-                        key, value = [x.strip().strip('"') for x in line.split('=')]
-                        prefs[key] = value
-
-        tags = {}
-        enable_cfr = prefs.get("Enable Concurrent Frame Renders")
-        num_concurrent_frames = prefs.get("Number of Concurrent Frame Renders")
-        reserved_cpu_power = prefs.get("Reserved CPU Power")
-
-        if reserved_cpu_power and int(reserved_cpu_power) > 10:
-            LOGGER.warning("Bad value for Reserved CPU Power %d", reserved_cpu_power)
-
-        if enable_cfr is None:
-            tags[f"mfr=unknown"] = True
-        elif int(enable_cfr):
-            tags[f"mfr={int(num_concurrent_frames)}"] = True
-        else:
-            tags["mfr=off"] = True
-
-        return tags
+        if self.probe:
+            return dict(self.probe.mfr_tags)
+        return env_probe.read_mfr_tags(env_probe.find_ae_prefs_path(self.params.render.ae))
 
-    def do_aerender(self):
-        aerender_dir = os.path.join(
-            self.params.render.ae.aerender_dir.replace('{ae.major_version}', self.params.render.ae.major_version),
-            'aerender.exe')
+    def hb_command(self):
+        return [self.probe.hb_path] if self.probe else None
 
-        tags = self.extract_preferences()
-        Trackers.add_tags(tags)
+    def aerender_command(self, output_path, output_module_template):
+        if self.probe:
+            aerender_dir = self.probe.aerender_path
+        else:
+            aerender_dir = env_probe.aerender_path(self.params.render.ae)
 
-        prores_path = self.path_maker.prores_path(self.params.item.item_name, mkdir=True)
         project_path = self.path_maker.item_ae_project_path(self.params.item.ae_project)
+        if not os.path.isfile(project_path):
+            raise MissingInput(f"AE project not found: {project_path}")
 
         LOGGER.info(f"Launching aerender.exe to render %s from project %s comp %s",
-                    prores_path, project_path, self.params.item.ae_comp)
+                    output_path, project_path, self.params.item.ae_comp)
         aerender_command = [
             aerender_dir,
             '-v', 'ERRORS_AND_PROGRESS',
             '-project', project_path,
             '-comp', self.params.item.ae_comp,
             '-mem_usage', str(self.params.render.ae.image_cache_percent), str(self.params.render.ae.max_mem_percent),
-            '-output', prores_path,  # self.params.output.destination_path,
+            '-output', output_path,  # self.params.output.destination_path,
             '-RStemplate', self.params.render.ae.render_settings_template,
-            '-OMtemplate', self.params.render.ae.output_module_template
+            '-OMtemplate', output_module_template
         ]
 
         if self.params.render.ae.mfr:
@@ -129,8 +168,203 @@ class RenderJob:
                 '-sound', 'ON'
             ]
 
+        if self.ae_session:
+            aerender_command += self.ae_session.aerender_args(project_path)
+        return aerender_command
+
+    def do_aerender(self):
+        if self.cancelled:
+            raise RenderCancelled(f"Render of {self.job_name} cancelled before starting")
+
+        tags = self.extract_preferences()
+        Trackers.add_tags(tags)
+        self.mfr_tags = tags
+
+        prores_path = self.path_maker.prores_path(self.params.item.item_name, mkdir=True)
+        total_frames = round(self.params.item.duration * self.params.item.frame_rate)
+        if self.recycle_policy and self.recycle_policy.applies(total_frames):
+            render = functools.partial(self.render_segments, prores_path, total_frames)
+            # The segments and the file they are joined into exist together for a while, unless kept segments
+            # are admitted to the cache one by one
+            expected_bytes_factor = 1 if self.recycle_policy.keep_segments else 2
+        else:
+            aerender_command = self.aerender_command(prores_path, self.params.render.ae.output_module_template)
+            render = functools.partial(self.run_aerender, aerender_command, prores_path)
+            expected_bytes_factor = 1
+        if self.prores_cache:
+            with self.prores_cache.use(prores_path,
+                                       expected_bytes_factor * self.prores_cache.expected_prores_bytes(self.params)):
+                render()
+        else:
+            render()
+
+    def render_segments(self, prores_path, total_frames):
+        """Render a long comp in segments, restarting After Effects between them as it slows, then join them."""
+        item_name = self.params.item.item_name
+        manifest = None
+        if self.recycle_policy.keep_segments:
+            markers = ae_recycle.marker_frames(self.params.item)
+            segments = self.recycle_policy.segments(total_frames, markers)
+            manifest, reusable = self.kept_segments(segments, markers)
+        else:
+            segments = self.recycle_policy.segments(total_frames)
+            reusable = set()
+
+        owns_session = self.recycle_policy.reuse and not self.ae_session
+        if owns_session:
+            self.ae_session = AeSession()
+        segment_paths = []
+        # Kept segments are cached files in their own right, pinned until they have been joined
+        pinned = contextlib.ExitStack()
+        try:
+            for start_frame, end_frame in segments:
+                segment_path = self.path_maker.segment_path(item_name, start_frame, mkdir=True)
+                segment_paths.append(segment_path)
+                reuse = segment_path in self.segments_rendered or os.path.basename(segment_path) in reusable
+                if manifest is not None and self.prores_cache:
+                    expected_bytes = 0 if reuse else self.prores_cache.expected_prores_bytes(
+                        self.params, (end_frame + 1 - start_frame) / self.params.item.frame_rate)
+                    pinned.enter_context(self.prores_cache.use(segment_path, expected_bytes))
+                if reuse and os.path.isfile(segment_path):
+                    # Rendered by an earlier attempt of this job, or an earlier render of the item
+                    continue
+                if self.cancelled:
+                    raise RenderCancelled(f"Render of {self.job_name} cancelled")
+
+                # Without a session each segment starts a new After Effects
+                if self.trend_monitor is None or not self.ae_session:
+                    self.trend_monitor = self.recycle_policy.monitor()
+                aerender_command = self.aerender_command(segment_path, self.params.render.ae.output_module_template)
+                aerender_command += [
+                    '-s', str(start_frame),
+                    '-e', str(end_frame)
+                ]
+                self.run_aerender(aerender_command, segment_path)
+                self.segments_rendered.add(segment_path)
+                if manifest is not None:
+                    manifest.add(os.path.basename(segment_path),
+                                 ae_recycle.segment_fingerprint(self.params, start_frame, end_frame, markers))
+
+                reason = self.trend_monitor.reason()
+                if reason and self.ae_session and end_frame < total_frames - 1:
+                    self.ae_restarts += 1
+                    LOGGER.info("Restarting After Effects after frame %d of %s: %s", end_frame, item_name, reason)
+                    Trackers.report_scalar("After Effects restarts", "Restarts", self.ae_restarts, end_frame)
+                    self.ae_session.close()
+                    self.trend_monitor = None
+        except BaseException:
+            pinned.close()
+            raise
+        finally:
+            self.trend_monitor = None
+            if owns_session:
+                self.ae_session.close()
+                self.ae_session = None
+
+        with pinned, Profiler.span('join_segments', item=self.profile_item):
+            rc = ae_recycle.join_segments(self.recycle_policy.ffmpeg_path, segment_paths, prores_path, self.job_name)
+        if rc != 0:
+            self.delete_on_failure(prores_path)
+            raise ProcessFailed(f"ffmpeg exited with rc={rc} joining {len(segment_paths)} segments", rc=rc)
+        LOGGER.info("Joined %d segments of %s with %d restarts of After Effects", len(segment_paths), item_name,
+                    self.ae_restarts)
+        if manifest is None:
+            for segment_path in segment_paths:
+                os.remove(segment_path)
+        self.segments_rendered.clear()
+
+    def kept_segments(self, segments, markers):
+        """Load the manifest of the item's kept segments, returning it and the names of those still usable."""
+        item_name = self.params.item.item_name
+        project_path = self.path_maker.item_ae_project_path(self.params.item.ae_project)
+        if not os.path.isfile(project_path):
+            raise MissingInput(f"AE project not found: {project_path}")
+        project = ae_recycle.project_stamp(project_path)
+        manifest = ae_recycle.SegmentManifest(self.path_maker.segment_manifest_path(item_name, mkdir=True)).load()
+        fingerprints = {os.path.basename(self.path_maker.segment_path(item_name, start_frame)):
+                        ae_recycle.segment_fingerprint(self.params, start_frame, end_frame, markers)
+                        for start_frame, end_frame in segments}
+        if manifest.segments and manifest.project != project:
+            LOGGER.info("%s has changed since the kept segments of %s were rendered, so all will be rendered again",
+                        project_path, item_name)
+        reusable = manifest.reusable(fingerprints, project) if self.reuse_segments else set()
+        # Those kept from here on are this job's own, so a retry can use them even when forced
+        self.reuse_segments = True
+        segments_dir = os.path.dirname(manifest.manifest_path)
+        reusable = {name for name in reusable if os.path.isfile(os.path.join(segments_dir, name))}
+
+        for name in manifest.update(project, reusable):
+            if name not in fingerprints:
+                # From boundaries that have since moved
+                segment_path = os.path.join(segments_dir, name)
+                if self.prores_cache:
+                    self.prores_cache.discard(segment_path)
+                elif os.path.exists(segment_path):
+                    os.remove(segment_path)
+        self.segments_reused = len(reusable)
+        LOGGER.info("Reusing %d of %d kept segments of %s", len(reusable), len(fingerprints), item_name)
+        return manifest, reusable
+
+    def do_preflight(self):
+        """Render sampled windows of frames, failing if any is unusable or too slow, and estimate seconds per frame."""
+        if self.cancelled:
+            raise RenderCancelled(f"Render of {self.job_name} cancelled before starting")
+        item = self.params.item
+        output_module_template = self.params.render.ae.preflight_output_module_template or \
+            self.params.render.ae.output_module_template
+        self.preflight_intervals = []
+        for start_frame, end_frame in self.preflight.windows(item):
+            preflight_path = self.path_maker.preflight_path(item.item_name, start_frame, mkdir=True)
+            aerender_command = self.aerender_command(preflight_path, output_module_template) + [
+                '-s', str(start_frame),
+                '-e', str(end_frame)
+            ]
+            self.preflight_window = (start_frame, end_frame)
+            try:
+                self.run_aerender(aerender_command, preflight_path)
+            except (ProcessFailed, RenderTimeout) as exc:
+                reason = "; ".join(self.ae_error_lines[-3:]) or str(exc)
+                raise PreflightFailed(f"Preflight of frames {start_frame}-{end_frame} failed: {reason}") from exc
+            finally:
+                self.preflight_window = None
+
+            try:
+                scan_result = file_scanner.FileScanner(preflight_path, f"Preflight {item.item_name}", self.params,
+                                                       hb_command=self.hb_command()).scan_video()
+            finally:
+                if os.path.exists(preflight_path):
+                    os.remove(preflight_path)
+            reason = self.preflight.check_resolution(item, scan_result) or \
+                self.preflight.check_speed(self.preflight_intervals)
+            if reason:
+                raise PreflightFailed(f"Preflight of frames {start_frame}-{end_frame} {reason}")
+
+        if self.preflight_intervals:
+            self.preflight_seconds_per_frame = statistics.median(self.preflight_intervals)
+            frames = round(item.duration * item.frame_rate)
+            LOGGER.info("Preflight of %s passed at %.2fs per frame, estimating %s for %d frames", self.job_name,
+                        self.preflight_seconds_per_frame,
+                        datetime.timedelta(seconds=int(self.preflight_seconds_per_frame * frames)), frames)
+            Trackers.report_scalar("Preflight", "Estimated After Effects seconds per frame",
+                                   self.preflight_seconds_per_frame, 0)
+
+    def run_aerender(self, aerender_command, prores_path):
+        self.ae_log = SubprocessLog.sink(f"{self.job_name} aerender", LOGGER)
+        start_time = time.monotonic()
+        try:
+            self.service_aerender_process(aerender_command, prores_path)
+        finally:
+            self.render_seconds += time.monotonic() - start_time
+            self.ae_log.close()
+            LiveMetrics.render_finished(self.params.item.item_name)
+
+    def service_aerender_process(self, aerender_command, prores_path):
         aerender = process_wrapper.ProcessWrapper(aerender_command)
-        self.ae_child_pids = []
+        self.aerender = aerender
+        # A reused After Effects instance is not a child of this aerender, so start from the session's
+        self.ae_child_pids = list(self.ae_session.ae_pids) if self.ae_session else []
+        self.ae_error_lines = []
+        self.last_frame_time = None
         aerender.run()
         self.start_time = time.monotonic()
         self.last_activity_time = time.monotonic()
@@ -152,22 +386,38 @@ class RenderJob:
 
         except (Exception, KeyboardInterrupt) as exp:
             aerender.kill(extra_pids=self.ae_child_pids)
+            if self.ae_session:
+                self.ae_session.failed(killed=True)
             self.delete_on_failure(prores_path)
             raise
 
+        # Each call takes at most 100 lines, so drain whatever is left after the process exits
         self.service_aerender_job(aerender)
+        while not aerender.output_queue.empty():
+            self.service_aerender_job(aerender)
 
         rc = aerender.get_return_code()
+        if self.cancelled:
+            if self.ae_session:
+                self.ae_session.failed(killed=True)
+            self.delete_on_failure(prores_path)
+            raise RenderCancelled(f"Render of {self.job_name} cancelled")
         if rc == 0:
             LOGGER.info(f"Successful: {self.job_name}")
+            if self.ae_session:
+                self.ae_session.rendered(self.ae_child_pids)
         else:
             LOGGER.error(f"+++RETURN CODE %s: %s", rc, self.job_name)
+            if self.ae_session:
+                self.ae_session.failed()
             self.delete_on_failure(prores_path)
-            raise Exception(f"AE render process exited with rc={rc}")
+            raise ProcessFailed(f"AE render process exited with rc={rc}", rc=rc)
 
     def delete_on_failure(self, output_path):
         if self.params.render.ae.delete_output_on_failure:
-            if os.path.exists(output_path):
+            if self.prores_cache:
+                self.prores_cache.discard(output_path)
+            elif os.path.exists(output_path):
                 for i in range(12):
                     try:
                         os.remove(output_path)
@@ -181,9 +431,18 @@ class RenderJob:
                     raise Exception(f"Failed to delete incomplete output file: {output_path}")
 
     def handle_new_frame(self, seconds, time_str, frame_num):
+        if self.preflight_window:
+            # The first frame of each window includes loading the project, so only later ones are timed
+            if self.last_frame_time is not None:
+                self.preflight_intervals.append(seconds - self.last_frame_time)
+            self.last_frame_time = seconds
+            return
+
+        frame_interval = None
         if self.last_frame_time is not None:
             elapsed_str = str(datetime.timedelta(seconds=int(time.monotonic() - self.start_time)))
             frame_interval = seconds - self.last_frame_time
+            self.frame_intervals.append(frame_interval)
             self.frame_interval_moving_average = 0.9 * self.frame_interval_moving_average + 0.1 * frame_interval
             Trackers.report_scalar("Render performance", "After Effects seconds per frame", frame_interval,
                                    frame_num)
@@ -216,7 +475,28 @@ class RenderJob:
                         LOGGER.info("After Effects process with PID %s no longer active", ae_pid)
                         del self.ae_child_pids[i]
 
+        if self.trend_monitor and frame_interval is not None:
+            self.trend_monitor.observe(self.frame_interval_moving_average,
+                                       self.ae_rss_bytes() if frame_num % 25 == 0 else None)
+
         self.last_frame_time = seconds
+        total_frames = round(self.params.item.duration * self.params.item.frame_rate)
+        LiveMetrics.frame_rendered(self.params.item.item_name, frame_num, total_frames, frame_interval)
+        if self.progress_callback:
+            self.progress_callback('aerender', min(1.0, frame_num / total_frames) if total_frames else None)
+
+    def ae_rss_bytes(self):
+        """Resident memory of the aerender and After Effects processes."""
+        total = 0
+        pids = list(self.ae_child_pids or [])
+        if self.aerender and self.aerender.process:
+            pids.append(self.aerender.process.pid)
+        for pid in pids:
+            try:
+                total += psutil.Process(pid).memory_info().rss
+            except (psutil.NoSuchProcess, psutil.AccessDenied, ProcessLookupError):
+                pass
+        return total
 
     def service_aerender_job(self, aerender):
         is_active = False
@@ -234,151 +514,263 @@ class RenderJob:
                 if match:
                     self.handle_new_frame(seconds=seconds, time_str=match.group(1), frame_num=int(match.group(2)))
                 else:
-                    LOGGER.info(line)
+                    if re.search(r'\berror\b', line, re.IGNORECASE):
+                        self.ae_error_lines.append(line.strip())
+                    self.ae_log.write(stream_label, line)
             else:
-                LOGGER.info(f"{stream_label}: {line}")
+                self.ae_log.write(stream_label, f"{stream_label}: {line}")
 
         ae_pids = aerender.capture_child_pids(r'After\s*(Effects|FX)')
         for ae_pid in [x for x in ae_pids if x not in self.ae_child_pids]:
             LOGGER.info("Captured new After Effects process with PID %d", ae_pid)
             self.ae_child_pids.append(ae_pid)
+        if self.placement and aerender.process:
+            self.placement.apply([aerender.process.pid] + self.ae_child_pids)
 
         return is_active
 
-    def do_hbrender(self):
+    def do_hbrender(self, suffixes=('',)):
+        """Encode the outputs with the given suffixes together, so that they share reads of the ProRes file."""
+        if self.cancelled:
+            raise EncodeCancelled(f"Encode of {self.job_name} cancelled before starting")
 
         prores_path = self.path_maker.prores_path(self.params.item.item_name)
-        final_path = self.path_maker.final_path(self.params.item.item_name, mkdir=True)
-        LOGGER.info(f"Launching HandBrakeCLI to render %s from %s", final_path, prores_path)
-
-        hb_path = os.path.join(self.params.render.hb.hb_dir, 'HandBrakeCLI.exe')
-
-        hb_scan_command = [
-            hb_path,
-            '--ab', str(self.params.render.hb.audio_bitrate),
-            '--enable-hw-decoding', 'nvdec',
-            '--encoder', str(self.params.render.hb.encoder),
-            '--encoder-preset', str(self.params.render.hb.encoder_preset),
-            '--input', prores_path,
-            '--json',
-            '--optimize',
-            '--output', final_path,
-            '--turbo',
-            '--vb', str(self.params.render.hb.bitrate),
-        ]
-
-        handbrakecli = process_wrapper.ProcessWrapper(hb_scan_command)
-        self.json_capture_on = False
-        self.json_discard_on = False
-        self.hb_iteration = 0
-        handbrakecli.run()
-        self.start_time = time.monotonic()
+        if not os.path.isfile(prores_path):
+            raise MissingInput(f"ProRes file not found: {prores_path}")
+        hb_settings = dict(self.params.render.output_profiles())
+        self.encodes = {}
+        for suffix in suffixes:
+            encode_path = self.encode_path(mkdir=True, suffix=suffix)
+            LOGGER.info(f"Launching HandBrakeCLI to render %s from %s", encode_path, prores_path)
+            self.encodes[suffix] = hb_encode.HandbrakeEncode(
+                hb_settings[suffix], prores_path, encode_path, f"{self.job_name}{suffix}",
+                progress_callback=functools.partial(self.handle_handbrakecli_progress, suffix=suffix),
+                hb_command=self.hb_command(), placement=self.encode_placement)
+        self.encode = self.encodes.get('', next(iter(self.encodes.values())))
+        self.hb_iterations.clear()
+        start_time = time.monotonic()
         try:
-            while handbrakecli.is_alive():
-                self.service_handbrakecli_job(handbrakecli)
-                time.sleep(0.5)
-
-        except (Exception, KeyboardInterrupt) as exp:
-            handbrakecli.kill()
-            raise
-
-        self.service_handbrakecli_job(handbrakecli)
-
-        rc = handbrakecli.get_return_code()
-        if rc == 0:
-            LOGGER.info(f"Successful: {self.job_name}")
-            if self.params.render.hb.delete_intermediate_on_success:
+            if self.prores_cache:
+                with self.prores_cache.use(prores_path):
+                    rcs = hb_encode.run_together(list(self.encodes.values()))
+            else:
+                rcs = hb_encode.run_together(list(self.encodes.values()))
+        finally:
+            self.encode_seconds += time.monotonic() - start_time
+            for suffix in suffixes:
+                LiveMetrics.encode_finished(f"{self.params.item.item_name}{suffix}")
+
+        if self.cancelled:
+            for encode in self.encodes.values():
+                if os.path.exists(encode.output_path):
+                    os.remove(encode.output_path)
+                    LOGGER.info(f"Deleted cancelled output file: {encode.output_path}")
+            raise EncodeCancelled(f"Encode of {self.job_name} cancelled")
+
+        if any(rcs):
+            raise ProcessFailed(f"HandBrakeCLI process exited with rc={' '.join(str(rc) for rc in rcs)}",
+                                rc=next(rc for rc in rcs if rc))
+
+    def delete_intermediate(self):
+        prores_path = self.path_maker.prores_path(self.params.item.item_name)
+        with Profiler.span('delete_intermediate', item=self.profile_item):
+            if self.params.render.hb.delete_intermediate_on_success and self.prores_cache:
+                self.prores_cache.release(prores_path)
+            elif self.params.render.hb.delete_intermediate_on_success:
                 file_size_gb = os.path.getsize(prores_path) / (1024 * 1024 * 1024)
                 os.remove(prores_path)
                 LOGGER.info(f"Deleted intermediate file with size {file_size_gb:.2f}GB: {prores_path}")
-        else:
-            LOGGER.error(f"+++RETURN CODE %s: %s", rc, self.job_name)
-            raise Exception(f"HandBrakeCLI process exited with rc={rc}")
 
-    def handle_handbrakecli_progress(self, progress):
+    def handle_handbrakecli_progress(self, progress, suffix=''):
         working = progress.get('Working', defaultdict(lambda: '<Unknown>'))
-        if self.hb_iteration % 10 == 0:
-            LOGGER.info("Rendered %.2f%%, average %.2f fps, current %.2f fps",
+        hb_iteration = self.hb_iterations[suffix]
+        if hb_iteration % 10 == 0:
+            LOGGER.info("Rendered %.2f%%, average %.2f fps, current %.2f fps%s",
                         100 * working.get('Progress', 0),
                         working.get('RateAvg', 0),
-                        working.get('Rate', 0))
+                        working.get('Rate', 0),
+                        f" for {suffix}" if suffix else "")
 
-        Trackers.report_scalar("Encoder performance", "Encoding frames per second",
+        Trackers.report_scalar("Encoder performance", f"Encoding frames per second{suffix}",
                                working.get('Rate', 0),
-                               self.hb_iteration)
+                               hb_iteration)
         Trackers.report_scalar("Encoder performance",
-                               "Encoding average frames per second",
+                               f"Encoding average frames per second{suffix}",
                                working.get('RateAvg', 0),
-                               self.hb_iteration)
+                               hb_iteration)
+        LiveMetrics.encode_progress(f"{self.params.item.item_name}{suffix}", working.get('Progress', 0),
+                                    working.get('Rate', 0), working.get('RateAvg', 0))
+        if self.progress_callback and not suffix:
+            self.progress_callback('handbrake', working.get('Progress', 0))
 
-        self.hb_iteration += 1
-
-    def service_handbrakecli_job(self, handbrakecli):
-
-        while not handbrakecli.output_queue.empty():
-            stream_label, seconds, line = handbrakecli.output_queue.get()
-            if stream_label == 'EXC':
-                raise line
-            if stream_label == 'OUT':
-                if self.json_discard_on:
-                    if line.startswith('}'):  # Use the absense of indent to determine the end
-                        self.json_discard_on = False
-                    # Don't log discarded lines
-                else:
-                    if self.json_capture_on:
-                        self.json_data.append(line.rstrip())
-                        if line.startswith('}'):  # Use the absense of indent to determine the end
-                            self.json_capture_on = False
-                            progress = json.loads("\n".join(self.json_data))
-                            if progress['State'] == 'WORKING':
-                                self.handle_handbrakecli_progress(progress)
-                    else:
-                        match = re.search(r'Progress: \{', line)
-                        if match:
-                            self.json_capture_on = True
-                            self.json_data = ['{']
-                        else:
-                            LOGGER.info(line)
-            else:
-                LOGGER.info("%s", line.rstrip())
+        self.hb_iterations[suffix] += 1
 
     def scan_prores(self):
         prores_path = self.path_maker.prores_path(self.params.item.item_name)
-        prores_scan = file_scanner.FileScanner(prores_path, f"Scan {self.params.item.item_name}", self.params)
-        return prores_scan.scan_video()
-
-    def scan_final(self):
-        final_path = self.path_maker.final_path(self.params.item.item_name)
-        final_scan = file_scanner.FileScanner(final_path, f"Scan {self.params.item.item_name}", self.params)
+        prores_scan = file_scanner.FileScanner(prores_path, f"Scan {self.params.item.item_name}", self.params,
+                                               hb_command=self.hb_command())
+        prores_scan_result = prores_scan.scan_video()
+        if self.prores_cache and prores_scan_result['valid']:
+            self.prores_cache.touch(prores_path)
+        return prores_scan_result
+
+    def scan_final(self, file_path=None):
+        final_path = file_path or self.path_maker.final_path(self.params.item.item_name)
+        final_scan = file_scanner.FileScanner(final_path, f"Scan {self.params.item.item_name}", self.params,
+                                              hb_command=self.hb_command())
         return final_scan.scan_video()
 
-    def execute(self, force_final, force_prores):
-        self.prores_scan_result = self.scan_prores()
-        if not self.prores_scan_result['valid'] or force_prores:
-            try:
-                self.do_aerender()
-            except RenderTimeout:
-                LOGGER.error(f"Retrying due to render timeout")
-                self.do_aerender()
+    def final_path(self, suffix=''):
+        return self.path_maker.final_path(self.params.item.item_name, suffix=suffix)
 
-        self.prores_scan_result = self.scan_prores()
+    def encode_path(self, mkdir=False, suffix=''):
+        """Where HandBrakeCLI writes, which is local scratch when there is a publisher to move it into place."""
+        if self.publisher and self.path_maker.has_scratch_mp4():
+            return self.path_maker.scratch_mp4_path(self.params.item.item_name, mkdir=mkdir, suffix=suffix)
+        return self.path_maker.final_path(self.params.item.item_name, mkdir=mkdir, suffix=suffix)
 
-        if not self.prores_scan_result['valid']:
-            LOGGER.error(f"Failed to create valid ProRes file (retrying): {self.prores_scan_result['message']}")
+    def execute(self, force_final, force_prores):
+        self.execute_render(force_prores=force_prores, force_final=force_final)
+        self.execute_encode(force_final=force_final)
+        return self.prores_scan_result, self.final_scan_result
+
+    def encodes_left_in_scratch(self):
+        """Whether some outputs were encoded to scratch by an earlier run that died before publishing them, and the
+        others are already valid, so that there is nothing left to render."""
+        found = False
+        with Profiler.span('final_check', item=self.profile_item):
+            for suffix, _ in self.params.render.output_profiles():
+                encode_path = self.encode_path(suffix=suffix)
+                if encode_path != self.final_path(suffix) and self.scan_final(encode_path)['valid']:
+                    found = True
+                elif not self.scan_final(self.final_path(suffix))['valid']:
+                    return False
+        return found
+
+    def execute_render(self, force_prores, force_final=False):
+        self.execute_start_time = time.monotonic()
+        # Forcing a render means not trusting kept segments either
+        self.reuse_segments = not force_prores
+        with Profiler.span('prores_scan', item=self.profile_item):
+            self.prores_scan_result = self.scan_prores()
+        if not self.prores_scan_result['valid'] and not force_prores and not force_final and \
+                self.encodes_left_in_scratch():
+            LOGGER.info("Skipping the render of %s as its encodes are waiting in scratch to be published",
+                        self.params.item.item_name)
+            return self.prores_scan_result
+        if not self.prores_scan_result['valid'] or force_prores:
+            if self.render_store:
+                self.render_through_store(force_prores)
+            else:
+                self.render()
+        return self.prores_scan_result
+
+    def render(self):
+        if self.preflight:
+            with Profiler.span('preflight', item=self.profile_item):
+                self.retry_policy.run(self.job_name, 'preflight', self.do_preflight)
+        self.retry_policy.run(self.job_name, 'aerender', self.render_attempt)
+
+    def render_through_store(self, force_prores):
+        """Take the ProRes file from the render store if another item or host rendered it, else render and add it."""
+        item_name = self.params.item.item_name
+        prores_path = self.path_maker.prores_path(item_name, mkdir=True)
+        project_path = self.path_maker.item_ae_project_path(self.params.item.ae_project)
+        if not os.path.isfile(project_path):
+            raise MissingInput(f"AE project not found: {project_path}")
+        key = self.render_store.key(self.params, project_path)
+
+        with self.render_store.lock(key):
+            if not force_prores:
+                with Profiler.span('render_store_fetch', item=self.profile_item):
+                    if self.prores_cache:
+                        with self.prores_cache.use(prores_path, self.prores_cache.expected_prores_bytes(self.params)):
+                            fetched = self.render_store.fetch(key, prores_path)
+                    else:
+                        fetched = self.render_store.fetch(key, prores_path)
+                    if fetched:
+                        self.prores_scan_result = self.scan_prores()
+                if fetched and self.prores_scan_result['valid']:
+                    return
+                if fetched:
+                    LOGGER.warning("Rendering %s again as the copy in the render store is not valid: %s", item_name,
+                                   self.prores_scan_result['message'])
+
+            render_store.unlink_shared(prores_path)
+            self.render()
+            with Profiler.span('render_store_put', item=self.profile_item):
+                self.render_store.put(key, prores_path)
+
+    def render_attempt(self):
+        # Only this attempt's frames, so that a failed one does not skew the seconds per frame in the history
+        self.frame_intervals = []
+        self.frame_interval_moving_average = 0.0
+        with Profiler.span('aerender', item=self.profile_item):
             self.do_aerender()
+        with Profiler.span('prores_rescan', item=self.profile_item):
             self.prores_scan_result = self.scan_prores()
-            if not self.prores_scan_result['valid']:
-                raise Exception(
-                    f"Failed to create valid ProRes file (second attempt): {self.prores_scan_result['message']}")
-
-        self.final_scan_result = self.scan_final()
-
-        if not self.final_scan_result['valid'] or force_final:
-            self.do_hbrender()
-
-        self.final_scan_result = self.scan_final()
-
-        if not self.final_scan_result['valid']:
-            raise Exception(f"Failed to create valid final file: {self.final_scan_result['message']}")
+        if not self.prores_scan_result['valid']:
+            raise InvalidOutput(f"Failed to create valid ProRes file: {self.prores_scan_result['message']}")
+
+    def execute_encode(self, force_final):
+        """Encode every output profile that is missing or invalid, returning the scan of the main output."""
+        item_name = self.params.item.item_name
+        scan_paths = {}
+        suffixes_to_encode = []
+        with Profiler.span('final_check', item=self.profile_item):
+            for suffix, _ in self.params.render.output_profiles():
+                scan_paths[suffix] = self.final_path(suffix)
+                if self.scan_final(scan_paths[suffix])['valid'] and not force_final:
+                    continue
+                scan_paths[suffix] = self.encode_path(suffix=suffix)
+                if scan_paths[suffix] != self.final_path(suffix) and not force_final and \
+                        self.scan_final(scan_paths[suffix])['valid']:
+                    LOGGER.info("Publishing the valid encode of %s%s left in scratch by an earlier run", item_name,
+                                suffix)
+                else:
+                    suffixes_to_encode.append(suffix)
 
-        return self.prores_scan_result, self.final_scan_result
+        if suffixes_to_encode:
+            self.retry_policy.run(self.job_name, 'handbrake',
+                                  functools.partial(self.encode_attempt, suffixes_to_encode, scan_paths))
+            # Only once every output is valid, so that a retry can encode from it again
+            self.delete_intermediate()
+        else:
+            self.scan_outputs(scan_paths)
+
+        for suffix, scan_path in scan_paths.items():
+            if scan_path != self.final_path(suffix):
+                self.publish_tasks.append(self.publisher.publish(f"{self.job_name}{suffix}", scan_path,
+                                                                 self.final_path(suffix)))
+
+        self.execute_end_time = time.monotonic()
+        return self.final_scan_result
+
+    def encode_attempt(self, suffixes, scan_paths):
+        with Profiler.span('handbrake', item=self.profile_item):
+            self.do_hbrender(suffixes)
+        self.scan_outputs(scan_paths)
+
+    def scan_outputs(self, scan_paths):
+        with Profiler.span('final_scan', item=self.profile_item):
+            self.output_scan_results = {suffix: self.scan_final(scan_path) for suffix, scan_path in scan_paths.items()}
+        self.final_scan_result = self.output_scan_results['']
+
+        for suffix, scan_result in self.output_scan_results.items():
+            if not scan_result['valid']:
+                raise InvalidOutput(f"Failed to create valid final file{' ' + suffix if suffix else ''}: "
+                                    f"{scan_result['message']}")
+
+    def total_seconds(self):
+        """Wall time from the start of the render stage to the end of the encode stage, including any queueing."""
+        if self.execute_start_time is None or self.execute_end_time is None:
+            return None
+        return self.execute_end_time - self.execute_start_time
+
+    def cancel(self):
+        self.cancelled = True
+        if self.aerender and self.aerender.is_alive():
+            self.aerender.kill(extra_pids=self.ae_child_pids)
+        for encode in list(self.encodes.values()):
+            if encode.handbrakecli:
+                encode.kill()
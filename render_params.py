@@ -1,7 +1,7 @@
-from typing import Optional
+from typing import List, Optional
 
 import json5
-from pydantic import BaseModel, ConfigDict
+from pydantic import BaseModel, ConfigDict, field_validator
 
 
 class AdobeAfterEffectsSettings(BaseModel):
@@ -17,8 +17,11 @@ class AdobeAfterEffectsSettings(BaseModel):
     multi_machine_settings: Optional[str] = ""
     mfr: Optional[bool] = True
     mfr_max_cpu_percent: Optional[int] = 100
+    prores_bitrate: Optional[int] = 700000
     render_settings_template: str
     output_module_template: str
+    # A cheaper output module for preflight renders, such as ProRes 422 Proxy, still writing .mov at full size
+    preflight_output_module_template: Optional[str] = None
     delete_output_on_failure: bool
 
 
@@ -29,14 +32,51 @@ class HandbrakeSettings(BaseModel):
     audio_sample_rate: Optional[str] = "auto"
     encoder: Optional[str] = "nvenc_h265"
     encoder_preset: Optional[str] = "quality"
+    hw_decoding: Optional[str] = "nvdec"
+    optimize: Optional[bool] = True
+    turbo: Optional[bool] = True
     hb_dir: str
     delete_intermediate_on_success: bool
 
 
+class OutputProfile(BaseModel):
+    """An extra output encoded from the same ProRes intermediate, overriding some of the hb settings."""
+    model_config = ConfigDict(extra='forbid')
+    suffix: str
+    bitrate: Optional[int] = None
+    audio_bitrate: Optional[int] = None
+    audio_sample_rate: Optional[str] = None
+    encoder: Optional[str] = None
+    encoder_preset: Optional[str] = None
+    hw_decoding: Optional[str] = None
+    optimize: Optional[bool] = None
+    turbo: Optional[bool] = None
+
+    def hb_settings(self, hb):
+        return hb.model_copy(update=self.model_dump(exclude={'suffix'}, exclude_none=True))
+
+
 class RenderParams(BaseModel):
     model_config = ConfigDict(extra='forbid')
     ae: AdobeAfterEffectsSettings
     hb: HandbrakeSettings
+    outputs: Optional[List[OutputProfile]] = []
+
+    @field_validator('outputs')
+    @classmethod
+    def check_suffixes(cls, outputs):
+        # Outputs are keyed by suffix, with the main output's empty
+        suffixes = [x.suffix for x in outputs or []]
+        if '' in suffixes:
+            raise ValueError("output suffixes must not be empty, which is the main output's")
+        duplicates = sorted({x for x in suffixes if suffixes.count(x) > 1})
+        if duplicates:
+            raise ValueError(f"output suffixes must be unique, repeated {', '.join(duplicates)}")
+        return outputs
+
+    def output_profiles(self):
+        """(suffix, hb settings) of every output, starting with the main one which has no suffix."""
+        return [('', self.hb)] + [(x.suffix, x.hb_settings(self.hb)) for x in self.outputs or []]
 
     @classmethod
     def from_json5(cls, file_path):
@@ -0,0 +1,181 @@
+import logging
+import queue
+import threading
+import time
+
+import psutil
+
+import process_placement
+from trackers import TrackerRecorder
+
+LOGGER = logging.getLogger('render_pool')
+LOGGER.setLevel(level=logging.DEBUG)
+
+GB = 1024 * 1024 * 1024
+
+
+class RenderTask:
+    def __init__(self, job, force_prores, force_final, encode, tags=None, tracker_ids=(None, None)):
+        self.job = job
+        self.force_prores = force_prores
+        self.force_final = force_final
+        # Called after the render, to decide whether to encode on the same thread
+        self.encode = encode
+        self.tags = tags or {}
+        # ClearML task and MLflow run opened when the item was submitted, to reattach to when it completes
+        self.tracker_ids = tracker_ids
+        self.exception = None
+        self.final_scan_result = None
+        self.recorder = TrackerRecorder()
+        self.slot = None
+        self.thread = None
+
+    def run(self, on_done):
+        try:
+            with self.recorder:
+                self.job.execute_render(force_prores=self.force_prores, force_final=self.force_final)
+                if self.encode():
+                    self.final_scan_result = self.job.execute_encode(force_final=self.force_final)
+        except (Exception, KeyboardInterrupt) as exc:
+            self.exception = exc
+        finally:
+            on_done(self)
+
+    def rss_bytes(self):
+        return self.job.ae_rss_bytes()
+
+
+class RenderPool:
+    """Runs several aerender jobs at once, each confined to its own set of CPUs.
+
+    Like EncodePool, renders run on worker threads that record their tracker calls for the owner to replay
+    from the main thread in collect().  A render is only started while the resident memory of this process
+    tree, plus that expected of one more render, stays within memory_limit_percent of physical memory.
+    """
+
+    def __init__(self, slots, reserved_cpus=0, memory_limit_percent=90, expected_rss_gb=16.0, ae_priority=None):
+        self.slots = slots
+        self.cpu_sets = process_placement.cpu_partitions(slots, reserved_cpus)
+        self.cpu_count = psutil.cpu_count(logical=True) or 1
+        self.memory_limit_bytes = psutil.virtual_memory().total * memory_limit_percent / 100
+        self.expected_rss_bytes = expected_rss_gb * GB
+        self.ae_priority = ae_priority
+        self.lock = threading.Lock()
+        self.pending = []
+        self.running = []
+        self.completed = queue.Queue()
+
+    @classmethod
+    def from_env(cls, env, slots=None):
+        slots = slots or env.get('render_slots', 1)
+        if slots <= 1:
+            return None
+        return cls(slots, reserved_cpus=env.get('render_reserved_cpus', 0),
+                   memory_limit_percent=env.get('render_memory_limit_percent', 90),
+                   expected_rss_gb=env.get('render_expected_rss_gb', 16.0),
+                   ae_priority=env.get('process_priority', {}).get('aerender'))
+
+    def partition_params(self, render_p):
+        """Scale the MFR CPU share and AE memory limit of render params to one slot of the host."""
+        ae = render_p.ae
+        mfr_max_cpu_percent = min(ae.mfr_max_cpu_percent, round(100 * len(self.cpu_sets[0]) / self.cpu_count))
+        max_mem_percent = max(10, ae.max_mem_percent // self.slots)
+        return render_p.model_copy(update=dict(ae=ae.model_copy(update=dict(
+            mfr_max_cpu_percent=mfr_max_cpu_percent, max_mem_percent=max_mem_percent,
+            image_cache_percent=min(ae.image_cache_percent, max_mem_percent)))))
+
+    def submit(self, task):
+        LOGGER.info("Queued render of %s", task.job.job_name)
+        with self.lock:
+            self.pending.append(task)
+        self.dispatch()
+
+    def process_tree_rss(self):
+        root = psutil.Process()
+        total = 0
+        for process in [root] + root.children(recursive=True):
+            try:
+                total += process.memory_info().rss
+            except (psutil.NoSuchProcess, psutil.AccessDenied, ProcessLookupError):
+                pass
+        return total
+
+    def admit(self):
+        """Whether memory allows one more render, learning the expected size from those running."""
+        if not self.running:
+            return True
+        for task in self.running:
+            self.expected_rss_bytes = max(self.expected_rss_bytes, task.rss_bytes())
+        rss_bytes = self.process_tree_rss()
+        if rss_bytes + self.expected_rss_bytes > self.memory_limit_bytes:
+            LOGGER.debug("Holding render: %.1fGB resident plus %.1fGB expected exceeds the %.1fGB limit",
+                         rss_bytes / GB, self.expected_rss_bytes / GB, self.memory_limit_bytes / GB)
+            return False
+        return True
+
+    def dispatch(self):
+        with self.lock:
+            while self.pending and len(self.running) < self.slots and self.admit():
+                task = self.pending.pop(0)
+                task.slot = min(set(range(self.slots)) - {x.slot for x in self.running})
+                task.job.placement = process_placement.ProcessPlacement(affinity=self.cpu_sets[task.slot],
+                                                                        priority=self.ae_priority)
+                self.running.append(task)
+                LOGGER.info("Starting render of %s in slot %d on CPUs %d-%d (%d/%d slots in use)",
+                            task.job.job_name, task.slot, self.cpu_sets[task.slot][0], self.cpu_sets[task.slot][-1],
+                            len(self.running), self.slots)
+                task.thread = threading.Thread(target=task.run, args=(self.task_done,),
+                                               name=f"render-{task.job.job_name}", daemon=True)
+                task.thread.start()
+
+    def task_done(self, task):
+        # Queue the task before it leaves running, so that busy() never misses it
+        with self.lock:
+            self.completed.put(task)
+            self.running.remove(task)
+        self.dispatch()
+
+    def busy(self):
+        """Whether any task is queued, running, or finished but not yet collected."""
+        with self.lock:
+            return bool(self.pending or self.running) or not self.completed.empty()
+
+    def waiting(self):
+        with self.lock:
+            return len(self.pending)
+
+    def full(self):
+        with self.lock:
+            return bool(self.pending) or len(self.running) >= self.slots
+
+    def collect(self, block=False, timeout=None):
+        """Return tasks that have completed since the last call, optionally waiting up to timeout for at least one.
+
+        Waits in steps, re-running the admission check as memory is freed by other processes.
+        """
+        tasks = []
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while block and not tasks and self.busy() and self.completed.empty():
+            step = 1.0 if deadline is None else min(1.0, deadline - time.monotonic())
+            if step <= 0:
+                break
+            try:
+                tasks.append(self.completed.get(timeout=step))
+            except queue.Empty:
+                self.dispatch()
+        while not self.completed.empty():
+            tasks.append(self.completed.get())
+        return tasks
+
+    def cancel_all(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+            running = list(self.running)
+        for task in pending:
+            LOGGER.info("Cancelled queued render of %s", task.job.job_name)
+        for task in running:
+            LOGGER.info("Cancelling running render of %s", task.job.job_name)
+            task.job.cancel()
+        for task in running:
+            task.thread.join()
+        return pending
@@ -0,0 +1,421 @@
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import sqlite3
+import threading
+import traceback
+
+import ae_recycle
+import ae_session
+import division_index
+import division_order
+import env_probe
+import file_scanner
+import host_tuning
+import item_params
+import output_params
+import path_maker
+import perf_history
+import preflight
+import process_placement
+import prores_cache
+import publisher
+import render_job
+import render_pool
+import render_store
+import retry_policy
+from live_metrics import LiveMetrics
+from profiling import Profiler
+from trackers import Trackers
+
+LOGGER = logging.getLogger('render_service')
+LOGGER.setLevel(level=logging.DEBUG)
+
+
+class RenderEvent:
+    """Progress of a submitted item, as passed to the submitter's callback.
+
+    stage is one of queued, skipped, aerender, handbrake, done or failed, with progress the fraction of the
+    aerender or handbrake stage completed.
+    """
+
+    def __init__(self, job_name, stage, progress=None, message=None):
+        self.job_name = job_name
+        self.stage = stage
+        self.progress = progress
+        self.message = message
+
+    def __repr__(self):
+        progress = f" {100 * self.progress:.1f}%" if self.progress is not None else ""
+        message = f": {self.message}" if self.message else ""
+        return f"<RenderEvent {self.job_name} {self.stage}{progress}{message}>"
+
+
+class RenderService:
+    """The renderer as a library, with the environment, tool probe, caches and histories loaded once.
+
+    sloerender.py builds its jobs through a service, and other tools in the same process, such as a watch
+    daemon or upload tooling, can submit items or whole divisions and get back concurrent.futures Futures.
+    A Future resolves to the finished RenderJob, or to None if every output was already valid or the item
+    is quarantined, and raises the item's exception if it failed.  Submitted items run in a RenderPool of
+    concurrency slots, on worker threads that call the submitter's callback with RenderEvents.  Tracker
+    calls are recorded on those threads and replayed into the item's run by a collector thread.
+    """
+
+    def __init__(self, env_filepath, render_params_path='render_params_base.json5',
+                 probe_cache_path='sloerender_probe_cache.json', division_index_path=None, perf_history_path=None,
+                 failure_history_path=None, use_ae_session=False, concurrency=None):
+        self.env_filepath = path_maker.host_env_filepath(env_filepath)
+        self.render_params_path = render_params_path
+        self.probe_cache_path = probe_cache_path
+        self.division_index_path = division_index_path
+        self.perf_history_path = perf_history_path
+        self.failure_history_path = failure_history_path
+        self.use_ae_session = use_ae_session
+        self.concurrency = concurrency
+
+        self.ae_session = None
+        self.division_index = None
+        self.encode_placement = None
+        self.failure_history = None
+        self.host_tuning = None
+        self.path_maker = None
+        self.perf_history = None
+        self.preflight = None
+        self.probe = None
+        self.prores_cache = None
+        self.publisher = None
+        self.recycle_policy = None
+        self.render_pool = None
+        self.render_store = None
+        self.retry_policy = None
+
+        self.collector = None
+        self.lock = threading.Lock()
+        self.pending_futures = {}
+        self.stopping = False
+        self.submitted = threading.Event()
+        # ClearML has one current task per process, so tracker runs are opened by one thread at a time
+        self.tracker_lock = threading.Lock()
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close(cancel=exc_type is not None)
+
+    def open(self):
+        self.path_maker = path_maker.PathMaker(self.env_filepath)
+        env = self.path_maker.env
+
+        # Fail on configuration errors now rather than part way through a run
+        self.probe = env_probe.EnvironmentProbe(self.env_filepath, self.render_params_path,
+                                                self.probe_cache_path).run()
+
+        if self.division_index_path:
+            self.division_index = division_index.DivisionIndex(self.division_index_path).open()
+        if self.perf_history_path:
+            self.perf_history = perf_history.PerfHistory(self.perf_history_path).open()
+
+        priorities = env.get('process_priority', {})
+        process_placement.set_own_priority(priorities.get('orchestrator'))
+        if priorities.get('encode'):
+            self.encode_placement = process_placement.ProcessPlacement(priority=priorities['encode'])
+        self.render_pool = render_pool.RenderPool.from_env(env, slots=self.concurrency)
+        if self.render_pool and self.use_ae_session:
+            raise ValueError("An AE session cannot be used with several render slots, as aerender -reuse would "
+                             "hand concurrent renders to the same After Effects instance")
+        self.host_tuning = host_tuning.HostTuning.from_env(env, self.probe.render_params.ae,
+                                                           perf_history=self.perf_history)
+        if self.use_ae_session:
+            self.ae_session = ae_session.AeSession()
+        self.retry_policy = retry_policy.RetryPolicy.from_env(env)
+        if self.failure_history_path:
+            self.failure_history = retry_policy.FailureHistory(
+                self.failure_history_path,
+                quarantine_after=env.get('quarantine_after_failures', retry_policy.DEFAULT_QUARANTINE_AFTER)).open()
+        self.preflight = preflight.Preflight.from_env(env)
+        self.render_store = render_store.RenderStore.from_env(env)
+        self.recycle_policy = ae_recycle.RecyclePolicy.from_env(env)
+
+        self.prores_cache = prores_cache.ProResCache.from_env(env)
+        self.prores_cache.start()
+        if self.path_maker.has_scratch_mp4():
+            self.publisher = publisher.Publisher().start()
+
+        if env['clearml_uri']:
+            Trackers.init_clearml(env['clearml_uri'])
+        if env['mlflow_uri']:
+            Trackers.init_mlflow(env['mlflow_uri'])
+        return self
+
+    def close(self, cancel=False):
+        """Wait for submitted items to finish, or with cancel stop them, then release everything opened."""
+        with self.lock:
+            self.stopping = True
+        if cancel and self.render_pool:
+            for task in self.render_pool.cancel_all():
+                with self.lock:
+                    future, notify = self.pending_futures.pop(task, (None, None))
+                if future:
+                    notify('failed', message='cancelled')
+                    future.set_exception(render_job.RenderCancelled(f"Render of {task.job.job_name} cancelled"))
+        self.submitted.set()
+        if self.collector:
+            self.collector.join()
+        if self.ae_session:
+            self.ae_session.close()
+        if self.prores_cache:
+            self.prores_cache.close()
+        if self.publisher:
+            self.publisher.close()
+        for store in (self.division_index, self.perf_history, self.failure_history):
+            if store:
+                store.close()
+
+    def for_division(self, event=None, division=None, variant=None):
+        return self.path_maker.for_division(self.path_maker.get_event(event), self.path_maker.get_division(division),
+                                            self.path_maker.get_variant(variant))
+
+    def order_items(self, division_path_maker, include='.*'):
+        if self.division_index:
+            order = self.division_index.order(division_path_maker.order_path())
+        else:
+            order = division_order.DivisionOrder(division_path_maker.order_path())
+        return order.filter(include)
+
+    def item_params(self, division_path_maker, item_name):
+        item_params_path = division_path_maker.item_path(item_name)
+        with Profiler.span('item_parse', item=Profiler.item_key(division_path_maker, item_name)):
+            if self.division_index:
+                return self.division_index.item_params(item_params_path)
+            return item_params.ItemParams.from_json5(item_params_path)
+
+    def job_params(self, division_path_maker, item_p, tags=None):
+        """Render job params for an item on this host, and the tracker tags to go with them."""
+        output_p = output_params.OutputParams(destination_path=division_path_maker.final_path(item_p.item_name))
+        render_p, item_tags = self.host_tuning.tune(self.probe.render_params, item_p)
+        if self.render_pool:
+            render_p = self.render_pool.partition_params(render_p)
+        return (render_job.RenderJobParams(item=item_p, output=output_p, render=render_p),
+                dict(tags or {}, **item_tags))
+
+    def prescan_outputs(self, division_path_maker, render_job_p):
+        """Scan of the first output that is not valid, or of the last if all are."""
+        item_name = render_job_p.item.item_name
+        with Profiler.span('final_prescan', item=Profiler.item_key(division_path_maker, item_name)):
+            for suffix, _ in render_job_p.render.output_profiles():
+                final_path = division_path_maker.final_path(item_name, mkdir=True, suffix=suffix)
+                final_scan = file_scanner.FileScanner(final_path, f"Output file prescan {item_name}",
+                                                      render_job_p, hb_command=[self.probe.hb_path])
+                final_scan_result = final_scan.scan_video()
+                if not final_scan_result['valid']:
+                    break
+        return final_scan_result
+
+    def quarantined(self, division_path_maker, item_p):
+        if not self.failure_history:
+            return None
+        try:
+            return self.failure_history.quarantined(division_path_maker, item_p)
+        except sqlite3.Error as exc:
+            LOGGER.warning("Failed to check the failure history of %s: %s", item_p.item_name, exc)
+            return None
+
+    def make_job(self, division_path_maker, item_p, render_job_p, progress_callback=None):
+        return render_job.RenderJob(division_path_maker, f"{item_p.item_name}", render_job_p,
+                                    prores_cache=self.prores_cache, probe=self.probe, publisher=self.publisher,
+                                    retry_policy=self.retry_policy, ae_session=self.ae_session,
+                                    encode_placement=self.encode_placement, preflight=self.preflight,
+                                    render_store=self.render_store, recycle_policy=self.recycle_policy,
+                                    progress_callback=progress_callback)
+
+    @staticmethod
+    def init_trackers(path_maker, item_name, tags, reuse_trackers, tracker_ids=(None, None)):
+        clearml_task = Trackers.clearml_task_init(
+            auto_resource_monitoring=dict(report_frequency_sec=5.0),
+            enabled=path_maker.env['clearml_enabled'],
+            continue_task=tracker_ids[0],
+            project_name=path_maker.env['project_prefix'] + path_maker.project_name(),
+            reuse_trackers=reuse_trackers,
+            tags=list(tags.keys()),
+            task_name=f"{path_maker.env['run_prefix']}{item_name}",
+        )
+        LOGGER.info("Contacting MLflow...")
+
+        mlflow_task = Trackers.mlflow_task_init(
+            continue_task=tracker_ids[1],
+            enabled=path_maker.env['mlflow_enabled'],
+            project_name=path_maker.env['project_prefix'] + path_maker.project_name(),
+            reuse_trackers=reuse_trackers,
+            tags=tags,
+            task_name=f"{path_maker.env['run_prefix']}{item_name}",
+        )
+        return clearml_task, mlflow_task
+
+    @staticmethod
+    def connect_output_scans(clearml_task, mlflow_task, job):
+        for suffix, scan_result in job.output_scan_results.items():
+            name = f"Output file {suffix}" if suffix else "Output file"
+            clearml_task.connect(scan_result, name=name)
+            mlflow_task.connect(scan_result, name=name)
+
+    def start_trackers(self, division_path_maker, item_name, tags, render_job_p, reuse_trackers=False):
+        """Open the item's tracker runs to log its params, returning their IDs for report_task to reattach to."""
+        with self.tracker_lock, Profiler.span('tracker_init', item=Profiler.item_key(division_path_maker, item_name)):
+            clearml_task, mlflow_task = self.init_trackers(division_path_maker, item_name, tags, reuse_trackers)
+            try:
+                clearml_task.connect(render_job_p.dict())
+                mlflow_task.connect(render_job_p.dict())
+            finally:
+                clearml_task.close()
+                mlflow_task.close()
+        return clearml_task.id, mlflow_task.id
+
+    def report_task(self, task):
+        """Replay a finished render or encode task's tracker calls and its results into the item's runs."""
+        job = task.job
+        with self.tracker_lock:
+            clearml_task, mlflow_task = self.init_trackers(job.path_maker, job.params.item.item_name, task.tags,
+                                                           reuse_trackers=False, tracker_ids=task.tracker_ids)
+            try:
+                task.recorder.replay()
+                if isinstance(task, render_pool.RenderTask) and job.prores_scan_result:
+                    clearml_task.connect(job.prores_scan_result, name="ProRes file")
+                    mlflow_task.connect(job.prores_scan_result, name="ProRes file")
+                if task.exception:
+                    status_message = "".join(traceback.format_exception_only(task.exception)).strip()
+                    clearml_task.mark_failed(status_message=status_message, force=True)
+                    mlflow_task.mark_failed(status_message=status_message, force=True)
+                    return
+                if task.final_scan_result:
+                    self.connect_output_scans(clearml_task, mlflow_task, job)
+                if Profiler.ENABLED:
+                    clearml_task.connect(Profiler.item_breakdown(job.profile_item), name="Stage seconds")
+                    mlflow_task.connect(Profiler.item_breakdown(job.profile_item), name="Stage seconds")
+            finally:
+                clearml_task.close()
+                mlflow_task.close()
+
+    def record_performance(self, job):
+        if not self.perf_history:
+            return
+        try:
+            self.perf_history.record(job)
+        except sqlite3.Error as exc:
+            LOGGER.warning("Failed to record performance history for %s: %s", job.job_name, exc)
+
+    def record_success(self, division_path_maker, item_name):
+        if not self.failure_history:
+            return
+        try:
+            self.failure_history.record_success(division_path_maker, item_name)
+        except sqlite3.Error as exc:
+            LOGGER.warning("Failed to record success of %s in the failure history: %s", item_name, exc)
+
+    def record_failure(self, division_path_maker, item_p, exc):
+        if not self.failure_history:
+            return
+        try:
+            self.failure_history.record_failure(division_path_maker, item_p, exc)
+        except sqlite3.Error as history_exc:
+            LOGGER.warning("Failed to record failure of %s: %s", item_p.item_name, history_exc)
+
+    def submit(self, item_name, event=None, division=None, variant=None, **kwargs):
+        """Queue an item for rendering and encoding, returning a Future of its RenderJob."""
+        return self.submit_item(self.for_division(event, division, variant), item_name, **kwargs)
+
+    def submit_division(self, event=None, division=None, variant=None, include='.*', **kwargs):
+        """Queue every item of a division whose name matches include, returning their Futures in order."""
+        division_path_maker = self.for_division(event, division, variant)
+        return [self.submit_item(division_path_maker, order_item['name'], **kwargs)
+                for order_item in self.order_items(division_path_maker, include)]
+
+    async def render(self, item_name, **kwargs):
+        """Awaitable form of submit, which is run in the loop's executor as it scans outputs and opens trackers."""
+        loop = asyncio.get_running_loop()
+        future = await loop.run_in_executor(None, functools.partial(self.submit, item_name, **kwargs))
+        return await asyncio.wrap_future(future)
+
+    def submit_item(self, division_path_maker, item_name, force_prores=False, force_final=False, callback=None,
+                    tags=None):
+        item_p = self.item_params(division_path_maker, item_name)
+        render_job_p, item_tags = self.job_params(division_path_maker, item_p, tags)
+        future = concurrent.futures.Future()
+        future.set_running_or_notify_cancel()
+
+        def notify(stage, progress=None, message=None):
+            if callback:
+                callback(RenderEvent(item_name, stage, progress=progress, message=message))
+
+        final_scan_result = self.prescan_outputs(division_path_maker, render_job_p)
+        quarantine = None if final_scan_result['valid'] else self.quarantined(division_path_maker, item_p)
+        if final_scan_result['valid'] and not force_final and not force_prores:
+            notify('skipped', message=final_scan_result['message'])
+            future.set_result(None)
+            return future
+        if quarantine:
+            notify('skipped', message=f"quarantined after {quarantine['failures']} failures, the last "
+                                      f"({quarantine['failure_class']}): {quarantine['message']}")
+            future.set_result(None)
+            return future
+
+        tracker_ids = self.start_trackers(division_path_maker, item_name, item_tags, render_job_p)
+        job = self.make_job(division_path_maker, item_p, render_job_p, progress_callback=notify)
+        task = render_pool.RenderTask(job, force_prores=force_prores, force_final=force_final,
+                                      encode=lambda: True, tags=item_tags, tracker_ids=tracker_ids)
+        with self.lock:
+            if self.stopping:
+                raise RuntimeError("RenderService is closed")
+            if self.render_pool is None:
+                self.render_pool = render_pool.RenderPool(1)
+            if self.collector is None:
+                self.collector = threading.Thread(target=self.run_collector, name='render_service', daemon=True)
+                self.collector.start()
+            self.pending_futures[task] = (future, notify)
+        notify('queued')
+        self.render_pool.submit(task)
+        self.submitted.set()
+        return future
+
+    def run_collector(self):
+        while True:
+            self.submitted.wait()
+            for task in self.render_pool.collect(block=True):
+                self.finish_task(task)
+            if not self.render_pool.busy():
+                self.submitted.clear()
+                with self.lock:
+                    if self.stopping:
+                        return
+                # A submit may have arrived between the checks
+                if self.render_pool.busy():
+                    self.submitted.set()
+
+    def finish_task(self, task):
+        with self.lock:
+            future, notify = self.pending_futures.pop(task)
+        job = task.job
+        item_name = job.params.item.item_name
+        if not task.exception:
+            # Outputs encoded to scratch are only final once published
+            for publish_task in job.publish_tasks:
+                publish_task.done.wait()
+                if publish_task.exception and not task.exception:
+                    task.exception = publish_task.exception
+        self.report_task(task)
+
+        if task.exception:
+            LOGGER.error("+++Failed %s (%s): %s", item_name, retry_policy.classify(task.exception), task.exception)
+            LiveMetrics.item_finished('failed')
+            if not isinstance(task.exception, render_job.RenderCancelled):
+                self.record_failure(job.path_maker, job.params.item, task.exception)
+            notify('failed', message=str(task.exception))
+            future.set_exception(task.exception)
+        else:
+            LiveMetrics.item_finished('rendered')
+            self.record_performance(job)
+            self.record_success(job.path_maker, item_name)
+            notify('done')
+            future.set_result(job)
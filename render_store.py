@@ -0,0 +1,343 @@
+# python 3.12
+import argparse
+import errno
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+import path_maker
+import publisher
+
+LOGGER = logging.getLogger('render_store')
+LOGGER.setLevel(level=logging.DEBUG)
+
+USAGE_DESCRIPTION = '''
+Lists or prunes the artefacts of the shared render store, least recently used first.  sloerender.py prunes
+to render_store_budget_gb after each render it adds; prune here also removes those unused for some days.
+Example of usage:
+python render_store.py list
+python render_store.py prune --budget-gb 4000 --unused-days 30
+'''
+GB = 1024 ** 3
+
+# Fields that change the frames aerender produces.  Others, such as the item name, variant and division, only
+# change where they are written, and the memory and MFR settings only change how fast
+ITEM_FIELDS = ['ae_comp', 'ae_project', 'ae_version', 'duration', 'frame_rate', 'height', 'width']
+AE_FIELDS = ['major_version', 'render_settings_template', 'output_module_template']
+# FICLONE from linux/fs.h, which makes a copy on write clone on btrfs, XFS and similar
+FICLONE = 0x40049409
+
+
+def reflink(source_path, dest_path):
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    with open(source_path, 'rb') as source_file, open(dest_path, 'wb') as dest_file:
+        try:
+            fcntl.ioctl(dest_file.fileno(), FICLONE, source_file.fileno())
+            return True
+        except OSError:
+            pass
+    os.remove(dest_path)
+    return False
+
+
+def link_file(source_path, dest_path):
+    """Make dest_path a hardlink, reflink or, failing those, a copy of source_path, returning which."""
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+    dest_dir, dest_name = os.path.split(dest_path)
+    partial_path = os.path.join(dest_dir, f".{dest_name}.partial")
+    try:
+        try:
+            os.link(source_path, partial_path)
+            method = 'hardlink'
+        except OSError:
+            if reflink(source_path, partial_path):
+                method = 'reflink'
+            else:
+                size = os.path.getsize(source_path)
+                with open(source_path, 'rb') as source_file, open(partial_path, 'wb') as dest_file:
+                    method = publisher.kernel_copy(source_file, dest_file, size)
+                    dest_file.flush()
+                    os.fsync(dest_file.fileno())
+        os.replace(partial_path, dest_path)
+        publisher.fsync_dir(dest_dir)
+    except BaseException:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    return method
+
+
+class RenderLock:
+    """A lock file in the store, created exclusively and kept fresh while held so that other hosts can tell
+    a long render from one whose host died."""
+
+    def __init__(self, lock_path, stale_seconds):
+        self.lock_path = lock_path
+        self.stale_seconds = stale_seconds
+        self.released = threading.Event()
+        self.thread = None
+
+    def try_acquire(self):
+        try:
+            fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            self.break_if_stale()
+            return False
+        with os.fdopen(fd, 'w') as file:
+            json.dump(dict(host=socket.gethostname(), pid=os.getpid(), time=time.time()), file)
+        self.thread = threading.Thread(target=self.heartbeat, name='render_lock', daemon=True)
+        self.thread.start()
+        return True
+
+    def holder(self):
+        try:
+            with open(self.lock_path, 'r', encoding='utf-8') as file:
+                holder = json.load(file)
+            return f"{holder['host']} pid {holder['pid']}"
+        except (OSError, ValueError, KeyError):
+            return 'unknown'
+
+    def stale_stat(self, path):
+        """os.stat of a lock file that has not been refreshed for stale_seconds, otherwise None."""
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat if time.time() - stat.st_mtime > self.stale_seconds else None
+
+    def break_if_stale(self):
+        if not self.stale_stat(self.lock_path):
+            return
+
+        # Only one host breaks the lock at a time, so that another that also found it stale cannot then remove
+        # the fresh lock taken by the first.  A breaker lock left by a host that died part way through is
+        # cleared in turn once it is stale
+        breaker_path = f"{self.lock_path}.break"
+        try:
+            os.close(os.open(breaker_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            if self.stale_stat(breaker_path):
+                stale_breaker_path = f"{breaker_path}.{socket.gethostname()}.{os.getpid()}.stale"
+                try:
+                    os.replace(breaker_path, stale_breaker_path)
+                    os.remove(stale_breaker_path)
+                except FileNotFoundError:
+                    pass
+            return
+        try:
+            stat = self.stale_stat(self.lock_path)
+            if not stat:
+                return
+            holder = self.holder()
+            # Rename to a name of our own first, then check it is still the lock found stale before removing it
+            broken_path = f"{self.lock_path}.{socket.gethostname()}.{os.getpid()}.broken"
+            try:
+                os.replace(self.lock_path, broken_path)
+            except FileNotFoundError:
+                return
+            broken_stat = self.stale_stat(broken_path)
+            if not broken_stat or (broken_stat.st_ino, broken_stat.st_dev) != (stat.st_ino, stat.st_dev):
+                LOGGER.info("Lock %s was renewed while breaking it, restoring it", self.lock_path)
+                try:
+                    os.link(broken_path, self.lock_path)
+                except FileExistsError:
+                    pass
+                os.remove(broken_path)
+                return
+            LOGGER.warning("Broke lock %s held by %s, not refreshed for %d seconds", self.lock_path, holder,
+                           time.time() - stat.st_mtime)
+            os.remove(broken_path)
+        finally:
+            try:
+                os.remove(breaker_path)
+            except FileNotFoundError:
+                pass
+
+    def heartbeat(self):
+        while not self.released.wait(self.stale_seconds / 4):
+            try:
+                os.utime(self.lock_path)
+            except OSError as exc:
+                LOGGER.warning("Unable to refresh lock %s: %s", self.lock_path, exc)
+
+    def release(self):
+        self.released.set()
+        if self.thread:
+            self.thread.join()
+        try:
+            os.remove(self.lock_path)
+        except FileNotFoundError:
+            pass
+
+
+class RenderStore:
+    """Content addressed store of rendered intermediates, shared between items, variants and hosts.
+
+    The key is a hash of the item and render settings that change what aerender produces, plus the size and
+    modification time of the AE project, so that editing the project starts afresh.  An item whose key is
+    already in the store gets its ProRes file as a hardlink, reflink or copy instead of a render.  Renders
+    take a lock file in the store first, and anyone wanting the same key waits for the artefact instead of
+    rendering it again.  The store directory should be on storage that every host can reach.
+
+    Editing a project leaves the artefacts of its old keys unused, so with a budget the least recently used
+    are removed once the store grows beyond it.  Each fetch refreshes the artefact's modification time as
+    its last use, and an artefact is only removed while holding its key's lock.
+    """
+    POLL_SECONDS = 10.0
+
+    def __init__(self, store_dir, lock_stale_seconds=900, budget_bytes=None):
+        self.store_dir = store_dir
+        self.lock_stale_seconds = lock_stale_seconds
+        self.budget_bytes = budget_bytes
+
+    @classmethod
+    def from_env(cls, env):
+        if not env.get('render_store_dir'):
+            return None
+        budget_gb = env.get('render_store_budget_gb')
+        return cls(env['render_store_dir'], lock_stale_seconds=env.get('render_store_lock_stale_seconds', 900),
+                   budget_bytes=int(budget_gb * GB) if budget_gb else None)
+
+    @staticmethod
+    def key(params, project_path):
+        stat = os.stat(project_path)
+        fields = dict(
+            item={name: getattr(params.item, name) for name in ITEM_FIELDS},
+            ae={name: getattr(params.render.ae, name) for name in AE_FIELDS},
+            project=f"{stat.st_mtime_ns}:{stat.st_size}",
+        )
+        return hashlib.sha256(json.dumps(fields, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def artefact_path(self, key):
+        return os.path.join(self.store_dir, key[:2], f"{key}.mov")
+
+    def fetch(self, key, dest_path):
+        """Link the stored artefact for a key to dest_path, returning False if there is none."""
+        artefact_path = self.artefact_path(key)
+        try:
+            method = link_file(artefact_path, dest_path)
+            # As the last use, for pruning
+            os.utime(artefact_path)
+        except FileNotFoundError:
+            return False
+        LOGGER.info("Took %s from the render store by %s of %s", dest_path, method, artefact_path)
+        return True
+
+    def put(self, key, source_path):
+        method = link_file(source_path, self.artefact_path(key))
+        LOGGER.info("Added %s to the render store by %s as %s", source_path, method, self.artefact_path(key))
+        if self.budget_bytes:
+            self.prune(self.budget_bytes)
+
+    def artefacts(self):
+        """os.stat of each artefact in the store by path, least recently used first."""
+        artefacts = []
+        for dir_entry in os.scandir(self.store_dir):
+            if not dir_entry.is_dir():
+                continue
+            for entry in os.scandir(dir_entry.path):
+                if entry.name.endswith('.mov') and not entry.name.startswith('.'):
+                    try:
+                        artefacts.append((entry.path, entry.stat()))
+                    except FileNotFoundError:
+                        pass
+        return sorted(artefacts, key=lambda x: x[1].st_mtime)
+
+    def prune(self, budget_bytes=None, unused_seconds=None):
+        """Remove the least recently used artefacts while over budget_bytes, and any unused for unused_seconds,
+        skipping those whose key is locked by a render or fetch.  Returns the paths removed."""
+        artefacts = self.artefacts()
+        total_bytes = sum(stat.st_size for _, stat in artefacts)
+        removed = []
+        for path, stat in artefacts:
+            over_budget = budget_bytes is not None and total_bytes > budget_bytes
+            unused = unused_seconds is not None and time.time() - stat.st_mtime > unused_seconds
+            if not over_budget and not unused:
+                continue
+            render_lock = RenderLock(f"{path[:-len('.mov')]}.lock", self.lock_stale_seconds)
+            if not render_lock.try_acquire():
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            finally:
+                render_lock.release()
+            total_bytes -= stat.st_size
+            removed.append(path)
+            LOGGER.info("Pruned %s (%.2fGB) from the render store, last used %s", path, stat.st_size / GB,
+                        time.strftime('%Y-%m-%d %H:%M', time.localtime(stat.st_mtime)))
+        if removed:
+            LOGGER.info("Render store holds %.2fGB after pruning %d artefacts", total_bytes / GB, len(removed))
+        return removed
+
+    def lock(self, key):
+        """Context manager holding the render lock for a key, waiting while another render holds it."""
+        store = self
+        render_lock = RenderLock(os.path.join(self.store_dir, key[:2], f"{key}.lock"), self.lock_stale_seconds)
+
+        class _Locked:
+            def __enter__(self):
+                os.makedirs(os.path.dirname(render_lock.lock_path), exist_ok=True)
+                waiting_since = None
+                while not render_lock.try_acquire():
+                    if waiting_since is None:
+                        waiting_since = time.monotonic()
+                        LOGGER.info("Waiting for %s to finish rendering %s", render_lock.holder(),
+                                    store.artefact_path(key))
+                    time.sleep(store.POLL_SECONDS)
+                if waiting_since is not None:
+                    LOGGER.info("Waited %d seconds for the render lock", time.monotonic() - waiting_since)
+                return render_lock
+
+            def __exit__(self, exc_type, exc_val, exc_tb):
+                render_lock.release()
+
+        return _Locked()
+
+
+def unlink_shared(path):
+    """Remove a file that is hardlinked elsewhere, so that rendering over it cannot change the other copies."""
+    try:
+        if os.stat(path).st_nlink > 1:
+            os.remove(path)
+    except OSError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=USAGE_DESCRIPTION, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('command', choices=['list', 'prune'])
+    parser.add_argument('--env-filepath', default='sloerender_env.json5',
+                        help='Env file, or this host\'s own version of it, for render_store_dir and its budget')
+    parser.add_argument('--budget-gb', type=float,
+                        help='Prune least recently used artefacts down to this size, by default '
+                             'render_store_budget_gb from the env file')
+    parser.add_argument('--unused-days', type=float,
+                        help='Also prune artefacts not used for this many days')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    options = parse_args()
+    logging.basicConfig(format='%(asctime)s.%(msecs)03d %(name)s:%(levelname)s: %(message)s', datefmt='%H:%M:%S',
+                        level=logging.INFO)
+    store = RenderStore.from_env(path_maker.PathMaker(path_maker.host_env_filepath(options.env_filepath)).env)
+    if store is None:
+        raise SystemExit("No render_store_dir in the env file")
+    if options.command == 'list':
+        for artefact_path, artefact_stat in store.artefacts():
+            LOGGER.info("%s: %.2fGB, last used %s", artefact_path, artefact_stat.st_size / GB,
+                        time.strftime('%Y-%m-%d %H:%M', time.localtime(artefact_stat.st_mtime)))
+    else:
+        budget_bytes = options.budget_gb * GB if options.budget_gb is not None else store.budget_bytes
+        unused_seconds = options.unused_days * 86400 if options.unused_days is not None else None
+        store.prune(budget_bytes, unused_seconds)
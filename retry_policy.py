@@ -0,0 +1,205 @@
+# python 3.12
+import argparse
+import logging
+import os
+import re
+import socket
+import sqlite3
+import threading
+import time
+
+import path_maker
+
+LOGGER = logging.getLogger('retry_policy')
+LOGGER.setLevel(level=logging.DEBUG)
+USAGE_DESCRIPTION = '''
+Lists or releases items quarantined by sloerender.py after repeated failures.  Quarantined items are skipped
+until their item file or AE project changes, or until they are released here.
+Example of usage:
+python retry_policy.py list
+python retry_policy.py release "hoc2025-divm1/.*heat 3"
+'''
+
+SCHEMA_VERSION = 1
+FAILURE_CLASSES = ['timeout', 'return_code', 'invalid_output', 'missing_input', 'preflight', 'other']
+# Retries within a run and the backoff before the first of them, doubling for each later retry
+DEFAULT_BUDGETS = {
+    'timeout': dict(retries=1, backoff_seconds=0.0),
+    'return_code': dict(retries=1, backoff_seconds=30.0),
+    'invalid_output': dict(retries=1, backoff_seconds=0.0),
+    'missing_input': dict(retries=0, backoff_seconds=0.0),
+    'preflight': dict(retries=0, backoff_seconds=0.0),
+    'other': dict(retries=0, backoff_seconds=0.0),
+}
+DEFAULT_QUARANTINE_AFTER = 3
+
+
+def classify(exc):
+    """Failure class of an exception, or None if it should never be retried, e.g. a cancellation."""
+    if isinstance(exc, FileNotFoundError):
+        return 'missing_input'
+    return getattr(exc, 'failure_class', 'other')
+
+
+class RetryPolicy:
+    """Runs a stage, retrying it within a budget that depends on how it failed."""
+
+    def __init__(self, budgets=None):
+        self.budgets = {name: dict(budget) for name, budget in DEFAULT_BUDGETS.items()}
+        for name, budget in (budgets or {}).items():
+            if name not in self.budgets:
+                raise ValueError(f"Unknown failure class {name} in retry_policy, expected one of {FAILURE_CLASSES}")
+            self.budgets[name].update(budget)
+
+    @classmethod
+    def from_env(cls, env):
+        return cls(env.get('retry_policy'))
+
+    def run(self, job_name, stage, function):
+        attempts = {}
+        while True:
+            try:
+                return function()
+            except Exception as exc:
+                failure_class = classify(exc)
+                if failure_class is None:
+                    raise
+                attempt = attempts.get(failure_class, 0)
+                budget = self.budgets[failure_class]
+                if attempt >= budget['retries']:
+                    raise
+                attempts[failure_class] = attempt + 1
+                backoff_seconds = budget['backoff_seconds'] * 2 ** attempt
+                LOGGER.error("+++%s of %s failed (%s), retry %d of %d in %.0fs: %s", stage, job_name, failure_class,
+                             attempt + 1, budget['retries'], backoff_seconds, exc)
+                time.sleep(backoff_seconds)
+
+
+class FailureHistory:
+    """Local SQLite record of the failures of each item since it last succeeded, keyed on its inputs.
+
+    The fingerprint is the size and modification time of the item file and its AE project, so editing
+    either gives a quarantined item a fresh start.
+    """
+
+    def __init__(self, history_path, quarantine_after=DEFAULT_QUARANTINE_AFTER):
+        self.history_path = history_path
+        self.quarantine_after = quarantine_after
+        self.connection = None
+        self.lock = threading.RLock()
+        self.host = socket.gethostname()
+
+    def open(self):
+        self.connection = sqlite3.connect(self.history_path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version == 0:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS failures (item_key TEXT NOT NULL, "
+                                    "fingerprint TEXT NOT NULL, timestamp REAL NOT NULL, host TEXT, "
+                                    "failure_class TEXT, message TEXT)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS failures_item ON failures (item_key)")
+            self.connection.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+            self.connection.commit()
+        elif version != SCHEMA_VERSION:
+            raise sqlite3.DatabaseError(f"{self.history_path} has schema version {version}, "
+                                        f"expected {SCHEMA_VERSION}")
+        return self
+
+    def close(self):
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+    @staticmethod
+    def item_key(path_maker, item_name):
+        return f"{path_maker.project_name()}/{item_name}"
+
+    @staticmethod
+    def fingerprint(path_maker, item_p):
+        parts = []
+        for path in (path_maker.item_path(item_p.item_name), path_maker.item_ae_project_path(item_p.ae_project)):
+            try:
+                stat = os.stat(path)
+                parts.append(f"{stat.st_mtime_ns}:{stat.st_size}")
+            except OSError:
+                parts.append("missing")
+        return "/".join(parts)
+
+    def query(self, sql, parameters=()):
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def record_failure(self, path_maker, item_p, exc):
+        item_key = self.item_key(path_maker, item_p.item_name)
+        fingerprint = self.fingerprint(path_maker, item_p)
+        with self.lock, self.connection:
+            # Failures with earlier inputs no longer count towards quarantine
+            self.connection.execute("DELETE FROM failures WHERE item_key = ? AND fingerprint != ?",
+                                    (item_key, fingerprint))
+            self.connection.execute("INSERT INTO failures VALUES (?, ?, ?, ?, ?, ?)",
+                                    (item_key, fingerprint, time.time(), self.host, classify(exc) or 'other',
+                                     str(exc)))
+
+    def record_success(self, path_maker, item_name):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM failures WHERE item_key = ?", (self.item_key(path_maker, item_name),))
+
+    def quarantined(self, path_maker, item_p):
+        """The latest failure of an item if it has failed too often with its current inputs, otherwise None."""
+        rows = self.query(
+            "SELECT * FROM failures WHERE item_key = ? AND fingerprint = ? ORDER BY timestamp DESC",
+            (self.item_key(path_maker, item_p.item_name), self.fingerprint(path_maker, item_p)))
+        if self.quarantine_after and len(rows) >= self.quarantine_after:
+            return dict(rows[0], failures=len(rows))
+        return None
+
+    def failed_items(self):
+        return [dict(row) for row in self.query(
+            "SELECT item_key, fingerprint, COUNT(*) AS failures, MAX(timestamp) AS timestamp, "
+            "GROUP_CONCAT(DISTINCT failure_class) AS failure_classes FROM failures "
+            "GROUP BY item_key, fingerprint ORDER BY item_key")]
+
+    def release(self, pattern):
+        item_keys = [row['item_key'] for row in self.failed_items() if re.search(pattern, row['item_key'])]
+        with self.lock, self.connection:
+            self.connection.executemany("DELETE FROM failures WHERE item_key = ?", [(x,) for x in item_keys])
+        return item_keys
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=USAGE_DESCRIPTION, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('command', choices=['list', 'release'])
+    parser.add_argument('pattern', nargs='?', default='.*', help='Regexp matching event-division[-variant]/item')
+    parser.add_argument('--failure-history', default='sloerender_failure_history.sqlite',
+                        help='History database written by sloerender.py --failure-history')
+    parser.add_argument('--env-filepath', default='sloerender_env.json5',
+                        help='Env file, or this host\'s own version of it, for quarantine_after_failures')
+    parser.add_argument('--quarantine-after', type=int,
+                        help='Failures with the same inputs after which an item is quarantined, by default '
+                             f'quarantine_after_failures from the env file or {DEFAULT_QUARANTINE_AFTER}')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    options = parse_args()
+    logging.basicConfig(format='%(asctime)s.%(msecs)03d %(name)s:%(levelname)s: %(message)s', datefmt='%H:%M:%S',
+                        level=logging.INFO)
+    quarantine_after = options.quarantine_after
+    if quarantine_after is None:
+        env_filepath = path_maker.host_env_filepath(options.env_filepath)
+        env = path_maker.PathMaker(env_filepath).env if os.path.isfile(env_filepath) else {}
+        quarantine_after = env.get('quarantine_after_failures', DEFAULT_QUARANTINE_AFTER)
+    history = FailureHistory(options.failure_history, quarantine_after=quarantine_after).open()
+    try:
+        if options.command == 'list':
+            for row in history.failed_items():
+                if re.search(options.pattern, row['item_key']):
+                    state = 'quarantined' if quarantine_after and row['failures'] >= quarantine_after else 'failing'
+                    last_failure = time.strftime('%Y-%m-%d %H:%M', time.localtime(row['timestamp']))
+                    LOGGER.info("%s: %s, %d failures (%s), last %s", row['item_key'], state, row['failures'],
+                                row['failure_classes'], last_failure)
+        else:
+            for item_key in history.release(options.pattern):
+                LOGGER.info("Released %s", item_key)
+    finally:
+        history.close()
@@ -1,21 +1,24 @@
 import argparse
+import datetime
+import itertools
 import logging
 import os.path
 import re
-import socket
+import sys
 import time
 import traceback
 
 import wakepy
 
-import division_order
-import file_scanner
-import item_params
-import output_params
-import path_maker
+import encode_pool
+import render_control
 import render_job
-import render_params
-from trackers import Trackers
+import render_pool
+import render_service
+import retry_policy
+from live_metrics import LiveMetrics
+from log_sink import SubprocessLog
+from profiling import Profiler
 
 LOGGER = logging.getLogger('render')
 LOGGER.setLevel(level=logging.DEBUG)
@@ -25,12 +28,36 @@ logging.getLogger("wakepy").setLevel(logging.INFO)
 class Render:
     def __init__(self):
         self.options = None
+        self.control = render_control.RenderControl()
+        self.consecutive_failures = 0
+        self.encode_pool = None
+        self.failed_items = []
+        self.max_consecutive_failures = 3
+        self.path_maker = None
+        self.render_pool = None
+        self.service = None
+
+    def build_work_queue(self):
+        if self.options.batch:
+            divisions = []
+            for spec in self.options.batch:
+                divisions += [x for x in self.path_maker.find_divisions(spec) if x not in divisions]
+            division_path_makers = [self.path_maker.for_division(*division) for division in divisions]
+        else:
+            division_path_makers = [self.path_maker]
+
+        division_queues = []
+        for division_path_maker in division_path_makers:
+            division_queues.append([(division_path_maker, order_item) for order_item in
+                                    self.service.order_items(division_path_maker, self.options.include)])
+
+        if self.options.batch_order == 'interleave':
+            return [entry for entries in itertools.zip_longest(*division_queues) for entry in entries if entry]
+        return list(itertools.chain.from_iterable(division_queues))
 
     def do_work(self):
         tags = {}
-        order = division_order.DivisionOrder(self.path_maker.order_path())
-
-        filtered_order = order.filter(self.options.include)
+        filtered_order = self.build_work_queue()
 
         if self.options.decimate:
             tags[f"decimate={self.options.decimate}"] = self.options.decimate
@@ -51,22 +78,92 @@ class Render:
         if self.options.reverse:
             filtered_order.reverse()
 
+        if self.service.ae_session and self.options.batch_order == 'interleave':
+            LOGGER.warning("--batch-order interleave alternates between divisions, so --ae-session will rarely "
+                           "find consecutive items sharing an AE project")
+
         LOGGER.info("Will potentially render:\n\n  %s\n\nStopping after: %s",
-                    "\n  ".join(x['name'] for x in filtered_order),
+                    "\n  ".join(f"{pm.project_name()}: {x['name']}" for pm, x in filtered_order),
                     self.options.stop_after
                     )
+        if self.service.perf_history and self.service.division_index:
+            self.log_estimate(filtered_order)
 
-        for order_num, order_item in enumerate(filtered_order):
-            for filename in (
-                    'stop.txt',
-                    'stop-once.txt',
-                    f"{self.path_maker.env['run_prefix']}stop.txt",
-                    f"{self.path_maker.env['run_prefix']}stop-once.txt"):
-                if os.path.isfile(filename):
-                    if 'once.txt' in filename:
-                        os.remove(filename)
-                    LOGGER.info("Stopping after %d items due to presence of %s", order_num, filename)
-                    break
+        try:
+            self.render_items(filtered_order, tags)
+            if self.render_pool:
+                self.collect_while(self.render_pool.busy)
+            if self.encode_pool:
+                while self.encode_pool.busy():
+                    self.collect_encodes(block=True)
+            if self.service.publisher:
+                failed_publishes = self.service.publisher.wait()
+                if failed_publishes:
+                    raise Exception(f"Failed to publish {', '.join(x.job_name for x in failed_publishes)}, "
+                                    f"the encoded files remain in {self.path_maker.env['smr_scratch_mp4']}")
+        except (Exception, KeyboardInterrupt):
+            if self.render_pool:
+                self.render_pool.cancel_all()
+            if self.encode_pool:
+                self.encode_pool.cancel_all()
+            raise
+        if self.failed_items:
+            LOGGER.error("+++%d items failed:\n\n  %s\n", len(self.failed_items), "\n  ".join(self.failed_items))
+
+    def log_estimate(self, filtered_order):
+        estimates = []
+        for division_path_maker, order_item in filtered_order:
+            item_p = self.service.item_params(division_path_maker, order_item['name'])
+            estimates.append(self.service.perf_history.estimate_seconds(item_p))
+        known = [x for x in estimates if x is not None]
+        if known:
+            LOGGER.info("Estimated %s to render all %d items from the history of %d of them, excluding any "
+                        "already rendered", datetime.timedelta(seconds=int(sum(known) * len(estimates) / len(known))),
+                        len(estimates), len(known))
+
+    def item_succeeded(self, path_maker, item_name):
+        self.consecutive_failures = 0
+        self.service.record_success(path_maker, item_name)
+
+    def item_failed(self, path_maker, item_p, exc):
+        """Record a failed item so the run can go on to the next, unless too many have failed in a row."""
+        LOGGER.error("+++Failed %s (%s): %s", item_p.item_name, retry_policy.classify(exc), exc)
+        self.failed_items.append(f"{path_maker.project_name()}/{item_p.item_name}: {exc}")
+        self.service.record_failure(path_maker, item_p, exc)
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.max_consecutive_failures:
+            # Likely a problem with the host rather than the items, so stop before quarantining good items
+            LOGGER.error("+++Stopping after %d consecutive failures", self.consecutive_failures)
+            raise exc
+
+    def stop_file(self):
+        for filename in (
+                'stop.txt',
+                'stop-once.txt',
+                f"{self.path_maker.env['run_prefix']}stop.txt",
+                f"{self.path_maker.env['run_prefix']}stop-once.txt"):
+            if os.path.isfile(filename):
+                if 'once.txt' in filename:
+                    os.remove(filename)
+                return filename
+        return None
+
+    def render_items(self, filtered_order, tags):
+        work_queue = render_control.WorkQueue(filtered_order)
+        self.control.work_queue = work_queue
+        order_num = 0
+        while work_queue:
+            LiveMetrics.set_items(total=len(filtered_order), started=order_num)
+            self.control.wait_if_paused()
+            if self.control.stopping():
+                LOGGER.info("Stopping after %d items due to %s command", order_num,
+                            'drain' if self.control.drain_requested else 'stop')
+                break
+
+            stop_filename = self.stop_file()
+            if stop_filename:
+                LOGGER.info("Stopping after %d items due to presence of %s", order_num, stop_filename)
+                break
 
             if self.options.stop_after:
                 if re.match(r'^[0-9]+$', self.options.stop_after):
@@ -75,73 +172,167 @@ class Render:
                                     self.options.stop_after)
                         break
 
-            item_params_path = self.path_maker.item_path(order_item['name'])
-            item_p = item_params.ItemParams.from_json5(item_params_path)
-            output_p = output_params.OutputParams(destination_path=self.path_maker.final_path(order_item['name']))
-            render_p = render_params.RenderParams.from_json5(self.options.render_params_base)
-            render_job_p = render_job.RenderJobParams(item=item_p, output=output_p, render=render_p)
+            division_path_maker, order_item = work_queue.pop()
+            item_p = self.service.item_params(division_path_maker, order_item['name'])
+            render_job_p, item_tags = self.service.job_params(division_path_maker, item_p, tags)
 
-            final_path = self.path_maker.final_path(item_p.item_name, mkdir=True)
-            final_scan = file_scanner.FileScanner(final_path, f"Output file prescan {item_p.item_name}",
-                                                  render_job_p)
-            final_scan_result = final_scan.scan_video()
+            # Skip only when every output profile is already valid
+            final_scan_result = self.service.prescan_outputs(division_path_maker, render_job_p)
+            quarantine = None
+            if not final_scan_result['valid']:
+                quarantine = self.service.quarantined(division_path_maker, item_p)
 
             if final_scan_result['valid'] and not self.options.force_final and not self.options.force_prores:
                 LOGGER.info("Skipping %s: %s", item_p.item_name, final_scan_result['message'])
+                LiveMetrics.item_finished('skipped')
+            elif quarantine:
+                LOGGER.warning("Skipping %s, quarantined after %d failures with unchanged inputs, the last (%s): %s",
+                               item_p.item_name, quarantine['failures'], quarantine['failure_class'],
+                               quarantine['message'])
+                LiveMetrics.item_finished('skipped')
+            elif self.render_pool:
+                self.submit_render(division_path_maker, item_p, render_job_p, item_tags)
             else:
                 LOGGER.info("Electing to render %s.  Contacting ClearML...", order_item['name'])
 
-                clearml_task = Trackers.clearml_task_init(
-                    auto_resource_monitoring=dict(report_frequency_sec=5.0),
-                    enabled=self.path_maker.env['clearml_enabled'],
-                    project_name=self.path_maker.env['project_prefix'] + self.path_maker.project_name(),
-                    reuse_trackers=self.options.reuse_trackers,
-                    tags=list(tags.keys()),
-                    task_name=f"{self.path_maker.env['run_prefix']}{item_p.item_name}",
-                )
-                LOGGER.info("Contacting MLflow...")
-
-                mlflow_task = Trackers.mlflow_task_init(
-                    enabled=self.path_maker.env['mlflow_enabled'],
-                    project_name=self.path_maker.env['project_prefix'] + self.path_maker.project_name(),
-                    reuse_trackers=self.options.reuse_trackers,
-                    tags=tags,
-                    task_name=f"{self.path_maker.env['run_prefix']}{item_p.item_name}",
-                )
+                with Profiler.span('tracker_init', item=Profiler.item_key(division_path_maker, item_p.item_name)):
+                    clearml_task, mlflow_task = self.service.init_trackers(division_path_maker, item_p.item_name,
+                                                                           item_tags, self.options.reuse_trackers)
+                item_exception = None
                 try:
                     clearml_task.connect(render_job_p.dict())
                     mlflow_task.connect(render_job_p.dict())
                     LOGGER.info(f"Starting job: Render {item_p.item_name}")
-                    job = render_job.RenderJob(self.path_maker, f"{item_p.item_name}", render_job_p)
-                    prores_scan_result, final_scan_result = job.execute(force_final=self.options.force_final,
-                                                                        force_prores=self.options.force_prores)
+                    job = self.service.make_job(division_path_maker, item_p, render_job_p)
+                    prores_scan_result = job.execute_render(force_prores=self.options.force_prores,
+                                                            force_final=self.options.force_final)
+                    final_scan_result = None
+                    if self.control.drain_requested:
+                        LOGGER.info("Draining, so leaving the encode of %s for a later run", item_p.item_name)
+                    else:
+                        final_scan_result = job.execute_encode(force_final=self.options.force_final)
                     if prores_scan_result:
                         clearml_task.connect(prores_scan_result, name="ProRes file")
                         mlflow_task.connect(prores_scan_result, name="ProRes file")
                     if final_scan_result:
-                        clearml_task.connect(final_scan_result, name="Output file")
-                        mlflow_task.connect(final_scan_result, name="Output file")
+                        self.service.connect_output_scans(clearml_task, mlflow_task, job)
+                    if Profiler.ENABLED:
+                        clearml_task.connect(Profiler.item_breakdown(job.profile_item), name="Stage seconds")
+                        mlflow_task.connect(Profiler.item_breakdown(job.profile_item), name="Stage seconds")
                 except (Exception, KeyboardInterrupt) as exc:
+                    LiveMetrics.item_finished('failed')
                     clearml_task.mark_failed(status_message="".join(traceback.format_exception_only(exc)).strip(),
                                              force=True)
                     mlflow_task.mark_failed(status_message="".join(traceback.format_exception_only(exc)).strip(),
                                             force=True)
-                    raise
+                    if isinstance(exc, KeyboardInterrupt):
+                        raise
+                    item_exception = exc
                 finally:
                     clearml_task.close()
                     mlflow_task.close()
 
+                if item_exception:
+                    self.item_failed(division_path_maker, item_p, item_exception)
+                elif final_scan_result:
+                    LiveMetrics.item_finished('rendered')
+                    self.service.record_performance(job)
+                    self.item_succeeded(division_path_maker, item_p.item_name)
+
+            if self.render_pool:
+                self.collect_renders()
+            if self.encode_pool:
+                self.collect_encodes()
+
             if self.options.stop_after:
                 if re.search(self.options.stop_after, order_item['name']):
                     LOGGER.info("Stopping after %d items due to --stop-after %s matching %s", order_num,
                                 self.options.stop_after, order_item['name'])
                     break
+            order_num += 1
+
+    def submit_render(self, division_path_maker, item_p, render_job_p, tags):
+        LOGGER.info("Electing to render %s.  Contacting ClearML...", item_p.item_name)
+        tracker_ids = self.service.start_trackers(division_path_maker, item_p.item_name, tags, render_job_p,
+                                                  self.options.reuse_trackers)
+        job = self.service.make_job(division_path_maker, item_p, render_job_p)
+        self.render_pool.submit(render_pool.RenderTask(
+            job, force_prores=self.options.force_prores, force_final=self.options.force_final,
+            encode=lambda: not self.encode_pool and not self.control.drain_requested, tags=tags,
+            tracker_ids=tracker_ids))
+        # Hold the next item until a slot is free, so that control commands and stop files still apply
+        self.collect_while(self.render_pool.full)
+
+    def collect_while(self, condition):
+        """Collect renders as they finish while condition holds, and encodes that finish meanwhile."""
+        while condition():
+            # Wake at least each second to collect encodes, rather than only when a render finishes
+            self.collect_renders(block=True, timeout=1.0 if self.encode_pool else None)
+            if self.encode_pool:
+                self.collect_encodes()
+
+    def collect_renders(self, block=False, timeout=None):
+        failed_tasks = []
+        for task in self.render_pool.collect(block=block, timeout=timeout):
+            item_name = task.job.params.item.item_name
+            if isinstance(task.exception, KeyboardInterrupt):
+                raise task.exception
+            if isinstance(task.exception, render_job.RenderCancelled):
+                LOGGER.info("Render of %s was cancelled", item_name)
+                continue
+
+            self.service.report_task(task)
+            if task.exception:
+                failed_tasks.append(task)
+                LiveMetrics.item_finished('failed')
+            elif task.final_scan_result:
+                LiveMetrics.item_finished('rendered')
+                self.service.record_performance(task.job)
+                self.item_succeeded(task.job.path_maker, item_name)
+
+            if not task.exception and not task.final_scan_result:
+                if self.encode_pool and not self.control.drain_requested:
+                    self.encode_pool.submit(encode_pool.EncodeTask(task.job, force_final=self.options.force_final,
+                                                                   tags=task.tags, tracker_ids=task.tracker_ids))
+                else:
+                    LOGGER.info("Draining, so leaving the encode of %s for a later run", item_name)
+
+        for task in failed_tasks:
+            self.item_failed(task.job.path_maker, task.job.params.item, task.exception)
+
+    def collect_encodes(self, block=False):
+        failed_tasks = []
+        for task in self.encode_pool.collect(block=block):
+            item_name = task.job.params.item.item_name
+            if isinstance(task.exception, render_job.EncodeCancelled):
+                LOGGER.info("Encode of %s was cancelled", item_name)
+                continue
+
+            self.service.report_task(task)
+            if task.exception:
+                LOGGER.error("Encode of %s failed: %s", item_name, task.exception)
+                failed_tasks.append(task)
+                LiveMetrics.item_finished('failed')
+            else:
+                LOGGER.info("Encode of %s complete", item_name)
+                LiveMetrics.item_finished('rendered')
+                self.service.record_performance(task.job)
+                self.item_succeeded(task.job.path_maker, item_name)
+
+        for task in failed_tasks:
+            self.item_failed(task.job.path_maker, task.job.params.item, task.exception)
 
     def prepare_env(self):
-        env_filepath = f"{socket.gethostname()}-{self.options.env_filepath}"
-        if not os.path.isfile(env_filepath):
-            env_filepath = self.options.env_filepath
-        self.path_maker = path_maker.PathMaker(env_filepath)
+        with Profiler.span('env_load'):
+            self.load_env()
+
+    def load_env(self):
+        self.service = render_service.RenderService(
+            self.options.env_filepath, render_params_path=self.options.render_params_base,
+            probe_cache_path=self.options.probe_cache, division_index_path=self.options.division_index,
+            perf_history_path=self.options.perf_history, failure_history_path=self.options.failure_history,
+            use_ae_session=self.options.ae_session).open()
+        self.path_maker = self.service.path_maker
         if self.options.event:
             self.path_maker.set_default_event(self.options.event)
         if self.options.division:
@@ -149,14 +340,37 @@ class Render:
         if self.options.variant:
             self.path_maker.set_default_variant(self.options.variant)
 
-        if self.path_maker.env['clearml_uri']:
-            Trackers.init_clearml(self.path_maker.env['clearml_uri'])
-        if self.path_maker.env['mlflow_uri']:
-            Trackers.init_mlflow(self.path_maker.env['mlflow_uri'])
+        self.render_pool = self.service.render_pool
+        self.max_consecutive_failures = self.path_maker.env.get('max_consecutive_failures', 3)
+        self.encode_pool = encode_pool.EncodePool.from_env(self.path_maker.env)
+        if self.encode_pool and not self.render_pool:
+            # Render on a worker thread, so the main thread can collect encodes that finish during a render
+            self.render_pool = render_pool.RenderPool(1)
+        LiveMetrics.encode_pool = self.encode_pool
+        self.control.encode_pool = self.encode_pool
 
     def parse_args(self):
         parser = argparse.ArgumentParser(description='Slow Motion Rowing renderer.')
 
+        parser.add_argument('--ae-session',
+                            action='store_true',
+                            help='Keep After Effects running with the project open between consecutive items that '
+                                 'share an AE project, so it starts and loads the project once per group.  Only '
+                                 'for dedicated render hosts, as aerender -reuse attaches to any running instance')
+        parser.add_argument('--batch',
+                            nargs='+',
+                            metavar='SPEC',
+                            help='Render several divisions in one run.  Each SPEC is event/division[/variant], '
+                                 'where each part may be a glob, e.g. hoc2025/div* or "*/divm1"')
+        parser.add_argument('--batch-order',
+                            choices=['sequential', 'interleave'],
+                            default='sequential',
+                            help='Take items from batch divisions one division after another, or round robin')
+        parser.add_argument('--control-port',
+                            default=None,
+                            type=int,
+                            help='Accept commands from render_control.py on this local port, e.g. to pause, '
+                                 'drain or change encode slots during the run')
         parser.add_argument('--debug',
                             action='store_true',
                             help='include to set logging to debug')
@@ -165,12 +379,20 @@ class Render:
         parser.add_argument('--division',
                             default=None,
                             help='Division name, e.g. divm1')
+        parser.add_argument('--division-index',
+                            default='sloerender_division_index.sqlite',
+                            help='Compiled index of order and item files, refreshed from any changed files. '
+                                 'Pass an empty string to parse the json5 files directly')
         parser.add_argument('--env-filepath',
                             default='sloerender_env.json5',
                             help='Path to the environment file (see sloerender_env_sample.json5')
         parser.add_argument('--event',
                             default=None,
                             help='Event name, e.g. mays2024')
+        parser.add_argument('--failure-history',
+                            default='sloerender_failure_history.sqlite',
+                            help='Local database of item failures, used to quarantine items that keep failing '
+                                 'until their inputs change (see retry_policy.py).  Pass an empty string to disable')
         parser.add_argument('--force-final',
                             action='store_true',
                             help='Force generation of the final file even if it is already present')
@@ -180,9 +402,32 @@ class Render:
         parser.add_argument('--include',
                             default='.*',
                             help='Filter regexp to select the names of items to be rendered')
+        parser.add_argument('--metrics-host',
+                            default='127.0.0.1',
+                            help='Address for --metrics-port to listen on, e.g. 0.0.0.0 to allow remote scraping')
+        parser.add_argument('--metrics-port',
+                            default=None,
+                            type=int,
+                            help='Serve live metrics on this port, as Prometheus text at /metrics and json at /status')
+        parser.add_argument('--perf-history',
+                            default='sloerender_perf_history.sqlite',
+                            help='Local database of per-item render performance, for perf_history.py compare and '
+                                 'run estimates.  Pass an empty string to disable')
+        parser.add_argument('--probe-cache',
+                            default='sloerender_probe_cache.json',
+                            help='Cache file for tool paths and preferences found at startup')
         parser.add_argument('--render-params-base',
                             default='render_params_base.json5',
                             help='Parameter file (json5) for rendering')
+        parser.add_argument('--profile',
+                            nargs='?',
+                            const='sloerender_trace.json',
+                            default=None,
+                            help='Record per-stage timings and write them as a Chrome trace to this file')
+        parser.add_argument('--profile-python',
+                            choices=['cprofile', 'sample'],
+                            default=None,
+                            help='With --profile, also profile the Python process with cProfile or stack sampling')
         parser.add_argument('--reuse-trackers',
                             action='store_true',
                             help='Reuse tracker IDs to prevent creation of new experiments')
@@ -191,6 +436,22 @@ class Render:
                             help='Process in reverse order')
         parser.add_argument('--stop-after',
                             help='Stop processing after this many (number) or the next name matches (regexp)')
+        parser.add_argument('--subprocess-log-dir',
+                            default=None,
+                            help='Write aerender and HandBrakeCLI output to compressed per-job files in this '
+                                 'directory, logging only periodic summaries to the console')
+        parser.add_argument('--subprocess-log-max-mb',
+                            default=50,
+                            type=int,
+                            help='Uncompressed size at which a per-job output file is rotated')
+        parser.add_argument('--subprocess-log-backups',
+                            default=3,
+                            type=int,
+                            help='Number of rotated per-job output files to keep')
+        parser.add_argument('--subprocess-log-summary-seconds',
+                            default=30.0,
+                            type=float,
+                            help='Minimum interval between console summaries of subprocess output')
         parser.add_argument('--variant',
                             default=None,
                             help='Variant name, e.g. nextgen')
@@ -209,6 +470,18 @@ if __name__ == '__main__':
     with wakepy.keep.running(on_fail="warn"):
         app = Render()
         app.parse_args()
+        if app.options.profile:
+            Profiler.enable(app.options.profile, python_profile=app.options.profile_python)
+        if app.options.control_port:
+            app.control.serve(app.options.control_port)
+        if app.options.metrics_port:
+            LiveMetrics.serve(app.options.metrics_port, host=app.options.metrics_host)
+            Profiler.add_listener(LiveMetrics)
+        if app.options.subprocess_log_dir:
+            SubprocessLog.configure(app.options.subprocess_log_dir,
+                                    max_bytes=app.options.subprocess_log_max_mb * 1024 * 1024,
+                                    backup_count=app.options.subprocess_log_backups,
+                                    summary_seconds=app.options.subprocess_log_summary_seconds)
         app.prepare_env()
         count = 0
         while os.path.exists("semaphore.txt"):
@@ -218,9 +491,13 @@ if __name__ == '__main__':
             time.sleep(5)
         try:
             app.do_work()
-        except Exception as exc:
-            LOGGER.error("Exception in main loop: %s", exc)
-            app.do_work()
         finally:
+            app.service.close()
+            Profiler.finish()
+            SubprocessLog.close()
+            LiveMetrics.close()
+            app.control.close()
             if os.path.exists("semaphore.txt"):
                 os.remove("semaphore.txt")
+        if app.failed_items:
+            sys.exit(1)
@@ -0,0 +1,6 @@
+def format_table(columns, rows):
+    """Left-aligned plain text table of string values, for the summaries the command line tools log."""
+    widths = [max([len(column)] + [len(row[i]) for row in rows]) for i, column in enumerate(columns)]
+    lines = ["  ".join(column.ljust(widths[i]) for i, column in enumerate(columns))]
+    lines += ["  ".join(value.ljust(widths[i]) for i, value in enumerate(row)) for row in rows]
+    return "\n".join(lines)
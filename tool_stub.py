@@ -0,0 +1,261 @@
+# python 3.12
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+USAGE_DESCRIPTION = '''
+Stand-in for external render tools so that the orchestration code can be exercised without GPUs or Windows.
+Example of usage:
+python tool_stub.py handbrake --input clip.mov --output clip.mp4 --json --encoder nvenc_h265 --vb 60000
+python tool_stub.py aerender -project x.aep -comp "comp name" -output out.mov
+python tool_stub.py record --output aerender.jsonl -- aerender.exe -project x.aep -comp "comp name" -output out.mov
+python tool_stub.py replay aerender.jsonl
+
+Behaviour is tuned through environment variables:
+  SLOE_STUB_FRAMES      number of frames in the input (default 1800)
+  SLOE_STUB_FRAME_RATE  input frame rate (default 50)
+  SLOE_STUB_SPEEDUP     how much faster than the modelled tool to run (default 1.0)
+  SLOE_STUB_SIZE_SCALE  fraction of the modelled output size actually written (default 0.001)
+  SLOE_STUB_LINE_RATE   aerender progress lines per second before speedup (default 2)
+  SLOE_STUB_REPLAY      if set, the handbrake and aerender stubs replay this recording instead
+'''
+
+# Modelled encode rates in frames per second, roughly those of a 4K ProRes source on an RTX-class GPU
+ENCODER_FPS = {
+    'nvenc_h264': 220.0,
+    'nvenc_h265': 180.0,
+    'nvenc_h265_10bit': 160.0,
+    'nvenc_av1': 150.0,
+    'x264': 25.0,
+    'x265': 8.0,
+}
+PRESET_FACTOR = {
+    'fastest': 1.6,
+    'faster': 1.4,
+    'fast': 1.2,
+    'medium': 1.0,
+    'slow': 0.8,
+    'slower': 0.6,
+    'quality': 0.7,
+    'speed': 1.3,
+}
+
+
+def env_float(name, default):
+    return float(os.environ.get(name, default))
+
+
+def emit(stream, text):
+    stream.write(text + '\n')
+    stream.flush()
+
+
+def emit_json(label, data):
+    emit(sys.stdout, f"{label}: " + json.dumps(data, indent=4))
+
+
+def handbrake_log(message):
+    emit(sys.stderr, time.strftime('[%H:%M:%S] ') + message)
+
+
+def handbrake_scan(options):
+    handbrake_log("hb_init: starting libhb thread")
+    if not os.path.isfile(options.input):
+        handbrake_log(f"scan: unrecognized file type: {options.input}")
+        return 3
+
+    frames = int(env_float('SLOE_STUB_FRAMES', 1800))
+    frame_rate = env_float('SLOE_STUB_FRAME_RATE', 50)
+    emit_json('Progress', dict(State='SCANNING', Scanning=dict(Preview=0, PreviewCount=1, Progress=0.0,
+                                                                SequenceID=0, Title=1, TitleCount=1)))
+    duration = frames / frame_rate
+    emit_json('JSON Title Set', dict(MainFeature=0, TitleList=[dict(
+        AudioList=[dict(BitRate=1536000, ChannelCount=2, CodecName='pcm_s16le', Description='Stereo',
+                        SampleRate=48000, TrackNumber=1)],
+        ChapterList=[],
+        Duration=dict(Hours=int(duration // 3600), Minutes=int(duration % 3600 // 60),
+                      Seconds=int(duration % 60), Ticks=int(duration * 90000)),
+        FrameRate=dict(Den=1, Num=int(frame_rate)),
+        Geometry=dict(Height=2160, PAR=dict(Den=1, Num=1), Width=3840),
+        Index=1,
+        Name=os.path.basename(options.input),
+        Path=options.input,
+        VideoCodec='prores',
+    )]))
+    handbrake_log("libhb: scan thread found 1 valid title(s)")
+    return 0
+
+
+def handbrake_encode(options):
+    handbrake_log("hb_init: starting libhb thread")
+    if not os.path.isfile(options.input):
+        handbrake_log(f"scan: unrecognized file type: {options.input}")
+        return 3
+
+    frames = int(env_float('SLOE_STUB_FRAMES', 1800))
+    frame_rate = env_float('SLOE_STUB_FRAME_RATE', 50)
+    speedup = env_float('SLOE_STUB_SPEEDUP', 1.0)
+    fps = ENCODER_FPS.get(options.encoder, 30.0) * PRESET_FACTOR.get(options.encoder_preset, 1.0)
+    if not options.enable_hw_decoding:
+        fps *= 0.75
+    if options.turbo:
+        fps *= 1.05
+
+    handbrake_log(f"encoder: {options.encoder} preset {options.encoder_preset} at {options.vb} kbps")
+    start_time = time.monotonic()
+    frames_done = 0
+    sequence_id = 0
+    while frames_done < frames:
+        time.sleep(0.5 / speedup)
+        sequence_id += 1
+        frames_done = min(frames, frames_done + int(fps * 0.5))
+        elapsed = time.monotonic() - start_time
+        rate_avg = frames_done / (elapsed * speedup) if elapsed else 0.0
+        eta = int((frames - frames_done) / fps)
+        emit_json('Progress', dict(State='WORKING', Working=dict(
+            ETASeconds=eta, Hours=eta // 3600, Minutes=eta % 3600 // 60, Pass=1, PassCount=1, PassID=-1, Paused=0,
+            Progress=frames_done / frames, Rate=fps, RateAvg=rate_avg, Seconds=eta % 60, SequenceID=sequence_id)))
+
+    output_bytes = int(int(options.vb) * 1000 / 8 * frames / frame_rate * env_float('SLOE_STUB_SIZE_SCALE', 0.001))
+    with open(options.output, 'wb') as file:
+        file.write(b'\0' * output_bytes)
+    emit_json('Progress', dict(State='WORKDONE', WorkDone=dict(Error=0, SequenceID=sequence_id + 1)))
+    handbrake_log("libhb: work result = 0")
+    emit(sys.stderr, "Encode done!")
+    return 0
+
+
+def aerender_main(args):
+    if os.environ.get('SLOE_STUB_REPLAY'):
+        return replay(os.environ['SLOE_STUB_REPLAY'], env_float('SLOE_STUB_SPEEDUP', 1.0))
+
+    parser = argparse.ArgumentParser(prog='aerender', prefix_chars='-')
+    parser.add_argument('-comp', default='Comp 1')
+    parser.add_argument('-output')
+    parser.add_argument('-project')
+    options, _ = parser.parse_known_args(args)
+
+    frames = int(env_float('SLOE_STUB_FRAMES', 1800))
+    frame_rate = env_float('SLOE_STUB_FRAME_RATE', 50)
+    interval = 1.0 / env_float('SLOE_STUB_LINE_RATE', 2) / env_float('SLOE_STUB_SPEEDUP', 1.0)
+
+    emit(sys.stdout, "aerender version 25.2x1")
+    emit(sys.stdout, f"PROGRESS:  {time.strftime('%d/%m/%Y %H:%M:%S')}: "
+                     f"Starting composition \u00ab{options.comp}\u00bb.")
+    emit(sys.stdout, "PROGRESS:  Render Settings: Best Settings")
+    emit(sys.stdout, "PROGRESS:  Output Module: Sloe ProRes")
+    emit(sys.stdout, f"PROGRESS:  Output To: {options.output}")
+    start_time = time.monotonic()
+    for frame in range(1, frames + 1):
+        time.sleep(interval)
+        comp_seconds = (frame - 1) / frame_rate
+        timecode = f"{int(comp_seconds // 3600)}:{int(comp_seconds % 3600 // 60):02d}:" \
+                   f"{int(comp_seconds % 60):02d}:{int((frame - 1) % frame_rate):02d}"
+        emit(sys.stdout, f"PROGRESS:  {timecode} ({frame}): {int(time.monotonic() - start_time)} Seconds")
+
+    if options.output:
+        output_bytes = int(700000 * 1000 / 8 * frames / frame_rate * env_float('SLOE_STUB_SIZE_SCALE', 0.001))
+        with open(options.output, 'wb') as file:
+            file.write(b'\0' * output_bytes)
+    emit(sys.stdout, f"PROGRESS:  Total Time Elapsed: {int(time.monotonic() - start_time)} Seconds")
+    emit(sys.stdout, f"PROGRESS:  {time.strftime('%d/%m/%Y %H:%M:%S')}: "
+                     f"Finished composition \u00ab{options.comp}\u00bb.")
+    return 0
+
+
+def record(args):
+    """Run a real tool, passing its output through and saving it with timestamps as jsonl."""
+    parser = argparse.ArgumentParser(prog='record')
+    parser.add_argument('--output', required=True)
+    parser.add_argument('command', nargs=argparse.REMAINDER)
+    options = parser.parse_args(args)
+    command = options.command[1:] if options.command[:1] == ['--'] else options.command
+
+    lock = threading.Lock()
+    start_time = time.monotonic()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    with open(options.output, 'w', encoding='utf-8') as recording:
+        def _reader(stream, stream_label, passthrough):
+            for raw_line in iter(stream.readline, b''):
+                line = raw_line.decode(errors='replace').rstrip('\n')
+                with lock:
+                    recording.write(json.dumps(dict(t=round(time.monotonic() - start_time, 4), stream=stream_label,
+                                                    line=line)) + '\n')
+                emit(passthrough, line)
+
+        threads = [threading.Thread(target=_reader, args=(process.stdout, 'OUT', sys.stdout)),
+                   threading.Thread(target=_reader, args=(process.stderr, 'ERR', sys.stderr))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        rc = process.wait()
+        recording.write(json.dumps(dict(t=round(time.monotonic() - start_time, 4), rc=rc)) + '\n')
+    return rc
+
+
+def replay(recording_path, speedup=1.0):
+    start_time = time.monotonic()
+    rc = 0
+    with open(recording_path, 'r', encoding='utf-8') as recording:
+        for record_line in recording:
+            entry = json.loads(record_line)
+            delay = entry['t'] / speedup - (time.monotonic() - start_time)
+            if delay > 0:
+                time.sleep(delay)
+            if 'rc' in entry:
+                rc = entry['rc']
+            else:
+                emit(sys.stdout if entry['stream'] == 'OUT' else sys.stderr, entry['line'])
+    return rc
+
+
+def replay_main(args):
+    parser = argparse.ArgumentParser(prog='replay')
+    parser.add_argument('recording')
+    parser.add_argument('--speedup', type=float, default=env_float('SLOE_STUB_SPEEDUP', 1.0))
+    options = parser.parse_args(args)
+    return replay(options.recording, options.speedup)
+
+
+def handbrake_main(args):
+    if os.environ.get('SLOE_STUB_REPLAY'):
+        return replay(os.environ['SLOE_STUB_REPLAY'], env_float('SLOE_STUB_SPEEDUP', 1.0))
+
+    parser = argparse.ArgumentParser(prog='HandBrakeCLI')
+    parser.add_argument('--input')
+    parser.add_argument('--output')
+    parser.add_argument('--scan', action='store_true')
+    parser.add_argument('--encoder', default='x264')
+    parser.add_argument('--encoder-preset', default='medium')
+    parser.add_argument('--enable-hw-decoding', default=None)
+    parser.add_argument('--turbo', action='store_true')
+    parser.add_argument('--vb', default=6000)
+    options, _ = parser.parse_known_args(args)
+    if options.scan:
+        return handbrake_scan(options)
+    return handbrake_encode(options)
+
+
+TOOLS = {
+    'aerender': aerender_main,
+    'handbrake': handbrake_main,
+    'record': record,
+    'replay': replay_main,
+}
+
+
+def stub_command(tool):
+    """Command prefix that runs the named stub in place of the real executable."""
+    return [sys.executable, os.path.abspath(__file__), tool]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in TOOLS:
+        sys.stderr.write(USAGE_DESCRIPTION)
+        sys.exit(2)
+    sys.exit(TOOLS[sys.argv[1]](sys.argv[2:]))
@@ -1,4 +1,5 @@
 import logging
+import threading
 from typing import Dict
 
 import clearml
@@ -11,6 +12,8 @@ logging.getLogger("urllib3").setLevel(logging.INFO)
 
 
 class NullClass:
+    id = None
+
     def __call__(self, *args, **kwargs):
         return self
 
@@ -25,6 +28,9 @@ class NullClass:
 
 
 class MLflowTask:
+    def __init__(self, run_id):
+        self.id = run_id
+
     def connect(self, params, name=None):
 
         def _log_dict(prefix, dict_param):
@@ -53,9 +59,37 @@ class MLflowTask:
         mlflow.end_run()
 
 
+class TrackerRecorder:
+    """Holds tracker calls made on a worker thread so they can be replayed into the item's run later."""
+
+    def __init__(self):
+        self.calls = []
+
+    def __enter__(self):
+        Trackers.local.recorder = self
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        Trackers.local.recorder = None
+
+    def replay(self):
+        for method_name, args in self.calls:
+            getattr(Trackers, method_name)(*args)
+        self.calls = []
+
+
 class Trackers:
     CLEARML_ENABLED = True
     MLFLOW_ENABLED = True
+    local = threading.local()
+
+    @classmethod
+    def recording(cls, method_name, *args):
+        recorder = getattr(cls.local, 'recorder', None)
+        if recorder is None:
+            return False
+        recorder.calls.append((method_name, args))
+        return True
 
     @classmethod
     def init_clearml(cls, clearml_uri):
@@ -68,7 +102,8 @@ class Trackers:
         cls.mlflow_uri = mlflow_uri
 
     @classmethod
-    def clearml_task_init(cls, project_name, task_name, enabled=None, reuse_trackers=False, **kwargs):
+    def clearml_task_init(cls, project_name, task_name, enabled=None, reuse_trackers=False, continue_task=None,
+                          **kwargs):
         if enabled is not None:
             cls.CLEARML_ENABLED = enabled
         if not cls.CLEARML_ENABLED:
@@ -78,10 +113,13 @@ class Trackers:
                 project_name=project_name,
                 task_name=task_name,
                 reuse_last_task_id=reuse_trackers,
+                # Reopen a task by ID without resetting what it has already logged
+                continue_last_task=continue_task or False,
                 **kwargs)
 
     @classmethod
-    def mlflow_task_init(cls, project_name, task_name, enabled=None, reuse_trackers=False, **kwargs):
+    def mlflow_task_init(cls, project_name, task_name, enabled=None, reuse_trackers=False, continue_task=None,
+                         **kwargs):
         if enabled is not None:
             cls.MLFLOW_ENABLED = enabled
 
@@ -105,29 +143,38 @@ class Trackers:
                 experiment_id = mlflow.create_experiment(project_name)
 
             run_list = []
-            if reuse_trackers:
+            if reuse_trackers and not continue_task:
                 run_list = mlflow.search_runs([experiment_id],
                                               filter_string=f"run_name='{task_name}'",
                                               order_by=['start_time DESC'],
                                               output_format='list',
                                               run_view_type=mlflow.entities.ViewType.ACTIVE_ONLY)
-            if run_list:
+            if continue_task:
+                LOGGER.info("Continuing MLflow run %s", continue_task)
+                run = mlflow.start_run(experiment_id=experiment_id,
+                                       log_system_metrics=True,
+                                       run_id=continue_task,
+                                       **kwargs)
+            elif run_list:
                 LOGGER.info("Reusuing MLflow run with name %s", run_list[0].info.run_name)
-                mlflow.start_run(experiment_id=experiment_id,
-                                 log_system_metrics=True,
-                                 run_id=run_list[0].info.run_id,
-                                 **kwargs)
+                run = mlflow.start_run(experiment_id=experiment_id,
+                                       log_system_metrics=True,
+                                       run_id=run_list[0].info.run_id,
+                                       **kwargs)
             else:
                 LOGGER.info("Creating new MLflow run with name %s", task_name)
-                mlflow.start_run(experiment_id=experiment_id,
-                                 log_system_metrics=True,
-                                 run_name=task_name,
-                                 **kwargs)
+                run = mlflow.start_run(experiment_id=experiment_id,
+                                       log_system_metrics=True,
+                                       run_name=task_name,
+                                       **kwargs)
 
-            return MLflowTask()
+            return MLflowTask(run.info.run_id)
 
     @classmethod
     def report_scalar(cls, title, series, value, iteration):
+        if cls.recording('report_scalar', title, series, value, iteration):
+            return
+
         if cls.CLEARML_ENABLED:
             logger = clearml.Logger.current_logger()
             logger.report_scalar(
@@ -141,6 +188,9 @@ class Trackers:
 
     @classmethod
     def add_tags(cls, tags: Dict[str, str]):
+        if cls.recording('add_tags', tags):
+            return
+
         if cls.CLEARML_ENABLED:
             clearml.Task.current_task().add_tags(list(tags.keys()))
 